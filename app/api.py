@@ -1,24 +1,101 @@
 """API interface."""
+import asyncio
 import csv
-import logging
-import os
 import datetime
+import hashlib
+import io
+import json
+import logging
+import time
+from contextlib import contextmanager
 from pathlib import Path
-from tempfile import TemporaryDirectory
 
+import attr
 import connexion
 from connexion.exceptions import OAuthProblem
-from fabric import Connection
 from flask import current_app as app
-from flask import request
+from flask import Response, request, stream_with_context
 from paramiko.ssh_exception import SSHException
 
-from .db import CaseNotFoundError
-from .exceptions import PipelineExecutionError, SSHKeyException
-from .io import IndividualIdNotFoundError, create_new_pedigree, create_rundata
+from .breaker import OPEN
+from .cache import CaseCache
+from .coalesce import get_coalescer
+from .db import (
+    CASE_PROJECTION,
+    CaseNotFoundError,
+    database_breaker,
+    iter_cases,
+    query_case,
+    query_case_async,
+    query_cases,
+    query_cases_async,
+)
+from .exceptions import (
+    CircuitOpenError,
+    ConnectionPoolTimeout,
+    IdempotencyKeyConflict,
+    LaunchUnknownError,
+    MissingInputFilesError,
+    NoSampleIdError,
+    PipelineExecutionError,
+    QueueFullError,
+    SSHKeyException,
+)
+from .hosts import (
+    get_router,
+    get_workflow_host,
+    host_breaker,
+    is_failover_error,
+    workflow_hosts,
+)
+from .io import (
+    RESCORE_VCF_TYPES,
+    VCF_COLUMNS,
+    IndividualIdNotFoundError,
+    create_new_pedigree,
+    create_rundata,
+    diff_pedigree,
+    export_pedigrees,
+    rescored_vcf_types,
+)
+from .jobs import (
+    DONE,
+    FAILED,
+    AsyncJobManager,
+    current_job,
+    get_job_manager,
+    record_stage,
+    run_blocking,
+    stage,
+)
+from .metrics import AUTHENTICATIONS, ERRORS
+from .remote import (
+    CONNECT_ERRORS,
+    asyncssh_error,
+    get_async_pool,
+    get_connect_kwargs,
+    get_pool,
+    transport_errors,
+)
+from .preflight import check_inputs, get_preflight_cache, preflight, preflight_async
+from .scheduler import get_host_limiter
+from .store import get_job_store
+from .tracing import new_trace_id, parse_traceparent, span
+from .tracking import RemoteLaunch, detached_cmd, get_tracker
+from .uploads import (
+    finish_upload,
+    prepare_upload,
+    prepare_upload_async,
+    upload_cmd,
+    upload_files,
+    upload_files_async,
+)
 
 LOG = logging.getLogger(__name__)
 
+# queue priorities of reruns, lower is run first
+RERUN_PRIORITIES = {"clinical": 0, "research": 10}
+
 
 def authenticate_user(user_email, api_key, required_scopes=None):
     """Authenticate API keys."""
@@ -27,12 +104,15 @@ def authenticate_user(user_email, api_key, required_scopes=None):
         LOG.error(
             f'Error passwd "{api_key}" not matching expected "{app.config["API_SECRET_KEY"]}"'
         )
+        AUTHENTICATIONS.inc("bad_key")
         raise OAuthProblem()
     authorized_users = app.config["AUTHORIZED_USERS"]
     LOG.info(f"loading list of authorized users: {authorized_users}")
     if not user_email in authorized_users:
         LOG.error(f"{user_email} not in {authorized_users}")
+        AUTHENTICATIONS.inc("unauthorized_user")
         raise OAuthProblem()
+    AUTHENTICATIONS.inc("success")
 
     info = {"sub": user_email, "scope": "super_user"}
 
@@ -53,98 +133,938 @@ def build_new_case_id(case_id):
     return f"{case_id}-ped-update-{date}"
 
 
+@attr.s(frozen=True)
+class PreparedRerun(object):
+    """Run data and pedigree files of a rerun serialized in memory."""
+
+    case_id = attr.ib(type=str)
+    rerun_group_id = attr.ib(type=str)
+    base_fname = attr.ib(type=str)
+    run_data = attr.ib(type=str, repr=False)  # csv content
+    pedigree = attr.ib(type=str, repr=False)  # ped content
+    changes = attr.ib(factory=list)  # changes compared with the original case
+    input_files = attr.ib(factory=tuple)  # vcf files read by the rescoring
+
+    @property
+    def is_noop(self):
+        """Check if the rerun would not change the pedigree of the case."""
+        return len(self.changes) == 0
+
+    @property
+    def run_data_fname(self):
+        return f"{self.base_fname}.csv"
+
+    @property
+    def ped_fname(self):
+        return f"{self.base_fname}.ped"
+
+
+def prepare_rerun(case_id, sample_ids=[], body=[], case=None):
+    """Build run data and pedigree files of a rerun.
+
+    Only the vcf files affected by the changes to the pedigree are included
+    in the run data.
+    """
+    if case is None:
+        case = query_case(case_id)
+    # create a new group id for the rerun
+    rerun_group_id = build_new_case_id(case_id)
+    with stage("build_pedigree"):
+        pedigree = create_new_pedigree(case_id, rerun_group_id, sample_ids, body, case=case)
+    with stage("diff_pedigree"):
+        changes = diff_pedigree(case, pedigree)
+        vcf_types = rescored_vcf_types(
+            changes, app.config.get("RESCORE_VCF_TYPES", RESCORE_VCF_TYPES)
+        )
+
+    date = datetime.datetime.now().strftime("%y%m%d_%H%M%S")
+    base_fname = f"{case_id}_{date}_rescore"
+
+    # serialize run data to csv format
+    with stage("build_rundata"):
+        run_data = create_rundata(case_id, rerun_group_id, case=case, vcf_types=vcf_types)
+    with stage("serialize"):
+        run_data_out = io.StringIO()
+        cwriter = csv.DictWriter(run_data_out, fieldnames=list(run_data[0].keys()))
+        cwriter.writeheader()
+        for row in run_data:
+            cwriter.writerow(row)
+
+        # serialize pedigree
+        ped_out = io.StringIO()
+        pedigree.to_ped(ped_out, write_header=False)
+    input_files = tuple(row[column] for row in run_data for column in VCF_COLUMNS if row.get(column))
+    return PreparedRerun(
+        case_id,
+        rerun_group_id,
+        base_fname,
+        run_data_out.getvalue(),
+        ped_out.getvalue(),
+        changes,
+        input_files,
+    )
+
+
+def _case_digest(case):
+    """Hash the fields of a case that reruns are prepared from."""
+    fields = {key: case.get(key) for key in CASE_PROJECTION}
+    return hashlib.sha256(json.dumps(fields, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def prepare_rerun_cached(case_id, sample_ids=[], body=[], case=None):
+    """Build run data and pedigree files of a rerun, reusing those of a matching preview.
+
+    A preview is used at most once and only if the case is unchanged since
+    it was prepared.
+    """
+    if case is None:
+        case = query_case(case_id)
+    cache = get_preview_cache()
+    if cache is not None:
+        key = request_hash(case_id, sample_ids, body)
+        entry = cache.get(key)
+        if entry is not None:
+            cache.invalidate(key)  # files of a preview are only submitted once
+            digest, prepared = entry
+            if digest == _case_digest(case):
+                LOG.info(f"Using the files of the preview of {case_id}")
+                return prepared
+    return prepare_rerun(case_id, sample_ids, body, case=case)
+
+
+def noop_result(prepared):
+    """Result of a rerun that was skipped because nothing changed."""
+    LOG.info(f"Skipping rerun of {prepared.case_id}, the pedigree is unchanged")
+    return {"rerun_group_id": prepared.rerun_group_id, "noop": True, "changes": []}
+
+
+def skip_noop(prepared):
+    """Check if a prepared rerun should be skipped."""
+    return prepared.is_noop and app.config.get("RERUN_SKIP_NOOP", True)
+
+
+def _remote_files(prepared, host):
+    """Remote paths and contents of the files of a prepared rerun on a host."""
+    remote_data = Path(get_workflow_host(host).data_dir)
+    return {
+        remote_data / prepared.run_data_fname: prepared.run_data,
+        remote_data / prepared.ped_fname: prepared.pedigree,
+    }
+
+
+def _record_rerun(prepared, remote_run_data, host):
+    """Record a submitted rerun in the job store, if enabled."""
+    store = get_job_store()
+    if store is not None:
+        job = current_job()
+        command = _rescore_cmd(host, remote_run_data)[0]
+        store.record_rerun(job and job.id, prepared, host, remote_run_data, command)
+
+
+def _submit_result(prepared, remote_run_data, host, launch, record=True):
+    """Result of a submitted rerun, detached launches are tracked until they exit.
+
+    The rerun is recorded in the job store, if enabled.
+    """
+    job = current_job()
+    if record:
+        _record_rerun(prepared, remote_run_data, host)
+    result = {
+        "rerun_group_id": prepared.rerun_group_id,
+        "run_data": str(remote_run_data),
+        "host": host,
+        "changes": prepared.changes,
+    }
+    if launch is not None:
+        if job is None:
+            result["remote"] = launch.to_json()
+        else:  # collect exit status in the background
+            get_tracker().track(job, launch, result)
+    return result
+
+
+async def _submit_result_async(prepared, remote_run_data, host, launch):
+    """Result of a submitted rerun, recorded in the executor, see _submit_result."""
+    await run_blocking(_record_rerun, prepared, remote_run_data, host)
+    return _submit_result(prepared, remote_run_data, host, launch, record=False)
+
+
+def launch_rerun(conn, prepared):
+    """Transfer files of a prepared rerun and start it on the remote.
+
+    With WORKFLOW_PIPELINED_SUBMIT the files are written and the analysis
+    started by a single remote command. With WORKFLOW_DETACHED the analysis
+    is started in the background. With UPLOAD_CACHE files already on the
+    remote are linked instead of uploaded. Returns the remote path of the
+    run data and the launch if detached.
+    """
+    files = _remote_files(prepared, conn.host)
+    remote_run_data = next(iter(files))
+    detached = app.config.get("WORKFLOW_DETACHED", False)
+    if app.config.get("WORKFLOW_PIPELINED_SUBMIT", False):
+        with stage("run_rescore"):
+            # upload and start rerun
+            launch = run_rescore(conn, remote_run_data, files=files, detached=detached)
+    else:
+        LOG.debug(
+            f"Uploading {prepared.run_data_fname} and {prepared.ped_fname} "
+            f"to {remote_run_data.parent}"
+        )
+        with stage("upload"):
+            upload_files(conn, files)
+        with stage("run_rescore"):
+            launch = run_rescore(conn, remote_run_data, detached=detached)  # start rerun
+    return remote_run_data, launch if detached else None
+
+
+async def launch_rerun_async(conn, prepared):
+    """Transfer files of a prepared rerun and start it without blocking.
+
+    The files are written by a remote command, see launch_rerun.
+    """
+    files = _remote_files(prepared, conn.host)
+    remote_run_data = next(iter(files))
+    detached = app.config.get("WORKFLOW_DETACHED", False)
+    if app.config.get("WORKFLOW_PIPELINED_SUBMIT", False):
+        with stage("run_rescore"):
+            launch = await run_rescore_async(conn, remote_run_data, files=files, detached=detached)
+    else:
+        with stage("upload"):
+            await upload_files_async(conn, files)
+        with stage("run_rescore"):
+            launch = await run_rescore_async(conn, remote_run_data, detached=detached)
+    return remote_run_data, launch if detached else None
+
+
+def submit_rerun(conn, prepared):
+    """Start a prepared rerun on the remote, see launch_rerun.
+
+    With WORKFLOW_PREFLIGHT the rerun is rejected if its input files are
+    missing on the remote. Detached analyses are tracked until they exit.
+    """
+    check_inputs(preflight(conn, [prepared]), prepared.case_id)
+    remote_run_data, launch = launch_rerun(conn, prepared)
+    return _submit_result(prepared, remote_run_data, conn.host, launch)
+
+
+async def submit_rerun_async(conn, prepared):
+    """Start a prepared rerun without blocking, see submit_rerun."""
+    check_inputs(await preflight_async(conn, [prepared]), prepared.case_id)
+    remote_run_data, launch = await launch_rerun_async(conn, prepared)
+    return await _submit_result_async(prepared, remote_run_data, conn.host, launch)
+
+
+def merge_reruns(reruns):
+    """Merge prepared reruns into one with a run data row and a family per rerun."""
+    header, *rows = reruns[0].run_data.splitlines(keepends=True)
+    for prepared in reruns[1:]:
+        rows.extend(prepared.run_data.splitlines(keepends=True)[1:])
+    group_ids = [prepared.rerun_group_id for prepared in reruns]
+    digest = hashlib.sha256("|".join(group_ids).encode()).hexdigest()[:8]
+    date = datetime.datetime.now().strftime("%y%m%d_%H%M%S")
+    return PreparedRerun(
+        ",".join(prepared.case_id for prepared in reruns),
+        ",".join(group_ids),
+        f"coalesced_{date}_{digest}_rescore",
+        "".join([header, *rows]),
+        "".join(prepared.pedigree for prepared in reruns),
+        [change for prepared in reruns for change in prepared.changes],
+        tuple(path for prepared in reruns for path in prepared.input_files),
+    )
+
+
+def _coalesced_outcomes(reruns, missing, launched):
+    """Outcome of each coalesced rerun, the shared launch or the error of missing inputs."""
+    outcomes = []
+    for prepared in reruns:
+        try:
+            check_inputs(missing, prepared.case_id)
+        except MissingInputFilesError as err:
+            outcomes.append(err)
+        else:
+            outcomes.append(launched)
+    return outcomes
+
+
+def submit_coalesced(conn, reruns):
+    """Start prepared reruns with one launch of the rescoring.
+
+    Reruns with input files missing on the remote fail on their own, the
+    others share the host, run data and launch returned as their outcome.
+    """
+    missing = preflight(conn, reruns)
+    ready = [prepared for prepared in reruns if prepared.case_id not in missing]
+    launched = None
+    if ready:
+        launched = (conn.host, *launch_rerun(conn, merge_reruns(ready)))
+    return _coalesced_outcomes(reruns, missing, launched)
+
+
+async def submit_coalesced_async(conn, reruns):
+    """Start prepared reruns with one launch without blocking, see submit_coalesced."""
+    missing = await preflight_async(conn, reruns)
+    ready = [prepared for prepared in reruns if prepared.case_id not in missing]
+    launched = None
+    if ready:
+        launched = (conn.host, *await launch_rerun_async(conn, merge_reruns(ready)))
+    return _coalesced_outcomes(reruns, missing, launched)
+
+
+def submit_with_failover(prepared, submit=submit_rerun, name=None):
+    """Submit a prepared rerun to the least loaded host.
+
+    The rerun is submitted to the next host if the connection or the
+    rescoring fails, the error of the last host is raised if all fail.
+    """
+    name = name or prepared.case_id
+    connect_kwargs = get_connect_kwargs()
+    router = get_router()
+    candidates = router.candidates()
+    for workflow_host in candidates:
+        host = workflow_host.host
+        try:
+            # wait for a free submission slot and borrow a connection from the pool
+            with host_breaker(workflow_host).guard(CONNECT_ERRORS), get_host_limiter().slot(
+                host
+            ), get_pool().connection(host, workflow_host.user, connect_kwargs) as conn:
+                result = submit(conn, prepared)
+        except Exception as err:
+            if not is_failover_error(err):
+                raise
+            router.record_failure(host, err)
+            if workflow_host is candidates[-1]:
+                raise
+            LOG.warning(f"Submitting {name} to {host} failed, trying next host: {err}")
+            continue
+        router.record_success(host)
+        return result
+
+
+async def submit_with_failover_async(prepared, submit=submit_rerun_async, name=None):
+    """Submit a prepared rerun without blocking, see submit_with_failover."""
+    name = name or prepared.case_id
+    connect_kwargs = get_connect_kwargs()
+    router = get_router()
+    candidates = router.candidates()
+    for workflow_host in candidates:
+        host = workflow_host.host
+        try:
+            with host_breaker(workflow_host).guard((*CONNECT_ERRORS, asyncssh_error())):
+                async with get_host_limiter().slot_async(host), get_async_pool().connection(
+                    host, workflow_host.user, connect_kwargs
+                ) as conn:
+                    result = await submit(conn, prepared)
+        except Exception as err:
+            if not is_failover_error(err):
+                raise
+            router.record_failure(host, err)
+            if workflow_host is candidates[-1]:
+                raise
+            LOG.warning(f"Submitting {name} to {host} failed, trying next host: {err}")
+            continue
+        router.record_success(host)
+        return result
+
+
+def launch_coalesced(reruns):
+    """Submit coalesced reruns to the least loaded host, returns the outcome of each."""
+    return submit_with_failover(
+        reruns, submit=submit_coalesced, name=f"{len(reruns)} coalesced reruns"
+    )
+
+
+async def launch_coalesced_async(reruns):
+    """Submit coalesced reruns without blocking, see launch_coalesced."""
+    return await submit_with_failover_async(
+        reruns, submit=submit_coalesced_async, name=f"{len(reruns)} coalesced reruns"
+    )
+
+
+def submit_prepared(prepared):
+    """Submit a prepared rerun, with WORKFLOW_COALESCE_WINDOW together with concurrent reruns.
+
+    Coalesced reruns share one run data file and launch, each keeps its own
+    rerun group id. In a job the rerun is handed to the coalescer and the
+    job returns right away, it is finished and its result completed when
+    the group is launched.
+    """
+    coalescer = get_coalescer()
+    if coalescer is None:
+        return submit_with_failover(prepared)
+    flask_app = app._get_current_object()
+
+    def launch_group(reruns):
+        with flask_app.app_context():
+            return launch_coalesced(reruns)
+
+    job = current_job()
+    if job is None:  # wait for the launch
+        with stage("coalesce"):
+            host, remote_run_data, launch = coalescer.submit_wait(
+                prepared.rerun_group_id, prepared, launch_group
+            )
+        return _submit_result(prepared, remote_run_data, host, launch)
+
+    manager = get_job_manager()
+    result = {"rerun_group_id": prepared.rerun_group_id, "changes": prepared.changes}
+    start = time.perf_counter()
+
+    def launched(outcome):
+        def complete():
+            record_stage("coalesce", time.perf_counter() - start)
+            if isinstance(outcome, Exception):
+                raise outcome
+            host, remote_run_data, launch = outcome
+            result.update(_submit_result(prepared, remote_run_data, host, launch))
+
+        manager.resolve(job, complete)
+
+    manager.defer(job)
+    coalescer.submit(prepared.rerun_group_id, prepared, launch_group, launched)
+    return result
+
+
+async def submit_prepared_async(prepared):
+    """Submit a prepared rerun without blocking, see submit_prepared."""
+    coalescer = get_coalescer()
+    if coalescer is None:
+        return await submit_with_failover_async(prepared)
+    with stage("coalesce"):
+        host, remote_run_data, launch = await coalescer.submit_async(
+            prepared.rerun_group_id, prepared, launch_coalesced_async
+        )
+    return await _submit_result_async(prepared, remote_run_data, host, launch)
+
+
 def conduct_reanalysis(case_id, **kwargs):
     """Setup and start a reanalysis."""
     LOG.info(f"Recieved request; case id: {case_id}; {kwargs}")
-    # create a new group id for the rerun
-    rerun_group_id = build_new_case_id(case_id)
-    pedigree = create_new_pedigree(case_id, rerun_group_id, kwargs.get("sample_ids", []), kwargs.get("body", []))
+    # fetch case once for building both pedigree and run data
+    with stage("fetch_case", {"case_id": case_id}):
+        case = query_case(case_id)
+    prepared = prepare_rerun_cached(
+        case_id, kwargs.get("sample_ids", []), kwargs.get("body", []), case=case
+    )
+    if skip_noop(prepared):
+        return noop_result(prepared)
+    return submit_prepared(prepared)
 
-    cnf = app.config
-    # write files to temporary directory
-    with TemporaryDirectory(prefix=case_id) as tmp_dir:
-        date = datetime.datetime.now().strftime("%y%m%d_%H%M%S")
-        directory = Path(tmp_dir)
-        base_fname = f"{case_id}_{date}_rescore"
-
-
-        # write run data to csv format
-        run_data_path = directory / f"{base_fname}.csv"
-        with open(run_data_path, "w") as out:
-            LOG.info(f"Writing rundata to {run_data_path}")
-            run_data = create_rundata(case_id, rerun_group_id)
-            cwriter = csv.DictWriter(out, fieldnames=list(run_data[0].keys()))
-            cwriter.writeheader()
-            for row in run_data:
-                cwriter.writerow(row)
-
-        # write pedigree file
-        ped_path = directory / f"{base_fname}.ped"
-        LOG.info(f"Writing pedigree to {ped_path}")
-        with open(ped_path, "w") as out:
-            pedigree.to_ped(out, write_header=False)
-        # set up ssh options and connect to remote
-        kwargs = {
-            "passphrase": cnf.get("SSH_PASSPHRASE"),
-            "key_filename": [cnf.get("SSH_KEY_FILENAME")],
-        }
-        if (
-            any(fname is None for fname in kwargs["key_filename"])
-            and os.environ.get("SSH_AGENT_PID") is None
-        ):
-            raise SSHKeyException("No SSH key specified.")
-
-        # setup connection
-        host = cnf["WORKFLOW_HOST"]
-        user = cnf["WORKFLOW_USER"]
-        LOG.info(f"Connecting to remote: {user}@{host}")
-        with Connection(host=host, user=user, connect_kwargs=kwargs) as conn:
-            # transfer files
-            remote_data = cnf["WORKFLOW_DATA_DIR"]
-            LOG.debug(f"SCP {run_data_path.absolute()} {remote_data}")
-            conn.put(str(run_data_path.absolute()), remote=remote_data)
-            conn.put(str(ped_path.absolute()), remote=remote_data)
-            run_rescore(conn, Path(remote_data).joinpath(run_data_path.name))  # start rerun
-
-
-def rerun_wrapper(case_id, **kwargs):
-    """API entrypoint wrapper with return code."""
+
+async def conduct_reanalysis_async(case_id, **kwargs):
+    """Setup and start a reanalysis without blocking the event loop."""
+    LOG.info(f"Recieved request; case id: {case_id}; {kwargs}")
+    with stage("fetch_case", {"case_id": case_id}):
+        case = await query_case_async(case_id)
+    prepared = prepare_rerun_cached(
+        case_id, kwargs.get("sample_ids", []), kwargs.get("body", []), case=case
+    )
+    if skip_noop(prepared):
+        return noop_result(prepared)
+    return await submit_prepared_async(prepared)
+
+
+def _prepare_batch(reruns, cases, results):
+    """Prepare the reruns of a batch, returns the index and prepared rerun to submit."""
+    prepared = {}
+    for idx, rerun in enumerate(reruns):
+        case_id = rerun["case_id"]
+        try:
+            if case_id not in cases:
+                raise CaseNotFoundError(f'Case "{case_id}" not found in database')
+            prep = prepare_rerun_cached(
+                case_id, rerun.get("sample_ids", []), rerun.get("body", []), case=cases[case_id]
+            )
+            if skip_noop(prep):
+                results[idx].update(noop_result(prep), state=DONE)
+            else:
+                prepared[idx] = prep
+        except Exception as err:
+            _set_failed(results[idx], err)
+    return prepared
+
+
+def conduct_batch_reanalysis(case_ids, reruns):
+    """Setup and start reanalysis of many cases.
+
+    All cases are fetched in one query and all files are transfered over one
+    connection to the least loaded host. If the connection or a rescoring
+    fails the remaining reruns are submitted to the next host. Errors are
+    reported per case. With WORKFLOW_COALESCE_WINDOW the reruns are started
+    with one launch.
+    """
+    LOG.info(f"Recieved batch request of {len(reruns)} reruns")
+    with stage("fetch_cases"):
+        cases = query_cases(case_ids)
+
+    results = [{"case_id": rerun["case_id"]} for rerun in reruns]
+    pending = _prepare_batch(reruns, cases, results)
+    if not pending:
+        return results
     try:
-        conduct_reanalysis(case_id, **kwargs)
-    except (
-        CaseNotFoundError,
-        IndividualIdNotFoundError,
-    ) as err:  # if case_id was not in database
-        return str(err), 404
-    except PipelineExecutionError as err:  # Pipeline execution crashed
-        msg = f"{type(err).__name__} - {str(err)}"
-        LOG.error(msg)
+        connect_kwargs = get_connect_kwargs()
+    except SSHKeyException as err:
+        for idx in pending:
+            _set_failed(results[idx], err)
+        return results
+
+    router = get_router()
+    candidates = router.candidates()
+    error = None
+    for workflow_host in candidates:
+        host = workflow_host.host
+        last = workflow_host is candidates[-1]
+        try:
+            with host_breaker(workflow_host).guard(CONNECT_ERRORS), get_host_limiter().slot(
+                host
+            ), get_pool().connection(host, workflow_host.user, connect_kwargs) as conn:
+                if get_coalescer() is not None:
+                    # start reruns with one launch, repeated rerun groups are started on their own
+                    first = {}
+                    for idx, prep in pending.items():
+                        first.setdefault(prep.rerun_group_id, idx)
+                    group = list(first.values())
+                    try:
+                        outcomes = submit_coalesced(conn, [pending[idx] for idx in group])
+                    except Exception as err:
+                        if is_failover_error(err) and not last:
+                            raise
+                        outcomes = [err] * len(group)
+                    for idx, outcome in zip(group, outcomes):
+                        if isinstance(outcome, Exception):
+                            _set_failed(results[idx], outcome)
+                        else:
+                            launched_host, remote_run_data, launch = outcome
+                            results[idx].update(
+                                _submit_result(pending[idx], remote_run_data, launched_host, launch)
+                            )
+                            results[idx]["state"] = DONE
+                        del pending[idx]
+                preflight(conn, list(pending.values()))  # check all input files at once
+                for idx, prep in list(pending.items()):
+                    try:
+                        results[idx].update(submit_rerun(conn, prep))
+                        results[idx]["state"] = DONE
+                    except Exception as err:
+                        if is_failover_error(err) and not last:
+                            raise
+                        _set_failed(results[idx], err)
+                    del pending[idx]
+        except Exception as err:  # submit remaining reruns to the next host
+            if not is_failover_error(err):
+                raise
+            LOG.warning(f"Submitting to {host} failed, {len(pending)} reruns left: {err}")
+            router.record_failure(host, err)
+            error = err
+            continue
+        router.record_success(host)
+        break
+    for idx in pending:  # all hosts failed
+        _set_failed(results[idx], error)
+    return results
+
+
+async def conduct_batch_reanalysis_async(case_ids, reruns):
+    """Setup and start reanalysis of many cases concurrently."""
+    LOG.info(f"Recieved batch request of {len(reruns)} reruns")
+    with stage("fetch_cases"):
+        cases = await query_cases_async(case_ids)
+
+    results = [{"case_id": rerun["case_id"]} for rerun in reruns]
+    prepared = _prepare_batch(reruns, cases, results)
+    if prepared and get_preflight_cache() is not None:
+        # check all input files at once, the reruns find the result in the cache
+        workflow_host = get_router().candidates()[0]
+        try:
+            async with get_async_pool().connection(
+                workflow_host.host, workflow_host.user, get_connect_kwargs()
+            ) as conn:
+                await preflight_async(conn, list(prepared.values()))
+        except Exception as err:
+            LOG.warning(f"Preflight of batch on {workflow_host.host} failed: {err}")
+
+    async def submit(idx, prep):
+        try:
+            results[idx].update(await submit_prepared_async(prep))
+            results[idx]["state"] = DONE
+        except Exception as err:
+            _set_failed(results[idx], err)
+
+    await asyncio.gather(*(submit(idx, prep) for idx, prep in prepared.items()))
+    return results
+
+
+def _set_failed(result, err):
+    """Record an error in the result of a batch rerun."""
+    result["state"] = FAILED
+    result["error"], result["status_code"] = error_response(err)
+
+
+def error_response(err):
+    """Translate an error of a rerun into a message and status code."""
+    ERRORS.inc(type(err).__name__)
+    if isinstance(err, (CaseNotFoundError, IndividualIdNotFoundError)):
+        return str(err), 404  # if case_id was not in database
+    if isinstance(err, MissingInputFilesError):  # stale paths in the database
+        return str(err), 422
+    msg = f"{type(err).__name__} - {str(err)}"
+    LOG.error(msg)
+    if isinstance(err, LaunchUnknownError):  # the rerun may be running
+        msg = "The connection to the remote server was lost, the rerun may be running, please contact administrator"
+        return msg, 500
+    if isinstance(err, PipelineExecutionError):  # Pipeline execution crashed
         msg = "There was an error when executing the pipeline, please contact administrator"
         return msg, 500
-    except SSHKeyException as err:  # Credentials error
-        msg = f"{type(err).__name__} - {str(err)}"
-        LOG.error(msg)
+    if isinstance(err, SSHKeyException):  # Credentials error
         msg = "There was an error with the connection to the remote server, please contact administrator"
         return msg, 500
-    except Exception as err:  # generic data
-        # clean up data
-        msg = f"{type(err).__name__} - {str(err)}"
-        LOG.error(msg)
-        return msg, 500  # fail
+    if isinstance(err, ConnectionPoolTimeout):  # all connections to remote are busy
+        return "The remote server is busy, please try again later", 503
+    if isinstance(err, CircuitOpenError):  # database or remote known to be down
+        return "A required service is unavailable, please try again later", 503
+    return msg, 500  # generic error
+
+
+def request_hash(case_id, sample_ids=[], body=[]):
+    """Hash a rerun request independent of sample and key order."""
+    normalized = {
+        "case_id": case_id,
+        "sample_ids": sorted(set(sample_ids or [])),
+        "body": sorted(
+            ({key: str(val) for key, val in mod_data.items()} for mod_data in body or []),
+            key=lambda mod_data: mod_data.get("sample_id", ""),
+        ),
+    }
+    return hashlib.sha256(json.dumps(normalized, sort_keys=True).encode()).hexdigest()
+
+
+def _dedup_keys(*request_hashes):
+    """Keys identifying duplicates of the current request, the first is its content."""
+    keys = [f"request:{'|'.join(request_hashes)}"]
+    idempotency_key = request.headers.get("Idempotency-Key")
+    if idempotency_key:
+        keys.append(f"idempotency:{idempotency_key}")
+    return keys
+
+
+def _queued_response(job, created):
+    """Response of a queued job, duplicated requests get the existing job."""
+    headers = {"Location": _status_url(job)}
+    if not created:
+        return job.to_json(), 200, headers
+    return job.to_json(), 202, headers
+
+
+def _is_async():
+    """Check if reruns are run as coroutines."""
+    return isinstance(get_job_manager(), AsyncJobManager)
+
+
+def _priority(name=None):
+    """Get the queue priority of a rerun by name, the default if None."""
+    if name is None:
+        name = app.config.get("RERUN_DEFAULT_PRIORITY", "clinical")
+    return RERUN_PRIORITIES[name]
+
+
+def _queue_full_response(err):
+    """Response when too many reruns are waiting, the client should retry later."""
+    LOG.warning(str(err))
+    headers = {"Retry-After": str(app.config.get("RERUN_RETRY_AFTER", 30))}
+    return "Too many reruns are waiting, please try again later", 429, headers
+
+
+def _conflict_response(err):
+    """Response when an idempotency key is reused for a different request."""
+    LOG.warning(str(err))
+    return "The Idempotency-Key was already used for a different request", 422
+
+
+def _unavailable_response():
+    """Response while the database or all workflow hosts are down, None if they are up."""
+    breakers = [database_breaker()]
+    host_breakers = [host_breaker(workflow_host) for workflow_host in workflow_hosts()]
+    if all(breaker.state == OPEN for breaker in host_breakers):
+        breakers.extend(host_breakers)
+    down = [breaker for breaker in breakers if breaker.state == OPEN]
+    if not down:
+        return None
+    names = ", ".join(breaker.name for breaker in down)
+    LOG.warning(f"Rejecting rerun, unavailable: {names}")
+    headers = {"Retry-After": str(max(breaker.reset_timeout for breaker in down))}
+    return f"Unavailable: {names}, please try again later", 503, headers
+
+
+def rerun_preview(case_id, **kwargs):
+    """API entrypoint for the pedigree and run data files of a rerun without starting it.
+
+    The prepared files are cached by the hash of the request and reused
+    when the same rerun is submitted within RERUN_PREVIEW_TTL seconds.
+    """
+    sample_ids, body = kwargs.get("sample_ids", []), kwargs.get("body", [])
+    try:
+        case = query_case(case_id)
+        prepared = prepare_rerun(case_id, sample_ids, body, case=case)
+    except (NoSampleIdError, ValueError) as err:
+        return str(err), 400
+    except Exception as err:
+        return error_response(err)
+    key = request_hash(case_id, sample_ids, body)
+    cache = get_preview_cache()
+    if cache is not None:
+        cache.set(key, (_case_digest(case), prepared))
+    return {
+        "request_hash": key,
+        "rerun_group_id": prepared.rerun_group_id,
+        "noop": prepared.is_noop,
+        "changes": prepared.changes,
+        "pedigree": prepared.pedigree,
+        "run_data": prepared.run_data,
+        "input_files": list(prepared.input_files),
+    }, 200
+
+
+def rerun_wrapper(case_id, priority=None, **kwargs):
+    """API entrypoint that queues a rerun.
+
+    Duplicates of a recently submitted request get the existing rerun.
+    Reruns are rejected while the database or the workflow hosts are down.
+    """
+    unavailable = _unavailable_response()
+    if unavailable is not None:
+        return unavailable
+    keys = _dedup_keys(request_hash(case_id, kwargs.get("sample_ids"), kwargs.get("body")))
+    func = conduct_reanalysis_async if _is_async() else conduct_reanalysis
+    trace_id, parent_span_id = _trace_context()
+    try:
+        job, created = get_job_manager().submit_once(
+            func,
+            case_id,
+            keys,
+            priority=_priority(priority),
+            trace_id=trace_id,
+            parent_span_id=parent_span_id,
+            fingerprint=keys[0],
+            **kwargs,
+        )
+    except QueueFullError as err:
+        return _queue_full_response(err)
+    except IdempotencyKeyConflict as err:
+        return _conflict_response(err)
+    return _queued_response(job, created)
+
+
+def _trace_context():
+    """Trace id of a new rerun and the span of the caller.
+
+    Reruns join the trace of a W3C traceparent header, otherwise a new trace
+    is started.
+    """
+    context = parse_traceparent(request.headers.get("traceparent"))
+    if context is None:
+        return new_trace_id(), None
+    return context
+
+
+def _status_url(job):
+    """Url of the status of a rerun job."""
+    api_root = request.base_url.rsplit("/rerun", 1)[0]
+    return f"{api_root}/rerun/{job.id}"
+
+
+def batch_rerun_wrapper(body, priority=None):
+    """API entrypoint that queues reruns of many cases as one job."""
+    unavailable = _unavailable_response()
+    if unavailable is not None:
+        return unavailable
+    case_ids = list(dict.fromkeys(rerun["case_id"] for rerun in body))
+    keys = _dedup_keys(
+        *(
+            request_hash(rerun["case_id"], rerun.get("sample_ids"), rerun.get("body"))
+            for rerun in body
+        )
+    )
+    func = conduct_batch_reanalysis_async if _is_async() else conduct_batch_reanalysis
+    trace_id, parent_span_id = _trace_context()
+    try:
+        job, created = get_job_manager().submit_once(
+            func,
+            case_ids,
+            keys,
+            priority=_priority(priority),
+            trace_id=trace_id,
+            parent_span_id=parent_span_id,
+            fingerprint=keys[0],
+            reruns=body,
+        )
+    except QueueFullError as err:
+        return _queue_full_response(err)
+    except IdempotencyKeyConflict as err:
+        return _conflict_response(err)
+    return _queued_response(job, created)
+
+
+def _stored_job_json(row):
+    """Summarize a stored job like Job.to_json."""
+    keys = ["case_id", "state", "submitted", "started", "finished", "stages", "result"]
+    keys += ["error", "status_code", "priority"]
+    return {"job_id": row["id"], **{key: row[key] for key in keys}}
 
-    return 204
 
+def rerun_status(job_id):
+    """API entrypoint for getting the status of a rerun.
 
-def run_rescore(connection, run_data_path):
-    """Run the rescore nextflow analysis."""
+    Jobs forgotten by the job manager are looked up in the job store.
+    """
+    job = get_job_manager().get(job_id)
+    if job is not None:
+        return job.to_json(), 200
+    store = get_job_store()
+    row = None if store is None else store.get_job(job_id)
+    if row is None:
+        return f'Rerun "{job_id}" not found', 404
+    return _stored_job_json(row), 200
+
+
+def rerun_history(case_id=None, since=None, until=None, limit=100):
+    """API entrypoint for the submitted reruns recorded in the job store."""
+    store = get_job_store()
+    if store is None:
+        return "The job store is disabled", 404
+    since, until = (
+        None if date is None else datetime.datetime.combine(date, datetime.time()).timestamp()
+        for date in (_parse_date(since), _parse_date(until))
+    )
+    reruns = store.list_reruns(case_id=case_id, since=since, until=until, limit=limit)
+    for rerun in reruns:
+        rerun["created"] = datetime.datetime.fromtimestamp(rerun["created"]).isoformat()
+    return reruns, 200
+
+
+def _parse_date(date):
+    """Parse an iso formated date, None is passed through."""
+    if date is None or isinstance(date, datetime.date):
+        return date
+    return datetime.date.fromisoformat(date)
+
+
+def list_reruns(case_id=None, state=None):
+    """API entrypoint for listing reruns."""
+    jobs = get_job_manager().list(case_id=case_id, state=state)
+    return [job.to_json() for job in jobs], 200
+
+
+def queue_status():
+    """API entrypoint for the depth of the queue, submissions and load per host."""
+    stats = get_job_manager().queue_stats()
+    names = {value: name for name, value in RERUN_PRIORITIES.items()}
+    stats["by_priority"] = {
+        names.get(priority, str(priority)): count
+        for priority, count in stats["by_priority"].items()
+    }
+    stats["hosts"] = get_host_limiter().stats()
+    stats["workflow_hosts"] = get_router().stats()
+    coalescer = get_coalescer()
+    if coalescer is not None:
+        stats["coalesced"] = coalescer.stats()
+    return stats, 200
+
+
+def health():
+    """API entrypoint for the state of the circuit breakers of the dependencies.
+
+    The service is down if the database or all workflow hosts are down and
+    degraded if some workflow hosts are down.
+    """
+    database_breaker()
+    for workflow_host in workflow_hosts():
+        host_breaker(workflow_host)
+    breakers = app.config["CIRCUIT_BREAKERS"].stats()
+    status = "ok"
+    if any(breaker["state"] == OPEN for breaker in breakers.values()):
+        status = "degraded"
+    if _unavailable_response() is not None:
+        status = "down"
+    return {"status": status, "breakers": breakers}, 503 if status == "down" else 200
+
+
+PEDIGREE_MIMETYPES = {"ped": "text/tab-separated-values", "ndjson": "application/x-ndjson"}
+
+
+def pedigree_export(case_id=None, owner=None, status=None, format="ped"):
+    """API entrypoint for streaming the pedigrees of many cases.
+
+    Cases are selected by id or by owner and status and serialized as they
+    are read from the database, in batches of PEDIGREE_EXPORT_BATCH_SIZE.
+    """
+    query = {}
+    if case_id:
+        query["_id"] = {"$in": case_id}
+    if owner is not None:
+        query["owner"] = owner
+    if status is not None:
+        query["status"] = status
+    if not query:
+        return "Give case ids, an owner or a status of the cases to export", 400
+    batch_size = app.config.get("PEDIGREE_EXPORT_BATCH_SIZE", 100)
+    try:
+        cases = iter_cases(query, projection={"individuals": 1}, batch_size=batch_size)
+    except CircuitOpenError as err:
+        msg, code = error_response(err)
+        return msg, code, {"Retry-After": str(err.retry_after)}
+    chunks = export_pedigrees(cases, output_format=format, batch_size=batch_size)
+    return Response(stream_with_context(chunks), mimetype=PEDIGREE_MIMETYPES[format])
+
+
+def init_preview_cache():
+    """Initialize cache of previewed reruns from flask, disabled if RERUN_PREVIEW_TTL is 0."""
+    cnf = app.config
+    ttl = cnf.get("RERUN_PREVIEW_TTL", 300)
+    size = cnf.get("RERUN_PREVIEW_CACHE_SIZE", 256)
+    cnf["PREVIEW_CACHE"] = CaseCache(max_size=size, ttl=ttl) if ttl and size else None
+
+
+def get_preview_cache():
+    """Get the cache of previewed reruns, None if disabled."""
+    return app.config.get("PREVIEW_CACHE")
+
+
+def cache_stats():
+    """API entrypoint for usage statistics of the case cache."""
+    cache = app.config.get("CASE_CACHE")
+    if cache is None:
+        return "The case cache is disabled", 404
+    return cache.stats(), 200
+
+
+def _rescore_cmd(host, run_data_path, files=None, detached=False, cached=None):
+    """Build the remote command of a rescoring, returns the command and remote command.
+
+    Files with a digest in cached are linked from the upload cache.
+    """
     cmd = " ".join(
         [
-            app.config["WORKFLOW_EXEC_SCRIPT"],
+            get_workflow_host(host).exec_script,
             str(run_data_path.absolute()),  # csv file path
         ]
     )
-    LOG.info(f"Executing cmd on {connection.host}: {cmd}")
-    resp = connection.run(cmd, warn=True)
+    log_prefix = str(run_data_path.absolute().with_suffix(""))
+    remote_cmd = detached_cmd(cmd, log_prefix) if detached else cmd
+    if files is not None:
+        remote_cmd = "\n".join([upload_cmd(host, files, cached), remote_cmd])
+    return cmd, remote_cmd
+
+
+def _exec_attributes(connection, cmd, files=None):
+    """Span attributes of a remote command, files are written by the same command."""
+    return {
+        "net.peer.name": connection.host,
+        "command": cmd,
+        "files": None if files is None else len(files),
+    }
+
+
+def _rescore_launch(connection, run_data_path, cmd, resp, detached):
+    """Check the outcome of starting a rescoring, returns a RemoteLaunch if detached."""
     LOG.debug(f"Run output: {resp.stdout.strip()}")
     if resp.failed:
         raise PipelineExecutionError(
@@ -154,3 +1074,74 @@ def run_rescore(connection, run_data_path):
                 "stderr": resp.stderr.strip(),
             }
         )
+    if detached:
+        log_prefix = str(run_data_path.absolute().with_suffix(""))
+        return RemoteLaunch(
+            host=connection.host,
+            user=connection.user,
+            cmd=cmd,
+            pid=int(resp.stdout.strip().splitlines()[-1]),
+            stdout_path=f"{log_prefix}.out",
+            stderr_path=f"{log_prefix}.err",
+            exit_path=f"{log_prefix}.exit",
+        )
+
+
+@contextmanager
+def _launching(connection, cmd):
+    """Raise a LaunchUnknownError if the connection is lost once the rescoring command was sent."""
+    try:
+        yield
+    except transport_errors() as err:
+        raise LaunchUnknownError(
+            {"cmd": cmd, "host": connection.host, "error": f"{type(err).__name__} - {err}"}
+        ) from err
+
+
+def run_rescore(connection, run_data_path, files=None, detached=False):
+    """Run the rescore nextflow analysis.
+
+    A connection to the least loaded host is borrowed from the pool if none
+    is given. Files, a mapping of remote paths to contents, are written by
+    the same remote command before the analysis is started. A detached
+    analysis is started in the background and a RemoteLaunch is returned
+    without waiting for it.
+    """
+    if connection is None:
+        workflow_host = get_router().candidates()[0]
+        with get_pool().connection(
+            workflow_host.host, workflow_host.user, get_connect_kwargs()
+        ) as conn:
+            return run_rescore(conn, run_data_path, files=files, detached=detached)
+
+    cached = None if files is None else prepare_upload(connection, files)
+    cmd, remote_cmd = _rescore_cmd(connection.host, run_data_path, files, detached, cached)
+    LOG.info(f"Executing cmd on {connection.host}: {cmd}")
+    with span("remote_exec", _exec_attributes(connection, cmd, files)), _launching(connection, cmd):
+        resp = connection.run(remote_cmd, warn=True)
+    if not finish_upload(connection, files, cached, resp):
+        remote_cmd = _rescore_cmd(connection.host, run_data_path, files, detached, cached=set())[1]
+        with span("remote_exec", _exec_attributes(connection, cmd, files)), _launching(
+            connection, cmd
+        ):
+            resp = connection.run(remote_cmd, warn=True)
+    return _rescore_launch(connection, run_data_path, cmd, resp, detached)
+
+
+async def run_rescore_async(connection, run_data_path, files=None, detached=False):
+    """Run the rescore nextflow analysis over an asynchronous connection.
+
+    See run_rescore.
+    """
+    cached = None if files is None else await prepare_upload_async(connection, files)
+    cmd, remote_cmd = _rescore_cmd(connection.host, run_data_path, files, detached, cached)
+    LOG.info(f"Executing cmd on {connection.host}: {cmd}")
+    with span("remote_exec", _exec_attributes(connection, cmd, files)), _launching(connection, cmd):
+        resp = await connection.run(remote_cmd)
+    if not finish_upload(connection, files, cached, resp):
+        remote_cmd = _rescore_cmd(connection.host, run_data_path, files, detached, cached=set())[1]
+        with span("remote_exec", _exec_attributes(connection, cmd, files)), _launching(
+            connection, cmd
+        ):
+            resp = await connection.run(remote_cmd)
+    return _rescore_launch(connection, run_data_path, cmd, resp, detached)
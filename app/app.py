@@ -8,24 +8,39 @@ import connexion
 import yaml
 from flask import Flask, current_app
 from flask.cli import current_app, with_appcontext
-from pymongo import MongoClient
-from pymongo.errors import ConnectionFailure, ServerSelectionTimeoutError
 
 from .__version__ import __version__ as version
+from .api import error_response, init_preview_cache
+from .breaker import init_breakers
+from .coalesce import init_coalescer
+from .db import init_case_cache
+from .hosts import init_router
+from .jobs import get_job_manager, init_jobs
+from .metrics import REGISTRY, init_metrics
+from .preflight import init_preflight
+from .scheduler import init_scheduler
+from .store import init_store
+from .tracing import init_tracer
+from .tracking import init_tracker
+from .uploads import init_upload_index
 
 dictConfig(
     {
         "version": 1,
+        # the loggers of the app modules are created before logging is configured
+        "disable_existing_loggers": False,
         "formatters": {
             "default": {
-                "format": "[%(asctime)s] %(levelname)s in %(module)s: %(message)s",
+                "format": "[%(asctime)s] %(levelname)s in %(module)s [%(trace_id)s]: %(message)s",
             }
         },
+        "filters": {"trace_id": {"()": "app.tracing.TraceIdFilter"}},
         "handlers": {
             "wsgi": {
                 "class": "logging.StreamHandler",
                 "stream": "ext://flask.logging.wsgi_errors_stream",
                 "formatter": "default",
+                "filters": ["trace_id"],
             }
         },
         "root": {"level": "INFO", "handlers": ["wsgi"]},
@@ -34,63 +49,78 @@ dictConfig(
 
 LOG = logging.getLogger(__name__)
 
+SPEC_PATH = Path(__file__).parent / "openapi" / "openapi.yaml"
+YAML_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
 
-def create_app(test_config=None):
-    """Create and configure app."""
-    logging.basicConfig(level=logging.DEBUG)
 
-    app = connexion.App(__name__, specification_dir="openapi", options={"swagger_ui": True})
-    app.add_api("openapi.yaml")
+def create_app(test_config=None, config_path=None):
+    """Create and configure app.
 
-    application = app.app
+    Connections to the database and the remote are opened on first use in
+    each process, the app can be created before gunicorn forks its workers.
+    """
+    logging.basicConfig(level=logging.DEBUG)
 
-    # set pymongo config
+    app = connexion.App(__name__, specification_dir="openapi")
+    application = app.app
 
     with application.app_context():
         if test_config:
             application.config.from_object(test_config)
         else:
-            load_config("config.yml")
-        init_db()
+            load_config(config_path)
+        init_breakers()
+        init_case_cache()
+        init_preview_cache()
+        init_store()
+        init_tracer()
+        init_jobs(error_handler=error_response)
+        init_scheduler()
+        init_router()
+        init_tracker(error_handler=error_response)
+        init_upload_index()
+        init_preflight()
+        init_coalescer()
+        init_metrics()
+
+    swagger_ui = application.config.get("SWAGGER_UI", False)
+    app.add_api(load_spec(SPEC_PATH), options={"swagger_ui": swagger_ui})
+
+    @application.before_request
+    def start_recovery():
+        # on the first request of each worker, a preloaded app is loaded before the fork
+        get_job_manager().start()
 
     @app.route("/")
     def about():
         return f"PEDmaker version: {version}"
 
-    return application
+    @app.route("/metrics")
+    def metrics():
+        return REGISTRY.render(), 200, {"Content-Type": "text/plain; version=0.0.4"}
 
+    return application
 
-def init_db():
-    """Initialize from flask"""
-    db_name = current_app.config.get("MONGO_DBNAME", "scout")
 
-    host = current_app.config.get("MONGO_HOST", "localhost")
-    port = current_app.config.get("MONGO_PORT", 27017)
-    LOG.info(f"Try to connect to database {db_name} at {host}:{port}")
-    try:
-        client = MongoClient(
-            host=host,
-            port=port,
-            username=current_app.config.get("MONGO_USERNAME", None),
-            password=current_app.config.get("MONGO_PASSWORD", None),
-            serverSelectionTimeoutMS=current_app.config.get("MONGO_TIMEOUT", 60),
-        )
-    except ServerSelectionTimeoutError as err:
-        LOG.warning("Connection Refused")
-        raise ConnectionFailure
+def load_spec(path):
+    """Load the OpenAPI specification with the C parser of libyaml if available.
 
-    LOG.info("Connection established")
+    It is validated by connexion when the api is added.
+    """
+    with open(path) as inpt:
+        return yaml.load(inpt, Loader=YAML_LOADER)
 
-    current_app.config["MONGO_DATABASE"] = client[db_name]
-    current_app.config["MONGO_CLIENT"] = client
 
+def load_config(path=None):
+    """Load app config.
 
-def load_config(path):
-    """Load app config."""
-    config_file = "config.yml"
+    The config file is given by path, the variable RERUNNER_CONFIG or
+    config.yml in the current directory.
+    """
+    config_file = path or os.environ.get("RERUNNER_CONFIG", "config.yml")
     LOG.info(f"Load configurations from file: {config_file}")
     with open(config_file) as inpt:
-        current_app.config.from_mapping(yaml.safe_load(inpt))
+        current_app.config.from_mapping(yaml.load(inpt, Loader=YAML_LOADER))
 
     LOG.info("Load configurations from environment variables")
     # get remote authentication information, assumes SSH key setup
@@ -0,0 +1,197 @@
+"""Retries with backoff and circuit breakers around the database and the remote."""
+import asyncio
+import logging
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import current_app
+
+from .exceptions import CircuitOpenError
+
+LOG = logging.getLogger(__name__)
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+
+def backoff_delays(retries, backoff=0.5, max_backoff=10):
+    """Delays before each retry, doubling with full jitter."""
+    for attempt in range(retries):
+        yield random.uniform(0, min(max_backoff, backoff * 2 ** attempt))
+
+
+def retry(func, errors, retries=2, backoff=0.5, max_backoff=10, name="Call"):
+    """Call func, retrying on errors with exponential backoff."""
+    for delay in backoff_delays(retries, backoff, max_backoff):
+        try:
+            return func()
+        except errors as err:
+            LOG.warning(f"{name} failed, retrying in {delay:.2f}s: {err}")
+            time.sleep(delay)
+    return func()
+
+
+async def retry_async(func, errors, retries=2, backoff=0.5, max_backoff=10, name="Call"):
+    """Await func, retrying on errors with exponential backoff without blocking."""
+    for delay in backoff_delays(retries, backoff, max_backoff):
+        try:
+            return await func()
+        except errors as err:
+            LOG.warning(f"{name} failed, retrying in {delay:.2f}s: {err}")
+            await asyncio.sleep(delay)
+    return await func()
+
+
+class CircuitBreaker(object):
+    """Fail fast while a dependency is down.
+
+    The breaker opens after failure_threshold consecutive failures and calls
+    are rejected with CircuitOpenError. While open the dependency is probed
+    in the background every reset_timeout seconds, the breaker closes when
+    a probe succeeds. Without a probe a single call is let through after
+    reset_timeout seconds.
+    """
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30, probe=None, app=None):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.probe = probe
+        self.app = app
+        self.state = CLOSED
+        self.failures = 0
+        self.opened = None
+        self.last_error = None
+        self._lock = threading.Lock()
+        self._prober_pid = None
+
+    def before_call(self):
+        """Raise CircuitOpenError if the breaker is open."""
+        with self._lock:
+            if self.state == CLOSED:
+                return
+            if self.state == OPEN and self.probe is None:
+                if time.monotonic() - self.opened >= self.reset_timeout:
+                    self.state = HALF_OPEN  # let one call through
+                    return
+            retry_after = max(0, round(self.opened + self.reset_timeout - time.monotonic()))
+        raise CircuitOpenError(f"{self.name} is unavailable: {self.last_error}", retry_after)
+
+    def record_success(self):
+        """Close the breaker."""
+        with self._lock:
+            if self.state != CLOSED:
+                LOG.info(f"Circuit breaker {self.name} closed")
+            self.state, self.failures, self.last_error = CLOSED, 0, None
+
+    def record_failure(self, err):
+        """Count a failure, open the breaker when the threshold is reached."""
+        with self._lock:
+            self.failures += 1
+            self.last_error = f"{type(err).__name__} - {err}"
+            if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != OPEN:
+                    LOG.warning(f"Circuit breaker {self.name} opened: {self.last_error}")
+                self.state, self.opened = OPEN, time.monotonic()
+                self._start_prober()
+
+    @contextmanager
+    def guard(self, errors=(Exception,)):
+        """Fail fast if open and count errors raised in the with block as failures.
+
+        Other errors show that the dependency responded and count as successes.
+        """
+        self.before_call()
+        try:
+            yield
+        except errors as err:
+            self.record_failure(err)
+            raise
+        except Exception:
+            self.record_success()
+            raise
+        self.record_success()
+
+    def _start_prober(self):
+        """Probe the dependency in the background until it is up, the lock must be held."""
+        if self.probe is None or self._prober_pid == os.getpid():
+            return
+        self._prober_pid = os.getpid()
+        threading.Thread(target=self._probe_forever, name=f"probe-{self.name}", daemon=True).start()
+
+    def _probe_forever(self):
+        """Call the probe every reset_timeout seconds until it succeeds."""
+        while True:
+            time.sleep(self.reset_timeout)
+            try:
+                if self.app is None:
+                    self.probe()
+                else:
+                    with self.app.app_context():
+                        self.probe()
+            except Exception as err:
+                LOG.debug(f"Probe of {self.name} failed: {err}")
+                with self._lock:
+                    self.opened = time.monotonic()
+                    self.last_error = f"{type(err).__name__} - {err}"
+                continue
+            with self._lock:
+                self._prober_pid = None
+            self.record_success()
+            return
+
+    def to_json(self):
+        """Summarize state of the breaker."""
+        return {
+            "state": self.state,
+            "failures": self.failures,
+            "error": self.last_error,
+        }
+
+
+class BreakerRegistry(object):
+    """Circuit breakers of the dependencies, created on first use."""
+
+    def __init__(self, app, failure_threshold=5, reset_timeout=30):
+        self.app = app
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._breakers = {}
+        self._lock = threading.Lock()
+
+    def get(self, name, probe=None):
+        """Get the breaker of a dependency, probe is used when it is created."""
+        with self._lock:
+            breaker = self._breakers.get(name)
+            if breaker is None:
+                breaker = self._breakers[name] = CircuitBreaker(
+                    name,
+                    failure_threshold=self.failure_threshold,
+                    reset_timeout=self.reset_timeout,
+                    probe=probe,
+                    app=self.app,
+                )
+            return breaker
+
+    def stats(self):
+        """Summarize the state of all breakers."""
+        with self._lock:
+            breakers = dict(self._breakers)
+        return {name: breaker.to_json() for name, breaker in sorted(breakers.items())}
+
+
+def init_breakers():
+    """Initialize circuit breakers from flask."""
+    cnf = current_app.config
+    cnf["CIRCUIT_BREAKERS"] = BreakerRegistry(
+        current_app._get_current_object(),
+        failure_threshold=cnf.get("BREAKER_FAILURE_THRESHOLD", 5),
+        reset_timeout=cnf.get("BREAKER_RESET_TIMEOUT", 30),
+    )
+
+
+def get_breaker(name, probe=None):
+    """Get the circuit breaker of a dependency."""
+    return current_app.config["CIRCUIT_BREAKERS"].get(name, probe)
@@ -0,0 +1,140 @@
+"""In-process caching of case documents."""
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from pymongo.errors import OperationFailure, PyMongoError
+
+LOG = logging.getLogger(__name__)
+
+# error code of mongod when change streams are not supported, ie not a replica set
+CHANGE_STREAM_NOT_SUPPORTED = 40573
+
+
+class CaseCache(object):
+    """Thread safe LRU cache where entries expire after ttl seconds.
+
+    Cached documents are shared between callers and must not be modified.
+    """
+
+    def __init__(self, max_size=256, ttl=300):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._entries = OrderedDict()  # key -> (expiry time, value)
+        self._lock = threading.Lock()
+        self._watcher = None
+
+    def get(self, key):
+        """Get an entry, returns None if it is missing or expired."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] < time.monotonic():
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        """Add entry and evict the least recently used if the cache is full."""
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        """Remove an entry."""
+        with self._lock:
+            if self._entries.pop(key, None) is not None:
+                self.invalidations += 1
+
+    def clear(self):
+        """Remove all entries."""
+        with self._lock:
+            self._entries.clear()
+
+    def watch(self, collection):
+        """Invalidate entries when documents in collection are changed.
+
+        Falls back on expiry by ttl if change streams are not available.
+        """
+        with self._lock:
+            # the watcher retries on its own, but is not inherited by forked processes
+            if self._watcher is not None and self._watcher.pid == os.getpid():
+                return
+            self._watcher = ChangeWatcher(self, collection)
+            self._watcher.start()
+
+    def has_watcher(self):
+        """Check if a watcher was started in the current process."""
+        with self._lock:
+            return self._watcher is not None and self._watcher.pid == os.getpid()
+
+    @property
+    def watching(self):
+        """Check if entries are invalidated by a change stream."""
+        return self._watcher is not None and self._watcher.active
+
+    def stats(self):
+        """Summarize usage of the cache."""
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "watching": self.watching,
+        }
+
+
+class ChangeWatcher(threading.Thread):
+    """Invalidate cached documents from a change stream of a collection."""
+
+    operations = ["update", "replace", "delete"]
+
+    def __init__(self, cache, collection, retry_delay=10):
+        super().__init__(name="case-cache-watcher", daemon=True)
+        self.cache = cache
+        self.collection = collection
+        self.retry_delay = retry_delay
+        self.active = False
+        self.pid = os.getpid()
+
+    def run(self):
+        """Follow the change stream, restarting it on transient errors."""
+        pipeline = [{"$match": {"operationType": {"$in": self.operations}}}]
+        while True:
+            try:
+                with self.collection.watch(pipeline) as stream:
+                    # changes may have been missed before the stream was opened
+                    self.cache.clear()
+                    self.active = True
+                    LOG.info(f"Watching {self.collection.name} for changes to cached cases")
+                    for change in stream:
+                        self.cache.invalidate(change["documentKey"]["_id"])
+            except OperationFailure as err:
+                if err.code == CHANGE_STREAM_NOT_SUPPORTED:
+                    LOG.warning("Change streams are not supported, cached cases expire by ttl")
+                    return
+                LOG.warning(f"Change stream failed, retrying in {self.retry_delay}s: {err}")
+            except PyMongoError as err:
+                LOG.warning(f"Change stream failed, retrying in {self.retry_delay}s: {err}")
+            except Exception as err:  # eg. driver without change stream support
+                LOG.warning(f"Can not watch for changes, cached cases expire by ttl: {err}")
+                return
+            finally:
+                self.active = False
+            time.sleep(self.retry_delay)
@@ -0,0 +1,164 @@
+"""Coalescing of reruns arriving close in time into one remote launch."""
+import asyncio
+import logging
+import threading
+import time
+from concurrent.futures import Future
+
+from flask import current_app
+
+LOG = logging.getLogger(__name__)
+
+
+class Coalescer(object):
+    """Merge reruns submitted within window seconds into groups launched together.
+
+    The first rerun of a group starts a thread that waits window seconds, or
+    until max_size reruns have joined, and then launches the group with
+    launch(reruns). The launch returns an outcome, a value or an exception,
+    for each rerun which is handed to the callback it was submitted with.
+    Reruns with the same key are not grouped together.
+    """
+
+    def __init__(self, window=5, max_size=20):
+        self.window = window
+        self.max_size = max_size
+        self.launches = 0
+        self.coalesced = 0
+        self._group = None  # [(key, rerun, callback), ...] open for new reruns
+        self._async_group = None
+        self._async_full = None
+        self._cond = threading.Condition()
+
+    def _join(self, group, key):
+        """Check if a rerun can join an open group."""
+        return group is not None and all(other != key for other, _, _ in group)
+
+    def _record(self, group):
+        """Count a launched group."""
+        with self._cond:
+            self.launches += 1
+            self.coalesced += len(group)
+        LOG.info(f"Launching {len(group)} coalesced reruns")
+
+    @staticmethod
+    def _outcomes(group, launch):
+        """Launch a group, an error of the launch is the outcome of all reruns."""
+        try:
+            return launch([rerun for _, rerun, _ in group])
+        except Exception as err:
+            return [err] * len(group)
+
+    @staticmethod
+    def _deliver(callback, outcome):
+        """Hand an outcome to the callback of a rerun, errors of the callback are logged."""
+        try:
+            callback(outcome)
+        except Exception as err:
+            LOG.error(f"Delivering the outcome of a coalesced rerun failed: {err}")
+
+    @staticmethod
+    def _set_outcome(future, outcome):
+        """Hand an outcome back to the submitter of a rerun."""
+        if isinstance(outcome, Exception):
+            future.set_exception(outcome)
+        else:
+            future.set_result(outcome)
+
+    def submit(self, key, rerun, launch, callback):
+        """Add a rerun to the open group, callback is called with the outcome of its launch.
+
+        Returns right away, launch and callback are called in the thread of the group.
+        """
+        with self._cond:
+            if not self._join(self._group, key):
+                self._group, leader = [], True
+            else:
+                leader = False
+            group = self._group
+            group.append((key, rerun, callback))
+            if len(group) >= self.max_size:
+                self._group = None  # full, launch it now
+                self._cond.notify_all()
+        if leader:
+            threading.Thread(
+                target=self._lead, args=(group, launch), name="coalesce-launch", daemon=True
+            ).start()
+
+    def submit_wait(self, key, rerun, launch):
+        """Add a rerun to the open group and wait for the outcome of its launch."""
+        future = Future()
+        self.submit(key, rerun, launch, lambda outcome: self._set_outcome(future, outcome))
+        return future.result()
+
+    def _lead(self, group, launch):
+        """Close a group after the window and launch it."""
+        deadline = time.monotonic() + self.window
+        with self._cond:
+            while self._group is group and time.monotonic() < deadline:
+                self._cond.wait(deadline - time.monotonic())
+            if self._group is group:
+                self._group = None
+        self._record(group)
+        outcomes = self._outcomes(group, launch)
+        for (_, _, callback), outcome in zip(group, outcomes):
+            self._deliver(callback, outcome)
+
+    async def submit_async(self, key, rerun, launch):
+        """Add a rerun to the open group without blocking, see submit.
+
+        Launch must be a coroutine function and all reruns must be submitted
+        on the same event loop.
+        """
+        future = asyncio.get_running_loop().create_future()
+        if not self._join(self._async_group, key):
+            self._async_group, self._async_full, leader = [], asyncio.Event(), True
+        else:
+            leader = False
+        group, full = self._async_group, self._async_full
+        group.append((key, rerun, future))
+        if len(group) >= self.max_size:
+            self._async_group = None  # full, launch it now
+            full.set()
+        if leader:
+            await self._lead_async(group, full, launch)
+        return await future
+
+    async def _lead_async(self, group, full, launch):
+        """Close a group after the window or when it is full and launch it."""
+        try:
+            await asyncio.wait_for(full.wait(), self.window)
+        except asyncio.TimeoutError:
+            pass
+        if self._async_group is group:
+            self._async_group = None
+        self._record(group)
+        try:
+            outcomes = await launch([rerun for _, rerun, _ in group])
+        except Exception as err:
+            outcomes = [err] * len(group)
+        for (_, _, future), outcome in zip(group, outcomes):
+            self._set_outcome(future, outcome)
+
+    def stats(self):
+        """Summarize coalesced launches."""
+        return {
+            "window": self.window,
+            "max_size": self.max_size,
+            "launches": self.launches,
+            "reruns": self.coalesced,
+        }
+
+
+def init_coalescer():
+    """Initialize coalescing of reruns from flask, disabled unless WORKFLOW_COALESCE_WINDOW."""
+    cnf = current_app.config
+    window = cnf.get("WORKFLOW_COALESCE_WINDOW", 0)
+    cnf["COALESCER"] = (
+        Coalescer(window=window, max_size=cnf.get("WORKFLOW_COALESCE_MAX", 20)) if window else None
+    )
+
+
+def get_coalescer():
+    """Get the coalescer of reruns, None if disabled."""
+    return current_app.config.get("COALESCER")
@@ -1,13 +1,25 @@
 """Setup and establish a connection to the mongodb."""
 import logging
+import os
+import threading
 
 from flask import current_app
 from flask.cli import with_appcontext
 from pymongo import MongoClient
 from pymongo.errors import ConnectionFailure, ServerSelectionTimeoutError
 
+from .breaker import get_breaker, retry, retry_async
+from .cache import CaseCache
+from .jobs import run_blocking
+from .tracing import span
+
 LOG = logging.getLogger(__name__)
 
+_CONNECT_LOCK = threading.Lock()
+
+# fields of a case used for building pedigrees and run data
+CASE_PROJECTION = {"individuals": 1, "vcf_files": 1}
+
 
 class CaseNotFoundError(Exception):
     """Individual id missing in the database."""
@@ -16,7 +28,10 @@ class CaseNotFoundError(Exception):
 
 
 def init_db():
-    """Initialize from flask"""
+    """Initialize from flask
+
+    Use get_database, the client is created on first use in each process.
+    """
     db_name = current_app.config.get("MONGO_DBNAME", "scout")
 
     host = current_app.config.get("MONGO_HOST", "localhost")
@@ -38,16 +53,237 @@ def init_db():
 
     current_app.config["MONGO_DATABASE"] = client[db_name]
     current_app.config["MONGO_CLIENT"] = client
+    current_app.config["MONGO_PID"] = os.getpid()
+
+
+def get_database():
+    """Get the database, connecting on first use in each process.
+
+    MongoClient is not fork safe, a client created before the process was
+    forked is replaced.
+    """
+    cnf = current_app.config
+    with _CONNECT_LOCK:
+        if cnf.get("MONGO_DATABASE") is None or cnf.get("MONGO_PID", os.getpid()) != os.getpid():
+            init_db()
+    return cnf["MONGO_DATABASE"]
+
+
+def get_async_database():
+    """Get database of a non-blocking client, created on first use.
+
+    The client is bound to the event loop it is first used on.
+    """
+    cnf = current_app.config
+    database = cnf.get("MONGO_ASYNC_DATABASE")
+    if database is not None:
+        return database
+    try:  # only required when reruns are run asynchronously
+        from motor.motor_asyncio import AsyncIOMotorClient
+    except ImportError:
+        raise ImportError("Asynchronous reruns require motor, install scout-rerunner[async]")
+    client = AsyncIOMotorClient(
+        host=cnf.get("MONGO_HOST", "localhost"),
+        port=cnf.get("MONGO_PORT", 27017),
+        username=cnf.get("MONGO_USERNAME", None),
+        password=cnf.get("MONGO_PASSWORD", None),
+        serverSelectionTimeoutMS=cnf.get("MONGO_TIMEOUT", 60),
+    )
+    cnf["MONGO_ASYNC_DATABASE"] = client[cnf.get("MONGO_DBNAME", "scout")]
+    return cnf["MONGO_ASYNC_DATABASE"]
+
+
+def _ping_database():
+    """Check that the database responds."""
+    get_database().client.admin.command("ping")
+
+
+def database_breaker():
+    """Get the circuit breaker of the database, it is probed with ping."""
+    return get_breaker("mongo", probe=_ping_database)
+
+
+def _database_span(operation):
+    """Span of an operation on the case collection."""
+    attributes = {"db.system": "mongodb", "db.mongodb.collection": "case"}
+    return span("mongo_query", {**attributes, "db.operation": operation})
+
+
+def _database_call(func, operation="find"):
+    """Run a database operation with retries behind the circuit breaker of the database.
+
+    Transient connection errors are retried MONGO_RETRIES times with
+    exponential backoff starting at MONGO_RETRY_BACKOFF seconds.
+    """
+    cnf = current_app.config
+    with _database_span(operation), database_breaker().guard(ConnectionFailure):
+        return retry(
+            func,
+            ConnectionFailure,
+            retries=cnf.get("MONGO_RETRIES", 2),
+            backoff=cnf.get("MONGO_RETRY_BACKOFF", 0.5),
+            name="Database query",
+        )
+
+
+async def _database_call_async(func, operation="find"):
+    """Await a database operation with retries behind the circuit breaker, see _database_call."""
+    cnf = current_app.config
+    with _database_span(operation), database_breaker().guard(ConnectionFailure):
+        return await retry_async(
+            func,
+            ConnectionFailure,
+            retries=cnf.get("MONGO_RETRIES", 2),
+            backoff=cnf.get("MONGO_RETRY_BACKOFF", 0.5),
+            name="Database query",
+        )
+
+
+def init_case_cache():
+    """Initialize cache of case documents from flask."""
+    size = current_app.config.get("CASE_CACHE_SIZE", 256)
+    ttl = current_app.config.get("CASE_CACHE_TTL", 60)
+    current_app.config["CASE_CACHE"] = CaseCache(max_size=size, ttl=ttl) if size else None
+
+
+def get_case_cache(projection=CASE_PROJECTION):
+    """Get the cache of case documents with projection, if enabled."""
+    cache = current_app.config.get("CASE_CACHE")
+    if cache is None or projection != CASE_PROJECTION:
+        return None
+    # invalidate cached cases when they are updated
+    cache.watch(get_database().case)
+    return cache
 
 
-def query_case(case_id):
-    """Query database for a case."""
-    db_client = current_app.config["MONGO_DATABASE"]
+async def get_case_cache_async(projection=CASE_PROJECTION):
+    """Get the cache of case documents without blocking the event loop, see get_case_cache.
+
+    The blocking client watching for changes is set up in the executor.
+    """
+    cache = current_app.config.get("CASE_CACHE")
+    if cache is None or projection != CASE_PROJECTION:
+        return None
+    if not cache.has_watcher():
+        await run_blocking(get_case_cache, projection)
+    return cache
+
+
+def query_case(case_id, projection=CASE_PROJECTION):
+    """Query database for a case.
+
+    Only the fields in projection are returned, use None for the full case.
+    """
+    cache = get_case_cache(projection)
+    resp = None if cache is None else cache.get(case_id)
+    if resp is not None:
+        LOG.debug(f"Using cached case: {case_id}")
+        return resp
+
+    db_client = get_database()
     LOG.info(f"Querying db: {db_client} for case: {case_id}")
-    resp = db_client.case.find_one({"_id": case_id})
+    resp = _database_call(
+        lambda: db_client.case.find_one({"_id": case_id}, projection), operation="find_one"
+    )
 
     if resp is None:  # no case id
         msg = f'Case "{case_id}" not found in database'
         LOG.error(msg)
         raise CaseNotFoundError(msg)
+    if cache is not None:
+        cache.set(case_id, resp)
     return resp
+
+
+def query_cases(case_ids, projection=CASE_PROJECTION):
+    """Query database for several cases in one round trip.
+
+    Cases not in the database are left out of the result.
+    """
+    cache = get_case_cache(projection)
+    cases = {}
+    for case_id in case_ids:
+        case = None if cache is None else cache.get(case_id)
+        if case is not None:
+            cases[case_id] = case
+    missing = [case_id for case_id in case_ids if case_id not in cases]
+    if len(missing) == 0:
+        return cases
+
+    db_client = get_database()
+    LOG.info(f"Querying db: {db_client} for {len(missing)} cases")
+    found = _database_call(
+        lambda: list(db_client.case.find({"_id": {"$in": missing}}, projection))
+    )
+    for case in found:
+        cases[case["_id"]] = case
+        if cache is not None:
+            cache.set(case["_id"], case)
+    return cases
+
+
+def iter_cases(query, projection=CASE_PROJECTION, batch_size=100):
+    """Iterate over the cases matching a query, fetched batch_size at a time.
+
+    Cases are read from a cursor so only one batch is held in memory. Raises
+    CircuitOpenError right away if the database is down.
+    """
+    breaker = database_breaker()
+    breaker.before_call()
+    db_client = get_database()
+    LOG.info(f"Querying db: {db_client} for cases matching: {query}")
+    cursor = db_client.case.find(query, projection, batch_size=batch_size).sort("_id", 1)
+
+    def fetch():
+        with breaker.guard(ConnectionFailure):
+            yield from cursor
+
+    return fetch()
+
+
+async def query_case_async(case_id, projection=CASE_PROJECTION):
+    """Query database for a case without blocking the event loop."""
+    cache = await get_case_cache_async(projection)
+    resp = None if cache is None else cache.get(case_id)
+    if resp is not None:
+        LOG.debug(f"Using cached case: {case_id}")
+        return resp
+
+    LOG.info(f"Querying db for case: {case_id}")
+    collection = get_async_database().case
+    resp = await _database_call_async(
+        lambda: collection.find_one({"_id": case_id}, projection), operation="find_one"
+    )
+    if resp is None:  # no case id
+        msg = f'Case "{case_id}" not found in database'
+        LOG.error(msg)
+        raise CaseNotFoundError(msg)
+    if cache is not None:
+        cache.set(case_id, resp)
+    return resp
+
+
+async def query_cases_async(case_ids, projection=CASE_PROJECTION):
+    """Query database for several cases without blocking the event loop."""
+    cache = await get_case_cache_async(projection)
+    cases = {}
+    for case_id in case_ids:
+        case = None if cache is None else cache.get(case_id)
+        if case is not None:
+            cases[case_id] = case
+    missing = [case_id for case_id in case_ids if case_id not in cases]
+    if len(missing) == 0:
+        return cases
+
+    LOG.info(f"Querying db for {len(missing)} cases")
+    collection = get_async_database().case
+
+    async def find():
+        cursor = collection.find({"_id": {"$in": missing}}, projection)
+        return [case async for case in cursor]
+
+    for case in await _database_call_async(find):
+        cases[case["_id"]] = case
+        if cache is not None:
+            cache.set(case["_id"], case)
+    return cases
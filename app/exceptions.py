@@ -19,7 +19,51 @@ class PipelineExecutionError(Exception):
     pass
 
 
+class UploadError(PipelineExecutionError):
+    """Files of a rerun could not be written on the remote before it was started."""
+
+    pass
+
+
+class LaunchUnknownError(PipelineExecutionError):
+    """The connection to the remote was lost after a rerun was started, it may be running."""
+
+    pass
+
+
 class SSHKeyException(Exception):
     """Error with the SSH keys on the server."""
 
     pass
+
+
+class ConnectionPoolTimeout(Exception):
+    """No pooled connection to the remote became available in time."""
+
+    pass
+
+
+class QueueFullError(Exception):
+    """Too many jobs are waiting to be run."""
+
+    pass
+
+
+class IdempotencyKeyConflict(Exception):
+    """An idempotency key was reused for a different request."""
+
+    pass
+
+
+class MissingInputFilesError(Exception):
+    """Input files of a rerun are missing on the remote."""
+
+    pass
+
+
+class CircuitOpenError(Exception):
+    """A dependency is known to be down."""
+
+    def __init__(self, msg, retry_after=None):
+        super().__init__(msg)
+        self.retry_after = retry_after
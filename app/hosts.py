@@ -0,0 +1,240 @@
+"""Routing of reruns to the least loaded of many workflow hosts."""
+import logging
+import os
+import threading
+import time
+
+import attr
+from flask import current_app
+
+from . import remote
+from .breaker import OPEN, get_breaker
+from .exceptions import CircuitOpenError, ConnectionPoolTimeout, UploadError
+
+LOG = logging.getLogger(__name__)
+
+# prints the load average and the number of cpus of the remote
+LOAD_CMD = "echo $(cut -d ' ' -f 1 /proc/loadavg) $(nproc)"
+
+
+@attr.s(frozen=True)
+class WorkflowHost(object):
+    """A host where reruns are started."""
+
+    host = attr.ib(type=str)
+    user = attr.ib(type=str)
+    data_dir = attr.ib(type=str)
+    exec_script = attr.ib(type=str, default=None)
+
+
+def _workflow_host(host):
+    """Build a workflow host from its config, missing settings are taken from the app config."""
+    cnf = current_app.config
+    return WorkflowHost(
+        host=host["host"],
+        user=host.get("user", cnf.get("WORKFLOW_USER")),
+        data_dir=host.get("data_dir", cnf.get("WORKFLOW_DATA_DIR")),
+        exec_script=host.get("exec_script", cnf.get("WORKFLOW_EXEC_SCRIPT")),
+    )
+
+
+def workflow_hosts():
+    """Get the configured workflow hosts.
+
+    Hosts are listed in WORKFLOW_HOSTS with a host and optionally a user,
+    data_dir and exec_script, defaulting to WORKFLOW_USER, WORKFLOW_DATA_DIR
+    and WORKFLOW_EXEC_SCRIPT. Otherwise WORKFLOW_HOST is the only host.
+    """
+    cnf = current_app.config
+    hosts = cnf.get("WORKFLOW_HOSTS") or [{"host": cnf["WORKFLOW_HOST"]}]
+    return [_workflow_host(host) for host in hosts]
+
+
+def get_workflow_host(host):
+    """Get a workflow host by name, hosts that are not configured get the default settings."""
+    for workflow_host in workflow_hosts():
+        if workflow_host.host == host:
+            return workflow_host
+    return _workflow_host({"host": host})
+
+
+def host_breaker(workflow_host):
+    """Get the circuit breaker of a workflow host, it is probed by running a no-op command."""
+
+    def probe():
+        with remote.get_pool().connection(
+            workflow_host.host, workflow_host.user, remote.get_connect_kwargs()
+        ) as conn:
+            conn.run("true", hide=True, timeout=10)
+
+    return get_breaker(f"ssh:{workflow_host.host}", probe=probe)
+
+
+def is_failover_error(err):
+    """Check if a rerun failed because of the host and could be submitted to another host.
+
+    Only errors before the rerun was started are. Failures of the rescoring
+    script would fail on the other hosts as well and a connection lost while
+    starting it, a LaunchUnknownError, might have started it already.
+    """
+    errors = (
+        *remote.transport_errors(),
+        CircuitOpenError,
+        ConnectionPoolTimeout,
+        UploadError,  # before the rerun was started
+    )
+    return isinstance(err, errors)
+
+
+@attr.s()
+class HostState(object):
+    """Last known load and health of a host."""
+
+    load = attr.ib(type=float, default=None)  # load average per cpu
+    probed = attr.ib(type=float, default=None)
+    failures = attr.ib(type=int, default=0)
+    down_until = attr.ib(type=float, default=0)
+    error = attr.ib(type=str, default=None)
+
+
+class HostRouter(object):
+    """Order workflow hosts by health and load.
+
+    The load of each host is probed with one cheap command in the background
+    and cached for probe_ttl seconds. Hosts that failed a submission are
+    tried last for failure_cooldown seconds.
+    """
+
+    def __init__(self, app, probe_ttl=30, failure_cooldown=60, load_cmd=LOAD_CMD):
+        self.app = app
+        self.probe_ttl = probe_ttl
+        self.failure_cooldown = failure_cooldown
+        self.load_cmd = load_cmd
+        self._states = {}  # host -> HostState
+        self._lock = threading.Lock()
+        self._probing = False
+        self._pid = None
+
+    def _state(self, host):
+        """Get the state of a host, the lock must be held."""
+        state = self._states.get(host)
+        if state is None:
+            state = self._states[host] = HostState()
+        return state
+
+    def candidates(self, hosts=None):
+        """Order hosts to try, healthy hosts first by load then hosts that failed recently.
+
+        Hosts with an open circuit breaker are tried last.
+        """
+        hosts = workflow_hosts() if hosts is None else hosts
+        if len(hosts) == 1:
+            return hosts
+        self._probe_stale(hosts)
+        active = current_app.config["HOST_LIMITER"].stats()
+        now = time.monotonic()
+        broken = {host.host for host in hosts if host_breaker(host).state == OPEN}
+        with self._lock:
+            states = {host.host: attr.evolve(self._state(host.host)) for host in hosts}
+
+        def order(workflow_host):
+            state = states[workflow_host.host]
+            if workflow_host.host in broken:
+                return (2, 0, 0)
+            if state.down_until > now:
+                return (1, state.down_until, 0)
+            submitting = active.get(workflow_host.host, {}).get("active", 0)
+            return (0, state.load or 0, submitting)
+
+        return sorted(hosts, key=order)
+
+    def _probe_stale(self, hosts):
+        """Probe hosts with expired loads in the background."""
+        now = time.monotonic()
+        with self._lock:
+            if self._probing and self._pid == os.getpid():
+                return
+            stale = [
+                host
+                for host in hosts
+                if self._state(host.host).probed is None
+                or now - self._state(host.host).probed >= self.probe_ttl
+            ]
+            if not stale:
+                return
+            self._probing, self._pid = True, os.getpid()
+        threading.Thread(
+            target=self._probe_in_background, args=(stale,), name="host-probe", daemon=True
+        ).start()
+
+    def _probe_in_background(self, hosts):
+        try:
+            with self.app.app_context():
+                self.probe(hosts)
+        finally:
+            self._probing = False
+
+    def probe(self, hosts):
+        """Measure the load of hosts, hosts that cannot be reached are marked as failed."""
+        connect_kwargs = remote.get_connect_kwargs()
+        for workflow_host in hosts:
+            try:
+                with remote.get_pool().connection(
+                    workflow_host.host, workflow_host.user, connect_kwargs
+                ) as conn:
+                    resp = conn.run(self.load_cmd, hide=True, warn=True, timeout=10)
+                load, *cpus = resp.stdout.split()
+                load = float(load) / max(int(cpus[0]) if cpus else 1, 1)
+            except Exception as err:
+                LOG.warning(f"Probing load of {workflow_host.host} failed: {err}")
+                self.record_failure(workflow_host.host, err)
+                continue
+            with self._lock:
+                state = self._state(workflow_host.host)
+                state.load, state.probed = load, time.monotonic()
+            LOG.debug(f"Load of {workflow_host.host}: {load:.2f}")
+
+    def record_failure(self, host, err):
+        """Try host last until the cool down has passed."""
+        with self._lock:
+            state = self._state(host)
+            state.failures += 1
+            state.probed = time.monotonic()
+            state.down_until = time.monotonic() + self.failure_cooldown
+            state.error = f"{type(err).__name__} - {err}"
+
+    def record_success(self, host):
+        """Mark host as healthy."""
+        with self._lock:
+            state = self._state(host)
+            state.down_until, state.error = 0, None
+
+    def stats(self):
+        """Summarize load and health of the hosts."""
+        now = time.monotonic()
+        with self._lock:
+            return {
+                host: {
+                    "load": state.load,
+                    "healthy": state.down_until <= now,
+                    "failures": state.failures,
+                    "error": state.error,
+                }
+                for host, state in sorted(self._states.items())
+            }
+
+
+def init_router():
+    """Initialize routing of reruns to the workflow hosts from flask."""
+    cnf = current_app.config
+    cnf["HOST_ROUTER"] = HostRouter(
+        current_app._get_current_object(),
+        probe_ttl=cnf.get("WORKFLOW_PROBE_TTL", 30),
+        failure_cooldown=cnf.get("WORKFLOW_FAILURE_COOLDOWN", 60),
+        load_cmd=cnf.get("WORKFLOW_LOAD_CMD", LOAD_CMD),
+    )
+
+
+def get_router():
+    """Get the router of the app."""
+    return current_app.config["HOST_ROUTER"]
@@ -1,10 +1,12 @@
 """IO functions."""
 import csv
+import io
+import json
 import logging
-from itertools import chain
+from array import array
+from collections import deque
 
 import attr
-import cattr
 from flask import current_app as app
 from pymongo.errors import InvalidId
 from collections import OrderedDict
@@ -29,8 +31,18 @@ PHENOTYPE_TR = {
     "affected": 2,
 }
 
+# rundata columns of the vcf files that must be rescored for each kind of change
+RESCORE_VCF_TYPES = {
+    "excluded": ("sv_vcf", "snv_vcf", "str_vcf"),
+    "mother": ("sv_vcf", "snv_vcf", "str_vcf"),
+    "father": ("sv_vcf", "snv_vcf", "str_vcf"),
+    "sex": ("sv_vcf", "snv_vcf", "str_vcf"),
+    "phenotype": ("sv_vcf", "snv_vcf"),
+}
+VCF_COLUMNS = {"sv_vcf": "vcf_sv", "snv_vcf": "vcf_snv", "str_vcf": "vcf_str"}
+
 # Pedigree types
-@attr.s(frozen=True)
+@attr.s(frozen=True, slots=True)
 class Individual(object):
     id = attr.ib(type=str)
     family_id = attr.ib(type=str)
@@ -51,13 +63,31 @@ class Individual(object):
             raise ValueError("Categories must be either of 0, 1 and 2.")
 
 
-@attr.s()
+def _category(value):
+    """Convert and check encoding of sex and phenotype."""
+    value = int(value)
+    if not 0 <= value <= 2:
+        raise ValueError("Categories must be either of 0, 1 and 2.")
+    return value
+
+
+@attr.s(slots=True)
 class Family(object):
-    """Family container."""
+    """Family container.
+
+    Individuals are stored column wise with an index of the individual ids
+    and the children of each parent id, rows are kept in insertion order.
+    """
 
     family_id = attr.ib(type=str)
+    _ids = attr.ib(init=False, factory=list)
+    _mothers = attr.ib(init=False, factory=list)
+    _fathers = attr.ib(init=False, factory=list)
+    _sexes = attr.ib(init=False, factory=lambda: array("b"))
+    _phenotypes = attr.ib(init=False, factory=lambda: array("b"))
+    _index = attr.ib(init=False, factory=dict)  # individual id -> row
+    _children = attr.ib(init=False, factory=dict)  # parent id -> [row, ...]
     # fixed variables
-    _individuals = tuple()
     ped_header = [
         "#FamilyID",
         "IndividualID",
@@ -67,37 +97,144 @@ class Family(object):
         "Phenotype",
     ]
 
+    def add(self, ind_id, mother=0, father=0, sex=0, phenotype=0) -> int:
+        """Add individual to family, returns its row."""
+        if ind_id in self._index:
+            raise ValueError(f"Individual {ind_id} is already in family {self.family_id}")
+        sex, phenotype = _category(sex), _category(phenotype)
+        row = len(self._ids)
+        self._index[ind_id] = row
+        self._ids.append(ind_id)
+        self._mothers.append(_parent_id(mother))
+        self._fathers.append(_parent_id(father))
+        self._sexes.append(sex)
+        self._phenotypes.append(phenotype)
+        for parent in (self._mothers[row], self._fathers[row]):
+            if parent != 0:
+                self._children.setdefault(parent, []).append(row)
+        return row
+
     def add_individual(self, individual: Individual) -> None:
         """Add individuals to family."""
         if not isinstance(individual, (Individual)):
-            raise ValueError("Individual must be a {type(Individual).__name__} object")
-        self._individuals = tuple(chain(self._individuals, [individual]))
+            raise ValueError(f"Individual must be a {Individual.__name__} object")
+        self.add(
+            individual.id,
+            mother=individual.mother,
+            father=individual.father,
+            sex=individual.sex,
+            phenotype=individual.phenotype,
+        )
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __contains__(self, ind_id):
+        return ind_id in self._index
+
+    def _individual(self, row):
+        """Individual of a row."""
+        return Individual(
+            id=self._ids[row],
+            family_id=self.family_id,
+            mother=self._mothers[row],
+            father=self._fathers[row],
+            sex=self._sexes[row],
+            phenotype=self._phenotypes[row],
+        )
+
+    def get(self, ind_id):
+        """Get individual by id, None if it is not in the family."""
+        row = self._index.get(ind_id)
+        return None if row is None else self._individual(row)
+
+    def children(self, ind_id):
+        """Get the ids of the children of an individual."""
+        return [self._ids[row] for row in self._children.get(ind_id, [])]
+
+    @property
+    def _individuals(self):
+        """Individuals of the family in insertion order."""
+        return tuple(self._individual(row) for row in range(len(self._ids)))
+
+    def validate(self):
+        """Check the pedigree, returns a list of errors.
+
+        Finds parents missing in the family, parents of the wrong sex and
+        individuals with a cycle in their ancestry. Runs in linear time.
+        """
+        errors = []
+        num_parents = [0] * len(self._ids)
+        for row, ind_id in enumerate(self._ids):
+            for parent, wrong_sex, role in (
+                (self._mothers[row], SEX_TR["male"], "mother"),
+                (self._fathers[row], SEX_TR["female"], "father"),
+            ):
+                if parent == 0:
+                    continue
+                parent_row = self._index.get(parent)
+                if parent_row is None:
+                    errors.append(f"{role} {parent} of {ind_id} is not in the family")
+                    continue
+                num_parents[row] += 1
+                if self._sexes[parent_row] == wrong_sex:
+                    sex = "male" if wrong_sex == SEX_TR["male"] else "female"
+                    errors.append(f"{role} {parent} of {ind_id} is {sex}")
+
+        # remove individuals without unvisited parents, those left are in or below a cycle
+        queue = deque(row for row, count in enumerate(num_parents) if count == 0)
+        while queue:
+            ind_id = self._ids[queue.popleft()]
+            for child in self._children.get(ind_id, []):
+                num_parents[child] -= 1
+                if num_parents[child] == 0:
+                    queue.append(child)
+        in_cycle = [ind_id for ind_id, count in zip(self._ids, num_parents) if count > 0]
+        if in_cycle:
+            errors.append(f"cycle in the ancestry of: {', '.join(in_cycle)}")
+        return errors
 
     def to_ped(self, output, write_header=True) -> None:
         """To pedigree file."""
         cwriter = csv.DictWriter(output, fieldnames=self.ped_header, delimiter="\t")
         if write_header:
             cwriter.writeheader()
-        for row in self._individuals:
+        header = self.ped_header
+        rows = zip(self._ids, self._mothers, self._fathers, self._sexes, self._phenotypes)
+        for ind_id, mother, father, sex, phenotype in rows:
             cwriter.writerow(
                 {
-                    self.ped_header[0]: row.family_id,
-                    self.ped_header[1]: row.id,
-                    self.ped_header[2]: row.mother,
-                    self.ped_header[3]: row.father,
-                    self.ped_header[4]: row.sex,
-                    self.ped_header[5]: row.phenotype,
+                    header[0]: self.family_id,
+                    header[1]: ind_id,
+                    header[2]: mother,
+                    header[3]: father,
+                    header[4]: sex,
+                    header[5]: phenotype,
                 }
             )
 
-    def to_json(self) -> None:
+    def to_json(self) -> tuple:
         """Convert attr to json."""
-        return cattr.unstructure(self._individuals)
+        rows = zip(self._ids, self._mothers, self._fathers, self._sexes, self._phenotypes)
+        return tuple(
+            {
+                "id": ind_id,
+                "family_id": self.family_id,
+                "mother": mother,
+                "father": father,
+                "sex": sex,
+                "phenotype": phenotype,
+            }
+            for ind_id, mother, father, sex, phenotype in rows
+        )
+
 
+def create_new_pedigree(case_id, new_case_id, sample_ids, edited_sample_info=[], case=None):
+    """Make new pedigree.
 
-def create_new_pedigree(case_id, new_case_id, sample_ids, edited_sample_info=[]):
-    """Make new pedigree."""
-    resp = query_case(case_id)
+    The case is queried from the database unless a prefetched case is given.
+    """
+    resp = query_case(case_id) if case is None else case
 
     if not isinstance(sample_ids, (list, tuple)):
         raise ValueError("Sample ids must have the following format [<id_1>, <id_2>]")
@@ -135,31 +272,100 @@ def create_new_pedigree(case_id, new_case_id, sample_ids, edited_sample_info=[])
         phenotype = mod_data.get("phenotype", org_phenotype)
 
         # store family information
-        family_ped.add_individual(
-            Individual(
-                id=ind_id,
-                family_id=new_case_id,
-                mother=mother,
-                father=father,
-                sex=sex,
-                phenotype=phenotype,
-            )
-        )
+        family_ped.add(ind_id, mother=mother, father=father, sex=sex, phenotype=phenotype)
+    for error in family_ped.validate():
+        LOG.warning(f"Invalid pedigree of {new_case_id}: {error}")
     return family_ped
 
 
-def create_rundata(case_id, rerun_group_id):
-    """Create rundata informaiton."""
-    resp = query_case(case_id)
+def export_pedigrees(cases, output_format="ped", batch_size=100):
+    """Serialize the pedigrees of cases, yields one chunk per batch_size cases.
+
+    Pedigrees are built as for a rerun including all individuals of the
+    case. The output is either a PED file with one header or NDJSON with one
+    line per case. Cases with invalid individuals are logged and left out.
+    """
+    out = io.StringIO()
+    if output_format == "ped":
+        out.write("\t".join(Family.ped_header) + "\r\n")
+    num_cases = 0
+    for case in cases:
+        case_id = case["_id"]
+        sample_ids = [ind["individual_id"] for ind in case.get("individuals", [])]
+        try:
+            family = create_new_pedigree(case_id, case_id, sample_ids, case=case)
+        except (KeyError, ValueError, NoSampleIdError) as err:
+            LOG.warning(f"Skipping export of case {case_id}: {type(err).__name__} - {err}")
+            continue
+        if output_format == "ped":
+            family.to_ped(out, write_header=False)
+        else:
+            out.write(json.dumps({"case_id": case_id, "individuals": family.to_json()}) + "\n")
+        num_cases += 1
+        if num_cases % batch_size == 0:
+            yield out.getvalue()
+            out.seek(0)
+            out.truncate()
+    if out.tell():
+        yield out.getvalue()
+
+
+def _parent_id(parent):
+    """Normalize id of a parent, 0 if unknown."""
+    return 0 if parent in (None, "", "0", 0) else parent
+
+
+def diff_pedigree(case, family):
+    """Compare a new pedigree with the individuals of the original case.
+
+    Returns a list of changes with the sample id, the changed field and the
+    original and new value.
+    """
+    changes = []
+    for individual in case["individuals"]:
+        ind_id = individual["individual_id"]
+        new_ind = family.get(ind_id)
+        if new_ind is None:
+            changes.append({"sample_id": ind_id, "field": "excluded", "old": False, "new": True})
+            continue
+        original = {
+            "mother": _parent_id(individual["mother"]),
+            "father": _parent_id(individual["father"]),
+            "sex": SEX_TR.get(individual["sex"], 0),
+            "phenotype": PHENOTYPE_TR.get(individual["phenotype"], 0),
+        }
+        for field, old in original.items():
+            new = getattr(new_ind, field)
+            if old != new:
+                changes.append({"sample_id": ind_id, "field": field, "old": old, "new": new})
+    return changes
+
+
+def rescored_vcf_types(changes, vcf_types_by_change=RESCORE_VCF_TYPES):
+    """Get the vcf types that must be rescored for changes to a pedigree."""
+    vcf_types = set()
+    for change in changes:
+        vcf_types.update(vcf_types_by_change.get(change["field"], VCF_COLUMNS))
+    return vcf_types
+
+
+def create_rundata(case_id, rerun_group_id, case=None, vcf_types=None):
+    """Create rundata informaiton.
+
+    The case is queried from the database unless a prefetched case is given.
+    Only vcf files of the given vcf types are included, the others are left
+    empty.
+    """
+    resp = query_case(case_id) if case is None else case
     data_files = OrderedDict(
         {
             "group": rerun_group_id,
             "assay": "rescore-dry"
             if app.config["TESTING"]
             else "rescore",  # triggers correct nexflow parameter
-            "sv_vcf": resp["vcf_files"]["vcf_sv"],
-            "snv_vcf": resp["vcf_files"]["vcf_snv"],
-            "str_vcf": resp["vcf_files"]["vcf_str"],
         }
     )
+    for column, vcf_key in VCF_COLUMNS.items():
+        include = vcf_types is None or column in vcf_types
+        data_files[column] = resp["vcf_files"][vcf_key] if include else ""
     return [data_files]
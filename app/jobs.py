@@ -0,0 +1,676 @@
+"""Background execution of rerun jobs."""
+import asyncio
+import contextvars
+import importlib
+import itertools
+import logging
+import os
+import queue
+import threading
+import time
+import uuid
+import weakref
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+import attr
+from flask import current_app
+
+from .exceptions import IdempotencyKeyConflict, QueueFullError
+from .metrics import JOBS_FINISHED, STAGE_DURATION
+from .tracing import new_trace_id, span
+
+LOG = logging.getLogger(__name__)
+
+# job states
+QUEUED = "queued"
+RUNNING = "running"
+LAUNCHED = "launched"  # started on the remote, waiting for it to finish
+DONE = "done"
+FAILED = "failed"
+
+# states of jobs reused for duplicated requests
+REUSED_STATES = (QUEUED, RUNNING, LAUNCHED, DONE)
+
+_CURRENT_JOB = ContextVar("current_job", default=None)
+_MANAGERS = weakref.WeakSet()  # managers to restart in forked processes
+
+
+@attr.s()
+class Job(object):
+    """A rerun job and its progress."""
+
+    func = attr.ib(repr=False)
+    case_id = attr.ib()  # case id or list of case ids of a batch
+    params = attr.ib(factory=dict, repr=False)
+    id = attr.ib(type=str, factory=lambda: uuid.uuid4().hex)
+    state = attr.ib(type=str, default=QUEUED)
+    submitted = attr.ib(type=float, factory=time.time)
+    started = attr.ib(type=float, default=None)
+    finished = attr.ib(type=float, default=None)
+    stages = attr.ib(factory=OrderedDict)
+    result = attr.ib(default=None)
+    error = attr.ib(type=str, default=None)
+    status_code = attr.ib(type=int, default=None)
+    launches = attr.ib(factory=list, repr=False)  # detached remote launches
+    deferred = attr.ib(type=int, default=0, repr=False)  # reruns handed to another job
+    deferred_error = attr.ib(default=None, repr=False)  # first error of a deferred rerun
+    returned = attr.ib(type=bool, default=False, repr=False)  # func has returned
+    priority = attr.ib(type=int, default=0)  # lower is run first
+    store = attr.ib(default=None, repr=False, eq=False)  # persistent job store
+    trace_id = attr.ib(type=str, factory=new_trace_id)
+    parent_span_id = attr.ib(type=str, default=None, repr=False)  # span of the caller, if any
+    _done = attr.ib(factory=threading.Event, repr=False)
+
+    @property
+    def is_finished(self):
+        """Check if the job has finished."""
+        return self.state in (DONE, FAILED)
+
+    def has_case(self, case_id):
+        """Check if the job reruns a case."""
+        if isinstance(self.case_id, (list, tuple)):
+            return case_id in self.case_id
+        return self.case_id == case_id
+
+    def wait(self, timeout=None):
+        """Wait for the job to finish."""
+        return self._done.wait(timeout)
+
+    def finish(self, state, error=None, status_code=None):
+        """Mark the job as finished."""
+        self.error, self.status_code = error, status_code
+        self.finished = time.time()
+        self.state = state
+        JOBS_FINISHED.inc(state)
+        self.save()
+        self._done.set()
+
+    def save(self):
+        """Save the job to the persistent store, if any."""
+        if self.store is None:
+            return
+        try:
+            self.store.save_job(self)
+        except Exception as err:  # the history must not fail the rerun
+            LOG.error(f"Could not save job {self.id}: {type(err).__name__} - {err}")
+
+    def to_json(self):
+        """Summarize job as json."""
+        return {
+            "job_id": self.id,
+            "case_id": self.case_id,
+            "state": self.state,
+            "submitted": self.submitted,
+            "started": self.started,
+            "finished": self.finished,
+            "stages": dict(self.stages),
+            "result": self.result,
+            "error": self.error,
+            "status_code": self.status_code,
+            "priority": self.priority,
+            "trace_id": self.trace_id,
+        }
+
+
+def current_job():
+    """Get the job run by the current thread, if any."""
+    return _CURRENT_JOB.get()
+
+
+@contextmanager
+def stage(name, attributes=None):
+    """Record the duration of a stage of the current job.
+
+    Durations of repeated stages are summed, each is also a span of the
+    trace of the job.
+    """
+    start = time.perf_counter()
+    try:
+        with span(name, attributes):
+            yield
+    finally:
+        record_stage(name, time.perf_counter() - start)
+
+
+def record_stage(name, elapsed):
+    """Add the duration of a stage to the current job, see stage."""
+    STAGE_DURATION.observe(elapsed, name)
+    job = _CURRENT_JOB.get()
+    if job is not None:
+        job.stages[name] = round(job.stages.get(name, 0) + elapsed, 6)
+
+
+async def run_blocking(func, *args):
+    """Run a blocking function in the default executor with the context of the current task."""
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(None, context.run, func, *args)
+
+
+def import_func(name):
+    """Import a function by its module and qualified name."""
+    module, _, qualname = name.rpartition(".")
+    while True:
+        try:
+            obj = importlib.import_module(module)
+            break
+        except ImportError:  # method of a class
+            module, _, parent = module.rpartition(".")
+            qualname = f"{parent}.{qualname}"
+            if not module:
+                raise
+    for attr_name in qualname.split("."):
+        obj = getattr(obj, attr_name)
+    return obj
+
+
+class JobManager(object):
+    """Run jobs on a bounded pool of worker threads.
+
+    Jobs are executed in an application context of `app`, those with the
+    lowest priority first and in order of submission. Errors are translated
+    into a message and status code by `error_handler`.
+
+    With a `store` jobs are saved when their state changes and unfinished
+    jobs of processes that stopped for more than `lease` seconds are
+    recovered.
+
+    With a `tracer` each job is traced from its submission.
+    """
+
+    def __init__(
+        self,
+        app,
+        workers=4,
+        max_queued=100,
+        history=1000,
+        error_handler=None,
+        dedup_window=600,
+        store=None,
+        lease=60,
+        tracer=None,
+    ):
+        self.app = app
+        self.workers = workers
+        self.history = history
+        self.error_handler = error_handler
+        self.dedup_window = dedup_window
+        self.store = store
+        self.lease = lease
+        self.tracer = tracer
+        self.resume_launches = None  # called with recovered launched jobs and their launches
+        self._queue = queue.PriorityQueue(maxsize=max_queued)  # (priority, order, job)
+        self._order = itertools.count()
+        self._jobs = OrderedDict()
+        self._dedup = {}  # deduplication key -> (job, expiry time, fingerprint)
+        self._lock = threading.Lock()
+        self._threads = []
+        self._pid = None
+        self._recovery_pid = None
+        _MANAGERS.add(self)
+
+    def start(self):
+        """Start recovery of jobs of stopped processes in the current process.
+
+        Called by the serving process, not before it is forked. Workers are
+        started with the first job.
+        """
+        if self.store is None or self._recovery_pid == os.getpid():
+            return
+        with self._lock:
+            self._start_recovery()
+
+    def _after_fork(self):
+        """Drop the jobs and threads of the parent process and restart recovery."""
+        self._lock = threading.Lock()
+        self._queue = queue.PriorityQueue(maxsize=self._queue.maxsize)
+        self._jobs = OrderedDict()
+        self._dedup = {}
+        self._threads = []
+        if self._recovery_pid is not None:
+            self.start()
+
+    def _start_workers(self):
+        """Start worker threads in the current process, the lock must be held."""
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        workers = [
+            threading.Thread(target=self._work, name=f"rerun-worker-{i}", daemon=True)
+            for i in range(self.workers)
+        ]
+        for thread in workers:
+            thread.start()
+        self._threads.extend(workers)
+        self._start_recovery()
+
+    def _start_recovery(self):
+        """Start recovery of jobs of stopped processes once per process, the lock must be held."""
+        if self.store is None or self._recovery_pid == os.getpid():
+            return
+        self._recovery_pid = os.getpid()
+        self.store.heartbeat()  # before jobs of this process are saved
+        thread = threading.Thread(target=self._recover_forever, name="rerun-recovery", daemon=True)
+        thread.start()
+        self._threads.append(thread)
+
+    def submit(self, func, case_id, priority=0, **params):
+        """Queue a job for background execution."""
+        job, _ = self.submit_once(func, case_id, (), priority=priority, **params)
+        return job
+
+    def submit_once(
+        self,
+        func,
+        case_id,
+        keys,
+        priority=0,
+        trace_id=None,
+        parent_span_id=None,
+        fingerprint=None,
+        **params,
+    ):
+        """Queue a job unless a job with any of the keys was recently queued.
+
+        Jobs that failed are not reused. Returns the job and if it was queued.
+        Raises IdempotencyKeyConflict if a key belongs to a job queued with
+        another fingerprint, the content of the request. The job is traced
+        with trace_id as a child of parent_span_id if given.
+
+        With a store the keys are shared by all processes using it, otherwise
+        they are only known to this process.
+        """
+        job = Job(
+            func=func,
+            case_id=case_id,
+            params=params,
+            priority=priority,
+            store=self.store,
+            trace_id=trace_id or new_trace_id(),
+            parent_span_id=parent_span_id,
+        )
+        with self._lock:
+            self._start_workers()
+            # only submitters add jobs and they hold the lock
+            full = self._queue.full()
+            shared = self.store is not None and self.dedup_window and keys
+            if shared:  # the job is saved if no key was used
+                found = self.store.submit_job(
+                    job, keys, fingerprint, self.dedup_window, REUSED_STATES, save=not full
+                )
+                duplicates = [
+                    (self._jobs.get(row["id"]) or self._stored_job(row), key, job_fingerprint)
+                    for row, key, job_fingerprint in found
+                ]
+            else:
+                duplicates = self._duplicates(keys)
+            for other, key, job_fingerprint in duplicates:
+                if None not in (fingerprint, job_fingerprint) and fingerprint != job_fingerprint:
+                    raise IdempotencyKeyConflict(
+                        f"Key {key} was used for another request, job {other.id}"
+                    )
+            if duplicates:
+                reused = duplicates[0][0]
+                LOG.info(f"Reusing job {reused.id} for duplicated request of case: {case_id}")
+                return reused, False
+
+            if full:
+                raise QueueFullError(f"Queue is full, {self._queue.qsize()} jobs are waiting")
+            if not shared:
+                job.save()  # before a worker updates it
+            # log before the job is visible to the workers
+            LOG.info(f"Queued job {job.id} for case: {case_id}")
+            self._queue.put_nowait((priority, next(self._order), job))
+            self._jobs[job.id] = job
+            if self.dedup_window and not shared:
+                expiry = time.monotonic() + self.dedup_window
+                for key in keys:
+                    self._dedup[key] = (job, expiry, fingerprint)
+            self._prune()
+        return job, True
+
+    def _duplicates(self, keys):
+        """Jobs of this process recently queued with any of the keys, the lock must be held.
+
+        Returns the job, key and fingerprint of each key in use.
+        """
+        now = time.monotonic()
+        duplicates = []
+        for key in keys:
+            job, expiry, fingerprint = self._dedup.get(key, (None, 0, None))
+            if job is not None and expiry > now and job.state != FAILED:
+                duplicates.append((job, key, fingerprint))
+        return duplicates
+
+    @staticmethod
+    def _stored_job(row):
+        """Job of another process, as stored."""
+        job = Job(
+            func=None,
+            case_id=row["case_id"],
+            params=row["params"],
+            id=row["id"],
+            state=row["state"],
+            submitted=row["submitted"],
+            started=row["started"],
+            result=row["result"],
+            error=row["error"],
+            status_code=row["status_code"],
+            priority=row["priority"],
+        )
+        job.stages.update(row["stages"] or {})
+        return job
+
+    def _prune(self):
+        """Forget the oldest finished jobs and expired keys, the lock must be held."""
+        now = time.monotonic()
+        for key in [key for key, (_, expiry, _) in self._dedup.items() if expiry <= now]:
+            del self._dedup[key]
+
+        n_remove = len(self._jobs) - self.history
+        for job_id in [job_id for job_id, job in self._jobs.items() if job.is_finished]:
+            if n_remove <= 0:
+                break
+            del self._jobs[job_id]
+            n_remove -= 1
+
+    def get(self, job_id):
+        """Get job by id."""
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def list(self, case_id=None, state=None):
+        """List jobs, most recent first."""
+        with self._lock:
+            jobs = list(self._jobs.values())
+        return [
+            job
+            for job in reversed(jobs)
+            if (case_id is None or job.has_case(case_id)) and (state is None or job.state == state)
+        ]
+
+    def queue_depth(self):
+        """Number of jobs waiting to be run."""
+        return self._queue.qsize()
+
+    def queue_stats(self):
+        """Summarize waiting and running jobs."""
+        with self._queue.mutex:
+            priorities = [priority for priority, _, _ in self._queue.queue]
+        with self._lock:
+            running = sum(job.state == RUNNING for job in self._jobs.values())
+        return {
+            "depth": len(priorities),
+            "max_size": self._queue.maxsize,
+            "running": running,
+            "by_priority": {
+                priority: priorities.count(priority) for priority in sorted(set(priorities))
+            },
+        }
+
+    def _work(self):
+        """Run queued jobs."""
+        while True:
+            _, _, job = self._queue.get()
+            try:
+                self.run(job)
+            finally:
+                self._queue.task_done()
+
+    def run(self, job):
+        """Run a job in the current thread."""
+        token = _CURRENT_JOB.set(job)
+        self._started(job)
+        try:
+            with self.app.app_context(), self._trace(job):
+                job.result = job.func(job.case_id, **job.params)
+        except Exception as err:
+            self._failed(job, err)
+        else:
+            self._succeeded(job)
+        finally:
+            _CURRENT_JOB.reset(token)
+
+    @contextmanager
+    def _trace(self, job):
+        """Trace a job from its submission, the wait in the queue is its first span."""
+        if self.tracer is None:
+            yield
+            return
+        submitted, started = int(job.submitted * 1e9), int(job.started * 1e9)
+        attributes = {"job.id": job.id, "case_id": str(job.case_id), "job.priority": job.priority}
+        with self.tracer.trace(
+            "rerun", job.trace_id, job.parent_span_id, start=submitted, attributes=attributes
+        ) as root:
+            root.child("queue", start=submitted).finish(end=started)
+            yield
+
+    def _started(self, job):
+        """Mark a job as running."""
+        job.state = RUNNING
+        job.started = time.time()
+        job.save()
+        LOG.info(f"Starting job {job.id} for case: {job.case_id}")
+
+    def _failed(self, job, err):
+        """Finish a job that raised an error."""
+        job.returned = True
+        job.finish(FAILED, *self.describe_error(err))
+        LOG.error(f"Job {job.id} failed: {job.error}")
+
+    def _succeeded(self, job):
+        """Finish a job, or wait for its deferred reruns to be resolved."""
+        with self._lock:
+            job.returned = True
+            if job.deferred:  # finished by the last call of resolve
+                return
+        self._complete(job)
+
+    def _complete(self, job):
+        """Finish a job whose reruns were all started, or wait for its remote launches."""
+        if job.is_finished:
+            return
+        if job.deferred_error is not None:
+            self._failed(job, job.deferred_error)
+        elif job.launches:  # finished when the remote launches finish
+            job.state = LAUNCHED
+            job.save()
+        else:
+            job.finish(DONE)
+
+    def defer(self, job):
+        """Keep a job running after it returns until resolve is called for a handed off rerun."""
+        with self._lock:
+            job.deferred += 1
+
+    def resolve(self, job, func):
+        """Call func in the context of a deferred job, it is finished after the last.
+
+        The first error of func fails the job.
+        """
+        token = _CURRENT_JOB.set(job)
+        try:
+            with self.app.app_context():
+                func()
+        except Exception as err:
+            job.deferred_error = job.deferred_error or err
+        finally:
+            _CURRENT_JOB.reset(token)
+        with self._lock:
+            job.deferred -= 1
+            complete = job.returned and not job.deferred
+        if complete:
+            self._complete(job)
+
+    def _recover_forever(self):
+        """Recover jobs of stopped processes until the process exits."""
+        while True:
+            time.sleep(self.lease / 3)
+            try:
+                self.recover()
+            except Exception as err:
+                LOG.error(f"Recovery of jobs failed: {type(err).__name__} - {err}")
+
+    def recover(self):
+        """Take over the unfinished jobs of stopped processes.
+
+        Queued jobs are queued again, running jobs are run again unless they
+        were already submitted to the remote and launched jobs are tracked
+        until their remote launches exit.
+        """
+        self.store.heartbeat()
+        for row in self.store.claim_orphans((QUEUED, RUNNING, LAUNCHED), self.lease):
+            if row["id"] in self._jobs:
+                continue
+            LOG.warning(f"Recovering {row['state']} job {row['id']} for case: {row['case_id']}")
+            try:
+                self._recover_job(row)
+            except Exception as err:
+                LOG.error(f"Could not recover job {row['id']}: {type(err).__name__} - {err}")
+
+    def _recover_job(self, row):
+        """Restore a stored job."""
+        job = Job(
+            func=None,
+            case_id=row["case_id"],
+            params=row["params"],
+            id=row["id"],
+            submitted=row["submitted"],
+            priority=row["priority"],
+            store=self.store,
+        )
+        job.stages.update(row["stages"] or {})
+        job.result = row["result"]
+        with self._lock:
+            self._jobs[job.id] = job
+        try:
+            job.func = import_func(row["func"])
+        except (ImportError, AttributeError):
+            job.finish(FAILED, f"Could not recover job, unknown function {row['func']}", 500)
+            return
+
+        if row["state"] == LAUNCHED and self.resume_launches is not None:
+            job.state, job.started = LAUNCHED, row["started"]
+            self.resume_launches(job, row["launches"] or [])
+        elif row["state"] == LAUNCHED or self.store.list_reruns(job_id=job.id, limit=1):
+            # the rerun was submitted, running it again would start it twice on the remote
+            msg = "The service was restarted after the rerun was submitted, see the rerun history"
+            job.finish(FAILED, msg, 500)
+        else:
+            job.result = None
+            with self._lock:
+                self._start_workers()
+                if not self._queue.full():
+                    job.save()
+                    self._queue.put_nowait((job.priority, next(self._order), job))
+                    return
+            job.finish(FAILED, "Could not recover job, the queue is full", 503)
+
+    def describe_error(self, err):
+        """Translate an error into a message and status code."""
+        if self.error_handler is None:
+            return f"{type(err).__name__} - {str(err)}", 500
+        return self.error_handler(err)
+
+
+class AsyncJobManager(JobManager):
+    """Run jobs as coroutines on an event loop in a background thread.
+
+    Jobs are queued like for the JobManager but up to `concurrency` jobs are
+    run at the same time, the functions of the jobs must be coroutines.
+    """
+
+    def __init__(self, app, concurrency=256, **kwargs):
+        super().__init__(app, workers=1, **kwargs)
+        self.concurrency = concurrency
+        self.loop = None
+
+    def _start_workers(self):
+        """Start event loop and dispatcher in the current process, the lock must be held."""
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self.loop = asyncio.new_event_loop()
+        threads = [
+            threading.Thread(target=self.loop.run_forever, name="rerun-loop", daemon=True),
+            threading.Thread(target=self._work, name="rerun-dispatcher", daemon=True),
+        ]
+        for thread in threads:
+            thread.start()
+        self._threads.extend(threads)
+        self._start_recovery()
+
+    def _work(self):
+        """Schedule queued jobs on the event loop, waiting when too many are running."""
+        running = threading.BoundedSemaphore(self.concurrency)
+        while True:
+            _, _, job = self._queue.get()
+            running.acquire()
+            future = asyncio.run_coroutine_threadsafe(self.run_async(job), self.loop)
+            future.add_done_callback(lambda _: running.release())
+            self._queue.task_done()
+
+    def run(self, job):
+        """Run a job on the event loop and wait for it to finish."""
+        with self._lock:
+            self._start_workers()
+        asyncio.run_coroutine_threadsafe(self.run_async(job), self.loop).result()
+
+    async def run_async(self, job):
+        """Run a job in the current task, the job is saved to the store in the executor."""
+        token = _CURRENT_JOB.set(job)
+        await run_blocking(self._started, job)
+        try:
+            with self.app.app_context(), self._trace(job):
+                job.result = await job.func(job.case_id, **job.params)
+        except Exception as err:
+            await run_blocking(self._failed, job, err)
+        else:
+            await run_blocking(self._succeeded, job)
+        finally:
+            _CURRENT_JOB.reset(token)
+
+
+def init_jobs(error_handler=None):
+    """Initialize job manager from flask.
+
+    With RERUN_ASYNC reruns are run as coroutines with non-blocking database
+    and ssh clients.
+    """
+    cnf = current_app.config
+    kwargs = dict(
+        max_queued=cnf.get("RERUN_QUEUE_SIZE", 100),
+        history=cnf.get("RERUN_HISTORY_SIZE", 1000),
+        error_handler=error_handler,
+        dedup_window=cnf.get("RERUN_DEDUP_WINDOW", 600),
+        store=cnf.get("JOB_STORE"),
+        lease=cnf.get("RERUN_RECOVERY_LEASE", 60),
+        tracer=cnf.get("TRACER"),
+    )
+    if cnf.get("RERUN_ASYNC", False):
+        manager = AsyncJobManager(
+            current_app._get_current_object(),
+            concurrency=cnf.get("RERUN_ASYNC_CONCURRENCY", 256),
+            **kwargs,
+        )
+    else:
+        manager = JobManager(
+            current_app._get_current_object(), workers=cnf.get("RERUN_WORKERS", 4), **kwargs
+        )
+    current_app.config["JOB_MANAGER"] = manager
+
+
+def get_job_manager():
+    """Get the job manager of the app."""
+    return current_app.config["JOB_MANAGER"]
+
+
+def _restart_after_fork():
+    """Restart recovery in a forked process, threads are not inherited."""
+    for manager in list(_MANAGERS):
+        manager._after_fork()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_restart_after_fork)
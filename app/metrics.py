@@ -0,0 +1,196 @@
+"""Counters and histograms exposed in the Prometheus text format.
+
+Metrics are kept per process, each gunicorn worker reports its own values.
+"""
+import threading
+from bisect import bisect_left
+
+from flask import current_app
+
+# upper bounds of histogram buckets in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+def _escape(value):
+    """Escape a label value."""
+    return str(value).replace("\\", r"\\").replace('"', r"\"").replace("\n", r"\n")
+
+
+def _format_labels(names, values, extra=()):
+    """Format label names and values as {name="value",...}."""
+    pairs = [*zip(names, values), *extra]
+    if len(pairs) == 0:
+        return ""
+    labels = ",".join(f'{name}="{_escape(value)}"' for name, value in pairs)
+    return f"{{{labels}}}"
+
+
+class Counter(object):
+    """Monotonically increasing counter."""
+
+    type = "counter"
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        """Increment counter of labels."""
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def get(self, *label_values):
+        """Get value of labels."""
+        return self._values.get(label_values, 0)
+
+    def samples(self):
+        """Samples as (name, labels, value)."""
+        with self._lock:
+            values = list(self._values.items())
+        for label_values, value in values:
+            yield self.name, _format_labels(self.labels, label_values), value
+
+
+class Sampled(object):
+    """Values sampled by a function when the metrics are collected.
+
+    The function returns a mapping of label values to the current value.
+    """
+
+    def __init__(self, name, description, func, labels=(), type="gauge"):
+        self.name = name
+        self.description = description
+        self.func = func
+        self.labels = tuple(labels)
+        self.type = type
+
+    def samples(self):
+        """Samples as (name, labels, value)."""
+        for label_values, value in self.func().items():
+            yield self.name, _format_labels(self.labels, label_values), value
+
+
+class Histogram(object):
+    """Distribution of observed values in cumulative buckets."""
+
+    type = "histogram"
+
+    def __init__(self, name, description, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}  # label values -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        """Record an observation."""
+        idx = bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(label_values)
+            if counts is None:
+                counts = self._values[label_values] = [0] * (len(self.buckets) + 3)
+            counts[idx] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    def count(self, *label_values):
+        """Number of observations of labels."""
+        return self._values.get(label_values, [0])[-1]
+
+    def samples(self):
+        """Samples as (name, labels, value)."""
+        with self._lock:
+            values = [(label_values, list(counts)) for label_values, counts in self._values.items()]
+        for label_values, counts in values:
+            cumulative = 0
+            for bound, count in zip([*self.buckets, "+Inf"], counts):
+                cumulative += count
+                labels = _format_labels(self.labels, label_values, [("le", bound)])
+                yield f"{self.name}_bucket", labels, cumulative
+            labels = _format_labels(self.labels, label_values)
+            yield f"{self.name}_sum", labels, counts[-2]
+            yield f"{self.name}_count", labels, counts[-1]
+
+
+class Registry(object):
+    """Collection of metrics."""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        """Add a metric, replacing any metric with the same name."""
+        with self._lock:
+            self._metrics[metric.name] = metric
+        return metric
+
+    def render(self):
+        """Render all metrics in the Prometheus text format."""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.description}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{labels} {value}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+STAGE_DURATION = REGISTRY.register(
+    Histogram(
+        "rerunner_stage_duration_seconds", "Duration of the stages of a rerun.", labels=["stage"]
+    )
+)
+JOBS_FINISHED = REGISTRY.register(
+    Counter("rerunner_jobs_finished_total", "Finished rerun jobs.", labels=["state"])
+)
+ERRORS = REGISTRY.register(
+    Counter("rerunner_errors_total", "Errors of reruns by exception type.", labels=["type"])
+)
+AUTHENTICATIONS = REGISTRY.register(
+    Counter("rerunner_authentications_total", "Authentication attempts.", labels=["result"])
+)
+
+
+def init_metrics():
+    """Register metrics sampled from the resources of the app."""
+    app = current_app._get_current_object()
+
+    def cache_counter(name):
+        cache = app.config.get("CASE_CACHE")
+        return {} if cache is None else {(): getattr(cache, name)}
+
+    def upload_counter(name):
+        index = app.config.get("UPLOAD_INDEX")
+        return {} if index is None else {(): getattr(index, name)}
+
+    def queue_depth():
+        manager = app.config.get("JOB_MANAGER")
+        return {} if manager is None else {(): manager.queue_depth()}
+
+    for name in ("hits", "misses"):
+        REGISTRY.register(
+            Sampled(
+                f"rerunner_case_cache_{name}_total",
+                f"Case cache {name}.",
+                lambda name=name: cache_counter(name),
+                type="counter",
+            )
+        )
+        REGISTRY.register(
+            Sampled(
+                f"rerunner_upload_cache_{name}_total",
+                f"Upload cache {name}.",
+                lambda name=name: upload_counter(name),
+                type="counter",
+            )
+        )
+    REGISTRY.register(Sampled("rerunner_queue_depth", "Reruns waiting to be run.", queue_depth))
@@ -0,0 +1,135 @@
+"""Checks that the input files of reruns exist on the remote before they are started."""
+import logging
+import re
+import shlex
+import threading
+import time
+
+from flask import current_app
+
+from .exceptions import MissingInputFilesError
+from .jobs import stage
+
+LOG = logging.getLogger(__name__)
+
+STAT_LINE = re.compile(r"^(\d+) (ok|missing)$")
+
+
+def stat_cmd(paths):
+    """Build one command printing <index> ok or <index> missing for each readable path."""
+    return "\n".join(
+        f'if [ -r {shlex.quote(str(path))} ]; then echo "{idx} ok"; else echo "{idx} missing"; fi'
+        for idx, path in enumerate(paths)
+    )
+
+
+class PreflightCache(object):
+    """Recently checked input files per host, kept for ttl seconds."""
+
+    def __init__(self, ttl=60):
+        self.ttl = ttl
+        self._checked = {}  # (host, path) -> (exists, time checked)
+        self._lock = threading.Lock()
+
+    def get(self, host, paths):
+        """Get the paths known to be missing and the paths to check."""
+        now = time.monotonic()
+        missing, unknown = set(), []
+        with self._lock:
+            for path in dict.fromkeys(paths):
+                exists, checked = self._checked.get((host, path), (None, None))
+                if checked is None or now - checked >= self.ttl:
+                    unknown.append(path)
+                elif not exists:
+                    missing.add(path)
+        return missing, unknown
+
+    def update(self, host, paths, output):
+        """Cache the output of stat_cmd, returns the missing paths.
+
+        Other output, like a login banner, is ignored and paths without a
+        result are neither cached nor reported missing.
+        """
+        now = time.monotonic()
+        checked = {}  # path -> exists
+        for line in output.splitlines():
+            match = STAT_LINE.match(line.strip())
+            if match is not None and int(match.group(1)) < len(paths):
+                checked[paths[int(match.group(1))]] = match.group(2) == "ok"
+        with self._lock:
+            for path, exists in checked.items():
+                self._checked[(host, path)] = (exists, now)
+            expired = [key for key, (_, when) in self._checked.items() if now - when >= self.ttl]
+            for key in expired:
+                del self._checked[key]
+        return {path for path, exists in checked.items() if not exists}
+
+
+def _missing_by_rerun(prepared_reruns, missing):
+    """Get the missing input files of each rerun by case id."""
+    return {
+        prepared.case_id: [path for path in prepared.input_files if path in missing]
+        for prepared in prepared_reruns
+        if missing.intersection(prepared.input_files)
+    }
+
+
+def _checked_missing(cache, host, paths, resp):
+    """Missing paths in the response of stat_cmd, nothing is cached if the command failed."""
+    if resp.failed:
+        LOG.warning(f"Checking input files on {host} failed: {resp.stderr.strip()}")
+        return set()
+    return cache.update(host, paths, resp.stdout)
+
+
+def preflight(conn, prepared_reruns):
+    """Check the input files of reruns with one remote command.
+
+    Returns a mapping of case id to missing files, empty if the check is
+    disabled or all files exist.
+    """
+    cache = get_preflight_cache()
+    if cache is None:
+        return {}
+    paths = [path for prepared in prepared_reruns for path in prepared.input_files]
+    missing, unknown = cache.get(conn.host, paths)
+    if unknown:
+        with stage("preflight"):
+            resp = conn.run(stat_cmd(unknown), hide=True, warn=True)
+        missing |= _checked_missing(cache, conn.host, unknown, resp)
+    return _missing_by_rerun(prepared_reruns, missing)
+
+
+async def preflight_async(conn, prepared_reruns):
+    """Check the input files of reruns without blocking, see preflight."""
+    cache = get_preflight_cache()
+    if cache is None:
+        return {}
+    paths = [path for prepared in prepared_reruns for path in prepared.input_files]
+    missing, unknown = cache.get(conn.host, paths)
+    if unknown:
+        with stage("preflight"):
+            resp = await conn.run(stat_cmd(unknown))
+        missing |= _checked_missing(cache, conn.host, unknown, resp)
+    return _missing_by_rerun(prepared_reruns, missing)
+
+
+def check_inputs(missing, case_id):
+    """Raise if input files of a case are missing."""
+    if case_id in missing:
+        files = ", ".join(missing[case_id])
+        raise MissingInputFilesError(f'Input files of case "{case_id}" are missing: {files}')
+
+
+def init_preflight():
+    """Initialize checking of input files from flask, disabled unless WORKFLOW_PREFLIGHT."""
+    cnf = current_app.config
+    cache = None
+    if cnf.get("WORKFLOW_PREFLIGHT", False):
+        cache = PreflightCache(ttl=cnf.get("WORKFLOW_PREFLIGHT_TTL", 60))
+    cnf["PREFLIGHT_CACHE"] = cache
+
+
+def get_preflight_cache():
+    """Get the cache of checked input files, None if the check is disabled."""
+    return current_app.config.get("PREFLIGHT_CACHE")
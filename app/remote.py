@@ -0,0 +1,462 @@
+"""Pooled SSH connections to the workflow host."""
+import asyncio
+import logging
+import os
+import shlex
+import threading
+import time
+import uuid
+from collections import defaultdict
+from contextlib import asynccontextmanager, contextmanager
+
+from fabric import Connection
+from flask import current_app
+from paramiko.ssh_exception import SSHException
+
+from .breaker import retry, retry_async
+from .exceptions import ConnectionPoolTimeout, SSHKeyException
+from .jobs import stage
+from .metrics import REGISTRY, Sampled
+
+try:  # only required when reruns are run asynchronously
+    import asyncssh
+except ImportError:
+    asyncssh = None
+
+LOG = logging.getLogger(__name__)
+
+_POOL = None
+_POOL_LOCK = threading.Lock()
+_ASYNC_POOL = None
+
+# errors of connections to the remote that are worth retrying
+CONNECT_ERRORS = (OSError, EOFError, SSHException)
+
+
+class ConnectionPool(object):
+    """Thread safe pool of open SSH connections.
+
+    Connections are keyed by (host, user, key files) and kept open with SSH
+    keepalives. Idle connections are closed after `idle_timeout` seconds and
+    at most `max_size` connections are opened per key. Opening a connection
+    is retried `connect_retries` times with exponential backoff.
+    """
+
+    def __init__(
+        self,
+        max_size=4,
+        idle_timeout=300,
+        keepalive=30,
+        acquire_timeout=30,
+        connect_retries=0,
+        retry_backoff=1,
+    ):
+        self.max_size = max_size
+        self.connect_retries = connect_retries
+        self.retry_backoff = retry_backoff
+        self.idle_timeout = idle_timeout
+        self.keepalive = keepalive
+        self.acquire_timeout = acquire_timeout
+        self._cond = threading.Condition()
+        self._idle = defaultdict(list)  # key -> [(connection, last used)]
+        self._n_open = defaultdict(int)  # key -> number of open connections
+        self._keys = {}  # id(connection) -> key
+        self._reaper = None
+        self._closed = False
+
+    @staticmethod
+    def make_key(host, user, connect_kwargs):
+        """Build the pool key of a connection."""
+        key_files = connect_kwargs.get("key_filename") or []
+        if isinstance(key_files, str):
+            key_files = [key_files]
+        return (host, user, tuple(str(fname) for fname in key_files))
+
+    @staticmethod
+    def is_healthy(connection):
+        """Check that the transport of a connection is still usable."""
+        try:
+            transport = connection.transport
+            if not connection.is_connected or transport is None or not transport.is_active():
+                return False
+            transport.send_ignore()  # cheap round trip on the transport
+        except Exception as err:
+            LOG.debug(f"Health check of {connection.host} failed: {err}")
+            return False
+        return True
+
+    def _open(self, host, user, connect_kwargs):
+        """Open a new connection and enable keepalives."""
+        LOG.info(f"Connecting to remote: {user}@{host}")
+        connection = Connection(host=host, user=user, connect_kwargs=connect_kwargs)
+        connection.open()
+        if self.keepalive:
+            connection.transport.set_keepalive(self.keepalive)
+        return connection
+
+    def _close(self, key, connection):
+        """Close a connection, the pool lock must be held."""
+        self._n_open[key] -= 1
+        self._keys.pop(id(connection), None)
+        try:
+            connection.close()
+        except Exception as err:
+            LOG.debug(f"Error when closing connection to {connection.host}: {err}")
+
+    def acquire(self, host, user, connect_kwargs):
+        """Borrow a connection from the pool, open a new one if needed.
+
+        Idle connections are checked outside the lock, the check is a round trip.
+        """
+        key = self.make_key(host, user, connect_kwargs)
+        deadline = time.monotonic() + self.acquire_timeout
+        while True:
+            with self._cond:
+                self._start_reaper()
+                while not self._idle[key] and self._n_open[key] >= self.max_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise ConnectionPoolTimeout(
+                            f"No free connection to {user}@{host} within {self.acquire_timeout}s"
+                        )
+                    self._cond.wait(remaining)
+                if not self._idle[key]:
+                    self._n_open[key] += 1
+                    break
+                # reuse the most recently used connection if healthy
+                connection, _ = self._idle[key].pop()
+            if self.is_healthy(connection):
+                LOG.debug(f"Reusing pooled connection to {user}@{host}")
+                return connection
+            LOG.info(f"Discarding stale connection to {user}@{host}")
+            with self._cond:
+                self._close(key, connection)
+
+        # open the connection outside the lock, the handshake is slow
+        try:
+            connection = retry(
+                lambda: self._open(host, user, connect_kwargs),
+                CONNECT_ERRORS,
+                retries=self.connect_retries,
+                backoff=self.retry_backoff,
+                name=f"Connecting to {user}@{host}",
+            )
+        except Exception:
+            with self._cond:
+                self._n_open[key] -= 1
+                self._cond.notify()
+            raise
+        with self._cond:
+            self._keys[id(connection)] = key
+        return connection
+
+    def release(self, connection, healthy=None):
+        """Return a borrowed connection to the pool, its health is checked unless known."""
+        if healthy is None:
+            healthy = self.is_healthy(connection)  # checked outside the lock
+        with self._cond:
+            key = self._keys.get(id(connection))
+            if key is None:  # not from this pool
+                return
+            if not healthy or self._closed:
+                self._close(key, connection)
+            else:
+                self._idle[key].append((connection, time.monotonic()))
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self, host, user, connect_kwargs):
+        """Borrow a connection for the duration of a with block."""
+        with stage("ssh_connect", {"net.peer.name": host, "net.peer.user": user}):
+            connection = self.acquire(host, user, connect_kwargs)
+        try:
+            yield connection
+        except Exception:
+            # the transport state is unknown after an error
+            self.release(connection, healthy=self.is_healthy(connection))
+            raise
+        else:
+            self.release(connection)
+
+    def evict_idle(self):
+        """Close connections that have been idle longer than the idle timeout."""
+        now = time.monotonic()
+        with self._cond:
+            for key, entries in self._idle.items():
+                keep = []
+                for connection, last_used in entries:
+                    if now - last_used > self.idle_timeout:
+                        LOG.info(f"Closing idle connection to {connection.host}")
+                        self._close(key, connection)
+                    else:
+                        keep.append((connection, last_used))
+                entries[:] = keep
+            self._cond.notify_all()
+
+    def _start_reaper(self):
+        """Start background eviction of idle connections, the lock must be held."""
+        if self._reaper is not None or not self.idle_timeout:
+            return
+
+        def reap():
+            while not self._closed:
+                time.sleep(min(self.idle_timeout, 60))
+                self.evict_idle()
+
+        self._reaper = threading.Thread(target=reap, name="ssh-pool-reaper", daemon=True)
+        self._reaper.start()
+
+    def stats(self):
+        """Summarize the number of open and idle connections per host."""
+        with self._cond:
+            return {
+                f"{key[1]}@{key[0]}": {"open": n_open, "idle": len(self._idle[key])}
+                for key, n_open in self._n_open.items()
+            }
+
+    def close(self):
+        """Close all idle connections and stop pooling."""
+        with self._cond:
+            self._closed = True
+            for key, entries in self._idle.items():
+                for connection, _ in entries:
+                    self._close(key, connection)
+                entries.clear()
+            self._cond.notify_all()
+
+
+class AsyncResult(object):
+    """Outcome of a command run over an asyncssh connection."""
+
+    def __init__(self, completed):
+        self.exit_status = completed.exit_status
+        self.stdout = completed.stdout or ""
+        self.stderr = completed.stderr or ""
+
+    @property
+    def failed(self):
+        return self.exit_status != 0
+
+
+class AsyncConnection(object):
+    """Non-blocking SSH connection with the interface used by the reruns."""
+
+    def __init__(self, connection, host, user, connect_kwargs):
+        self.connection = connection
+        self.host = host
+        self.user = user
+        self.connect_kwargs = connect_kwargs
+
+    async def run(self, cmd):
+        """Run a command on the remote, errors are reported by the result."""
+        return AsyncResult(await self.connection.run(cmd, check=False))
+
+
+def _import_asyncssh():
+    """Get asyncssh, an error if it is not installed."""
+    if asyncssh is None:
+        raise ImportError("Asynchronous reruns require asyncssh, install scout-rerunner[async]")
+    return asyncssh
+
+
+def asyncssh_error():
+    """Base class of asyncssh errors."""
+    return _import_asyncssh().Error
+
+
+def transport_errors():
+    """Errors of connections to the remote, with those of asyncssh if installed."""
+    return CONNECT_ERRORS if asyncssh is None else (*CONNECT_ERRORS, asyncssh.Error)
+
+
+class AsyncConnectionPool(object):
+    """SSH connections shared by coroutines.
+
+    One connection is opened per key and commands are multiplexed as
+    channels over it, at most `max_sessions` at the same time. The pool must
+    only be used from one event loop.
+    """
+
+    def __init__(
+        self, max_sessions=10, keepalive=30, known_hosts=None, connect_retries=0, retry_backoff=1
+    ):
+        self.max_sessions = max_sessions
+        self.connect_retries = connect_retries
+        self.retry_backoff = retry_backoff
+        self.keepalive = keepalive
+        self.known_hosts = known_hosts
+        self._connections = {}  # key -> asyncssh connection
+        self._sessions = {}  # key -> semaphore limiting concurrent channels
+        self._n_sessions = defaultdict(int)  # key -> number of borrowed sessions
+        self._locks = defaultdict(asyncio.Lock)
+
+    async def _open(self, host, user, connect_kwargs):
+        """Open a new connection."""
+        LOG.info(f"Connecting to remote: {user}@{host}")
+        kwargs = {"username": user, "keepalive_interval": self.keepalive}
+        key_files = [fname for fname in connect_kwargs.get("key_filename") or [] if fname]
+        if key_files:  # otherwise use the ssh agent
+            kwargs.update(client_keys=key_files, passphrase=connect_kwargs.get("passphrase"))
+        if self.known_hosts is not None:
+            kwargs["known_hosts"] = self.known_hosts
+        return await _import_asyncssh().connect(host, **kwargs)
+
+    async def acquire(self, host, user, connect_kwargs):
+        """Get the open connection of a key and a free session on it."""
+        key = ConnectionPool.make_key(host, user, connect_kwargs)
+        async with self._locks[key]:
+            connection = self._connections.get(key)
+            if connection is None or connection.is_closed():
+                connection = await retry_async(
+                    lambda: self._open(host, user, connect_kwargs),
+                    (*CONNECT_ERRORS, asyncssh_error()),
+                    retries=self.connect_retries,
+                    backoff=self.retry_backoff,
+                    name=f"Connecting to {user}@{host}",
+                )
+                self._connections[key] = connection
+                self._sessions.setdefault(key, asyncio.Semaphore(self.max_sessions))
+        await self._sessions[key].acquire()
+        self._n_sessions[key] += 1
+        return AsyncConnection(connection, host, user, connect_kwargs)
+
+    def release(self, connection):
+        """Free the session of a connection, drop the connection if it was lost."""
+        key = ConnectionPool.make_key(connection.host, connection.user, connection.connect_kwargs)
+        self._sessions[key].release()
+        self._n_sessions[key] -= 1
+        if connection.connection.is_closed() and self._connections.get(key) is connection.connection:
+            LOG.info(f"Lost connection to {connection.user}@{connection.host}")
+            del self._connections[key]
+
+    @asynccontextmanager
+    async def connection(self, host, user, connect_kwargs):
+        """Borrow a session on a connection for the duration of a with block."""
+        with stage("ssh_connect", {"net.peer.name": host, "net.peer.user": user}):
+            connection = await self.acquire(host, user, connect_kwargs)
+        try:
+            yield connection
+        finally:
+            # the connection is shared, it is only dropped if it was closed
+            self.release(connection)
+
+    def stats(self):
+        """Summarize the number of open connections and sessions per host."""
+        return {
+            f"{key[1]}@{key[0]}": {"open": 1, "sessions": self._n_sessions[key]}
+            for key in self._connections
+        }
+
+    def close(self):
+        """Close all connections."""
+        for connection in self._connections.values():
+            connection.close()
+        self._connections.clear()
+
+
+def get_connect_kwargs():
+    """Get SSH options for connecting to the remote."""
+    cnf = current_app.config
+    kwargs = {
+        "passphrase": cnf.get("SSH_PASSPHRASE"),
+        "key_filename": [cnf.get("SSH_KEY_FILENAME")],
+    }
+    if (
+        any(fname is None for fname in kwargs["key_filename"])
+        and os.environ.get("SSH_AGENT_PID") is None
+    ):
+        raise SSHKeyException("No SSH key specified.")
+    return kwargs
+
+
+def heredoc_cmd(path, content):
+    """Build shell command writing a file on the remote with a here document."""
+    delimiter = f"EOF_{uuid.uuid4().hex}"
+    if not content.endswith("\n"):
+        content += "\n"
+    return f"cat > {shlex.quote(str(path))} <<'{delimiter}'\n{content}{delimiter}"
+
+
+def write_files_cmd(files):
+    """Build shell command writing files on the remote with here documents."""
+    lines = ["set -e"]
+    for path, content in files.items():
+        lines.append(heredoc_cmd(path, content))
+    return "\n".join(lines)
+
+
+def get_pool():
+    """Get the connection pool of the current process."""
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is None:
+            cnf = current_app.config
+            _POOL = ConnectionPool(
+                max_size=cnf.get("SSH_POOL_MAX_SIZE", 4),
+                idle_timeout=cnf.get("SSH_POOL_IDLE_TIMEOUT", 300),
+                keepalive=cnf.get("SSH_KEEPALIVE_INTERVAL", 30),
+                acquire_timeout=cnf.get("SSH_POOL_ACQUIRE_TIMEOUT", 30),
+                connect_retries=cnf.get("SSH_CONNECT_RETRIES", 2),
+                retry_backoff=cnf.get("SSH_RETRY_BACKOFF", 1),
+            )
+        return _POOL
+
+
+def get_async_pool():
+    """Get the asynchronous connection pool of the current process."""
+    global _ASYNC_POOL
+    if _ASYNC_POOL is None:
+        cnf = current_app.config
+        _ASYNC_POOL = AsyncConnectionPool(
+            max_sessions=cnf.get("SSH_MAX_SESSIONS", 10),
+            keepalive=cnf.get("SSH_KEEPALIVE_INTERVAL", 30),
+            known_hosts=cnf.get("SSH_KNOWN_HOSTS"),
+            connect_retries=cnf.get("SSH_CONNECT_RETRIES", 2),
+            retry_backoff=cnf.get("SSH_RETRY_BACKOFF", 1),
+        )
+    return _ASYNC_POOL
+
+
+def _pool_connections():
+    """Number of open and idle pooled connections per remote."""
+    if _POOL is None:
+        return {}
+    return {
+        (remote, state): count
+        for remote, counts in _POOL.stats().items()
+        for state, count in counts.items()
+    }
+
+
+REGISTRY.register(
+    Sampled(
+        "rerunner_ssh_connections",
+        "Pooled SSH connections.",
+        _pool_connections,
+        labels=["remote", "state"],
+    )
+)
+
+
+def close_pool():
+    """Close and drop the connection pools of the current process."""
+    global _POOL, _ASYNC_POOL
+    with _POOL_LOCK:
+        if _POOL is not None:
+            _POOL.close()
+        _POOL = None
+    if _ASYNC_POOL is not None:
+        _ASYNC_POOL.close()
+    _ASYNC_POOL = None
+
+
+def _reset_pool_after_fork():
+    """Drop the inherited pool, SSH transports can not be shared between processes."""
+    global _POOL, _POOL_LOCK, _ASYNC_POOL
+    _POOL = None
+    _ASYNC_POOL = None
+    _POOL_LOCK = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_pool_after_fork)
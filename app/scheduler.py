@@ -0,0 +1,100 @@
+"""Limits on concurrent submissions to the workflow hosts."""
+import asyncio
+import logging
+import threading
+from collections import defaultdict
+from contextlib import asynccontextmanager, contextmanager
+
+from flask import current_app
+
+from .jobs import stage
+
+LOG = logging.getLogger(__name__)
+
+
+class HostLimiter(object):
+    """Cap the number of reruns submitted to each host at the same time.
+
+    Reruns run on threads wait in `slot` and reruns run as coroutines in
+    `slot_async`, the two are limited separately.
+    """
+
+    def __init__(self, max_per_host=2):
+        self.max_per_host = max_per_host
+        self._semaphores = defaultdict(lambda: threading.BoundedSemaphore(self.max_per_host))
+        self._async_semaphores = {}  # host -> asyncio semaphore
+        self._active = defaultdict(int)  # host -> number of running submissions
+        self._waiting = defaultdict(int)  # host -> number of waiting submissions
+        self._lock = threading.Lock()
+
+    def _count(self, counter, host, value):
+        with self._lock:
+            counter[host] += value
+
+    @contextmanager
+    def slot(self, host):
+        """Wait for a free submission slot of host."""
+        if not self.max_per_host:
+            yield
+            return
+        with self._lock:
+            semaphore = self._semaphores[host]
+        self._count(self._waiting, host, 1)
+        try:
+            with stage("wait_for_host"):
+                semaphore.acquire()
+        finally:
+            self._count(self._waiting, host, -1)
+        self._count(self._active, host, 1)
+        try:
+            yield
+        finally:
+            self._count(self._active, host, -1)
+            semaphore.release()
+
+    @asynccontextmanager
+    async def slot_async(self, host):
+        """Wait for a free submission slot of host without blocking the event loop."""
+        if not self.max_per_host:
+            yield
+            return
+        semaphore = self._async_semaphores.get(host)
+        if semaphore is None:
+            semaphore = self._async_semaphores[host] = asyncio.Semaphore(self.max_per_host)
+        self._count(self._waiting, host, 1)
+        try:
+            with stage("wait_for_host"):
+                await semaphore.acquire()
+        finally:
+            self._count(self._waiting, host, -1)
+        self._count(self._active, host, 1)
+        try:
+            yield
+        finally:
+            self._count(self._active, host, -1)
+            semaphore.release()
+
+    def stats(self):
+        """Summarize running and waiting submissions per host."""
+        with self._lock:
+            hosts = set(self._active) | set(self._waiting)
+            return {
+                host: {
+                    "limit": self.max_per_host,
+                    "active": self._active[host],
+                    "waiting": self._waiting[host],
+                }
+                for host in sorted(hosts)
+            }
+
+
+def init_scheduler():
+    """Initialize limits on submissions from flask."""
+    current_app.config["HOST_LIMITER"] = HostLimiter(
+        max_per_host=current_app.config.get("WORKFLOW_MAX_SUBMISSIONS", 2)
+    )
+
+
+def get_host_limiter():
+    """Get the submission limits of the app."""
+    return current_app.config["HOST_LIMITER"]
@@ -0,0 +1,316 @@
+"""Persistent history of reruns in an embedded SQLite database."""
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+import attr
+from flask import current_app
+
+LOG = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    case_id TEXT NOT NULL,
+    func TEXT NOT NULL,
+    params TEXT NOT NULL,
+    state TEXT NOT NULL,
+    priority INTEGER NOT NULL DEFAULT 0,
+    submitted REAL NOT NULL,
+    started REAL,
+    finished REAL,
+    stages TEXT,
+    result TEXT,
+    error TEXT,
+    status_code INTEGER,
+    launches TEXT,
+    owner TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_submitted ON jobs (submitted);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state);
+CREATE TABLE IF NOT EXISTS job_cases (
+    job_id TEXT NOT NULL REFERENCES jobs (id),
+    case_id TEXT NOT NULL,
+    PRIMARY KEY (job_id, case_id)
+);
+CREATE INDEX IF NOT EXISTS job_cases_case_id ON job_cases (case_id);
+CREATE TABLE IF NOT EXISTS reruns (
+    id INTEGER PRIMARY KEY,
+    job_id TEXT,
+    case_id TEXT NOT NULL,
+    rerun_group_id TEXT NOT NULL,
+    host TEXT,
+    run_data_path TEXT,
+    run_data TEXT,
+    pedigree TEXT,
+    command TEXT,
+    changes TEXT,
+    created REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS reruns_case_id ON reruns (case_id, created);
+CREATE INDEX IF NOT EXISTS reruns_created ON reruns (created);
+CREATE TABLE IF NOT EXISTS dedup_keys (
+    key TEXT PRIMARY KEY,
+    job_id TEXT NOT NULL,
+    fingerprint TEXT,
+    expires REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS owners (
+    token TEXT PRIMARY KEY,
+    host TEXT,
+    pid INTEGER,
+    heartbeat REAL NOT NULL
+);
+"""
+
+# columns of jobs stored as json
+JSON_COLUMNS = ("case_id", "params", "stages", "result", "launches")
+
+
+def func_name(func):
+    """Importable name of a function."""
+    return f"{func.__module__}.{func.__qualname__}"
+
+
+class JobStore(object):
+    """Jobs and submitted reruns stored in SQLite.
+
+    Each process and thread uses its own connection. Jobs are owned by the
+    process that runs them, jobs of processes that stopped updating their
+    heartbeat can be claimed by another process.
+    """
+
+    def __init__(self, path):
+        self.path = str(path)
+        self._local = threading.local()
+        self.token = None
+        self._pid = None
+        with self._connect() as conn:
+            conn.executescript(SCHEMA)
+
+    def _connect(self):
+        """Get the connection of the current thread, connections are not shared after fork."""
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._local = threading.local()
+            self.token = f"{socket.gethostname()}:{os.getpid()}:{time.time()}"
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return _Transaction(conn)
+
+    def save_job(self, job):
+        """Insert or update a job, it is owned by the current process."""
+        with self._connect() as conn:
+            conn.execute("BEGIN")
+            self._save_job(conn, job)
+
+    def _save_job(self, conn, job):
+        """Insert or update a job in the transaction of conn."""
+        row = {
+            "id": job.id,
+            "case_id": job.case_id,
+            "func": func_name(job.func),
+            "params": job.params,
+            "state": job.state,
+            "priority": job.priority,
+            "submitted": job.submitted,
+            "started": job.started,
+            "finished": job.finished,
+            "stages": dict(job.stages),
+            "result": job.result,
+            "error": job.error,
+            "status_code": job.status_code,
+            "launches": [attr.asdict(launch) for launch in job.launches],
+        }
+        for column in JSON_COLUMNS:
+            row[column] = json.dumps(row[column], default=str)
+        row["owner"] = self.token
+        columns = ", ".join(row)
+        values = ", ".join(f":{column}" for column in row)
+        conn.execute(f"INSERT OR REPLACE INTO jobs ({columns}) VALUES ({values})", row)
+        case_ids = job.case_id if isinstance(job.case_id, (list, tuple)) else [job.case_id]
+        conn.executemany(
+            "INSERT OR IGNORE INTO job_cases (job_id, case_id) VALUES (?, ?)",
+            [(job.id, case_id) for case_id in case_ids],
+        )
+
+    def submit_job(self, job, keys, fingerprint, window, states, save=True):
+        """Find jobs submitted with any of the keys in the last window seconds or save job.
+
+        Keys of jobs not in states are ignored. Keys are looked up and the job
+        saved with its keys in one transaction, so processes sharing the
+        database start one job per key. Returns the rows of the jobs found,
+        with the key and its fingerprint, the job is saved if none was found
+        and save is set.
+        """
+        now = time.time()
+        placeholders = ", ".join("?" for _ in states)
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")  # one process submits at a time
+            found = []
+            for key in keys:
+                row = conn.execute(
+                    "SELECT jobs.*, dedup_keys.key AS dedup_key, "
+                    "dedup_keys.fingerprint AS dedup_fingerprint FROM dedup_keys "
+                    "JOIN jobs ON jobs.id = dedup_keys.job_id "
+                    "WHERE dedup_keys.key = ? AND dedup_keys.expires > ? "
+                    f"AND jobs.state IN ({placeholders})",
+                    [key, now, *states],
+                ).fetchone()
+                if row is not None:
+                    found.append(row)
+            if found or not save:
+                return [
+                    (self._job_row(row), row["dedup_key"], row["dedup_fingerprint"])
+                    for row in found
+                ]
+            self._save_job(conn, job)
+            conn.executemany(
+                "INSERT OR REPLACE INTO dedup_keys (key, job_id, fingerprint, expires) "
+                "VALUES (?, ?, ?, ?)",
+                [(key, job.id, fingerprint, now + window) for key in keys],
+            )
+            conn.execute("DELETE FROM dedup_keys WHERE expires <= ?", (now,))
+        return []
+
+    @staticmethod
+    def _job_row(row):
+        """Decode a row of the jobs table."""
+        job = dict(row)
+        for column in JSON_COLUMNS:
+            job[column] = json.loads(job[column]) if job[column] is not None else None
+        return job
+
+    def get_job(self, job_id):
+        """Get a stored job as a dict, None if it is not stored."""
+        with self._connect() as conn:
+            row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return None if row is None else self._job_row(row)
+
+    def list_jobs(self, case_id=None, state=None, since=None, until=None, limit=100):
+        """List stored jobs, most recent first."""
+        query = ["SELECT jobs.* FROM jobs"]
+        where, args = [], []
+        if case_id is not None:
+            query.append("JOIN job_cases ON job_cases.job_id = jobs.id")
+            where.append("job_cases.case_id = ?")
+            args.append(case_id)
+        for condition, value in (
+            ("jobs.state = ?", state),
+            ("jobs.submitted >= ?", since),
+            ("jobs.submitted < ?", until),
+        ):
+            if value is not None:
+                where.append(condition)
+                args.append(value)
+        if where:
+            query.append("WHERE " + " AND ".join(where))
+        query.append("ORDER BY jobs.submitted DESC LIMIT ?")
+        with self._connect() as conn:
+            rows = conn.execute(" ".join(query), [*args, limit]).fetchall()
+        return [self._job_row(row) for row in rows]
+
+    def record_rerun(self, job_id, prepared, host, run_data_path, command):
+        """Record the files and command of a rerun submitted to the remote."""
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO reruns (job_id, case_id, rerun_group_id, host, run_data_path, "
+                "run_data, pedigree, command, changes, created) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    job_id,
+                    prepared.case_id,
+                    prepared.rerun_group_id,
+                    host,
+                    str(run_data_path),
+                    prepared.run_data,
+                    prepared.pedigree,
+                    command,
+                    json.dumps(prepared.changes),
+                    time.time(),
+                ),
+            )
+
+    def list_reruns(self, case_id=None, since=None, until=None, job_id=None, limit=100):
+        """List submitted reruns, most recent first."""
+        where, args = [], []
+        for condition, value in (
+            ("case_id = ?", case_id),
+            ("created >= ?", since),
+            ("created < ?", until),
+            ("job_id = ?", job_id),
+        ):
+            if value is not None:
+                where.append(condition)
+                args.append(value)
+        query = "SELECT * FROM reruns"
+        if where:
+            query += " WHERE " + " AND ".join(where)
+        with self._connect() as conn:
+            rows = conn.execute(f"{query} ORDER BY created DESC LIMIT ?", [*args, limit])
+            reruns = [dict(row) for row in rows.fetchall()]
+        for rerun in reruns:
+            rerun["changes"] = json.loads(rerun["changes"])
+        return reruns
+
+    def heartbeat(self):
+        """Mark the current process as alive."""
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO owners (token, host, pid, heartbeat) VALUES (?, ?, ?, ?)",
+                (self.token, socket.gethostname(), os.getpid(), time.time()),
+            )
+
+    def claim_orphans(self, states, lease):
+        """Take ownership of unfinished jobs of processes without a recent heartbeat.
+
+        Returns the claimed jobs as dicts, oldest first.
+        """
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")  # one process claims at a time
+            placeholders = ", ".join("?" for _ in states)
+            rows = conn.execute(
+                f"SELECT * FROM jobs WHERE state IN ({placeholders}) AND (owner IS NULL OR "
+                "(owner != ? AND owner NOT IN (SELECT token FROM owners WHERE heartbeat >= ?))) "
+                "ORDER BY submitted",
+                [*states, self.token, time.time() - lease],
+            ).fetchall()
+            conn.executemany(
+                "UPDATE jobs SET owner = ? WHERE id = ?", [(self.token, row["id"]) for row in rows]
+            )
+            conn.execute("DELETE FROM owners WHERE heartbeat < ?", (time.time() - lease,))
+        return [self._job_row(row) for row in rows]
+
+
+class _Transaction(object):
+    """Commit or roll back explicit transactions of a connection in autocommit mode."""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.conn.in_transaction:
+            self.conn.execute("ROLLBACK" if exc_type else "COMMIT")
+
+
+def init_store():
+    """Initialize the job store from flask, disabled if JOB_STORE_PATH is not set."""
+    path = current_app.config.get("JOB_STORE_PATH")
+    current_app.config["JOB_STORE"] = JobStore(path) if path else None
+
+
+def get_job_store():
+    """Get the job store of the app, None if disabled."""
+    return current_app.config.get("JOB_STORE")
@@ -0,0 +1,278 @@
+"""Tracing of reruns with spans exported in the OpenTelemetry json format."""
+import json
+import logging
+import re
+import secrets
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+import attr
+from flask import current_app
+
+from .__version__ import __version__ as version
+
+LOG = logging.getLogger(__name__)
+
+SERVICE_NAME = "scout-rerunner"
+TRACEPARENT = re.compile(r"^[0-9a-f]{2}-([0-9a-f]{32})-([0-9a-f]{16})-[0-9a-f]{2}$")
+
+# OpenTelemetry span status codes
+STATUS_OK = 1
+STATUS_ERROR = 2
+
+_CURRENT_SPAN = ContextVar("current_span", default=None)
+
+
+def new_trace_id():
+    """Random trace id as 32 hex digits."""
+    return secrets.token_hex(16)
+
+
+def new_span_id():
+    """Random span id as 16 hex digits."""
+    return secrets.token_hex(8)
+
+
+def parse_traceparent(header):
+    """Get the trace id and parent span id of a W3C traceparent header, None if invalid."""
+    match = TRACEPARENT.match((header or "").strip().lower())
+    if match is None or set(match.group(1)) == {"0"} or set(match.group(2)) == {"0"}:
+        return None
+    return match.group(1), match.group(2)
+
+
+@attr.s()
+class Span(object):
+    """A timed operation in a trace, times are unix timestamps in nanoseconds."""
+
+    name = attr.ib(type=str)
+    trace_id = attr.ib(type=str)
+    parent_id = attr.ib(type=str, default=None)
+    id = attr.ib(type=str, factory=new_span_id)
+    start = attr.ib(type=int, factory=time.time_ns)
+    end = attr.ib(type=int, default=None)
+    attributes = attr.ib(factory=dict)
+    error = attr.ib(type=str, default=None)
+    finished = attr.ib(factory=list, repr=False, eq=False)  # finished spans of the trace
+
+    @property
+    def duration(self):
+        """Duration in seconds, until now if unfinished."""
+        return ((self.end or time.time_ns()) - self.start) / 1e9
+
+    def child(self, name, attributes=None, start=None):
+        """Start a span within this one."""
+        return Span(
+            name,
+            self.trace_id,
+            parent_id=self.id,
+            start=start or time.time_ns(),
+            attributes=dict(attributes or {}),
+            finished=self.finished,
+        )
+
+    def finish(self, end=None):
+        """End the span and add it to the finished spans of the trace."""
+        self.end = end or time.time_ns()
+        self.finished.append(self)
+
+    def to_otlp(self):
+        """Summarize span as OTLP json."""
+        otlp = {
+            "traceId": self.trace_id,
+            "spanId": self.id,
+            "name": self.name,
+            "kind": 1,  # internal
+            "startTimeUnixNano": str(self.start),
+            "endTimeUnixNano": str(self.end),
+            "attributes": _otlp_attributes(self.attributes),
+            "status": {"code": STATUS_OK}
+            if self.error is None
+            else {"code": STATUS_ERROR, "message": self.error},
+        }
+        if self.parent_id is not None:
+            otlp["parentSpanId"] = self.parent_id
+        return otlp
+
+
+def _otlp_value(value):
+    """Typed OTLP json value."""
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def _otlp_attributes(attributes):
+    """OTLP json key values of attributes, None values are left out."""
+    return [
+        {"key": key, "value": _otlp_value(value)}
+        for key, value in attributes.items()
+        if value is not None
+    ]
+
+
+def current_span():
+    """Get the span of the current thread or task, if any."""
+    return _CURRENT_SPAN.get()
+
+
+@contextmanager
+def span(name, attributes=None):
+    """Record a with block as a span of the current trace.
+
+    Nothing is recorded outside of a trace.
+    """
+    parent = _CURRENT_SPAN.get()
+    if parent is None:
+        yield None
+        return
+    child = parent.child(name, attributes)
+    token = _CURRENT_SPAN.set(child)
+    try:
+        yield child
+    except Exception as err:
+        child.error = f"{type(err).__name__} - {err}"
+        raise
+    finally:
+        _CURRENT_SPAN.reset(token)
+        child.finish()
+
+
+def breakdown(spans):
+    """Describe spans as an indented tree, one span per line."""
+    children = defaultdict(list)
+    ids = {item.id for item in spans}
+    for item in sorted(spans, key=lambda item: item.start):
+        children[item.parent_id if item.parent_id in ids else None].append(item)
+    lines = []
+
+    def describe(parent_id, depth):
+        for item in children[parent_id]:
+            attributes = " ".join(f"{key}={value}" for key, value in item.attributes.items())
+            error = f" error: {item.error}" if item.error else ""
+            lines.append(f"{'  ' * depth}{item.name} {item.duration:.3f}s {attributes}{error}")
+            describe(item.id, depth + 1)
+
+    describe(None, 0)
+    return "\n".join(line.rstrip() for line in lines)
+
+
+class Tracer(object):
+    """Record traces of reruns and export them when they finish.
+
+    Finished traces are appended to `export_path`, one OTLP json export
+    request per line as read by the otlpjsonfile receiver of the
+    OpenTelemetry collector. Traces longer than `slow_threshold` seconds are
+    logged with the duration of each span.
+    """
+
+    def __init__(self, export_path=None, slow_threshold=30, service_name=SERVICE_NAME):
+        self.export_path = export_path
+        self.slow_threshold = slow_threshold
+        self.service_name = service_name
+        self.exported = 0
+        self.slow = 0
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def trace(self, name, trace_id=None, parent_id=None, start=None, attributes=None):
+        """Record a with block as the root span of a trace, exported when it ends."""
+        root = Span(
+            name,
+            trace_id or new_trace_id(),
+            parent_id=parent_id,
+            start=start or time.time_ns(),
+            attributes=dict(attributes or {}),
+        )
+        token = _CURRENT_SPAN.set(root)
+        try:
+            yield root
+        except Exception as err:
+            root.error = f"{type(err).__name__} - {err}"
+            raise
+        finally:
+            root.finish()
+            self.export(root)
+            _CURRENT_SPAN.reset(token)
+
+    def to_otlp(self, spans):
+        """Summarize spans as an OTLP json export request."""
+        resource = {"service.name": self.service_name, "service.version": version}
+        return {
+            "resourceSpans": [
+                {
+                    "resource": {"attributes": _otlp_attributes(resource)},
+                    "scopeSpans": [
+                        {
+                            "scope": {"name": __name__, "version": version},
+                            "spans": [item.to_otlp() for item in spans],
+                        }
+                    ],
+                }
+            ]
+        }
+
+    def export(self, root):
+        """Write the spans of a finished trace and log it if slow."""
+        # the root first, spans starting at the same time keep the order they ended
+        spans = sorted(root.finished, key=lambda item: (item is not root, item.start))
+        slow = self.slow_threshold is not None and root.duration >= self.slow_threshold
+        with self._lock:
+            self.exported += 1
+            self.slow += slow
+        if slow:
+            LOG.warning(
+                f"Slow {root.name} took {root.duration:.3f}s, trace {root.trace_id}:\n"
+                f"{breakdown(spans)}"
+            )
+        if self.export_path is None:
+            return
+        line = json.dumps(self.to_otlp(spans), separators=(",", ":"))
+        try:
+            with self._lock, open(self.export_path, "a") as outpt:
+                outpt.write(f"{line}\n")
+        except OSError as err:  # tracing must not fail the rerun
+            LOG.error(f"Could not export trace {root.trace_id}: {err}")
+
+    def stats(self):
+        """Summarize exported traces."""
+        return {
+            "exported": self.exported,
+            "slow": self.slow,
+            "slow_threshold": self.slow_threshold,
+        }
+
+
+class TraceIdFilter(logging.Filter):
+    """Add the trace id of the current span to log records as trace_id."""
+
+    def filter(self, record):
+        current = _CURRENT_SPAN.get()
+        record.trace_id = "-" if current is None else current.trace_id
+        return True
+
+
+def init_tracer():
+    """Initialize tracing of reruns from flask, enabled unless TRACING is false."""
+    cnf = current_app.config
+    cnf["TRACER"] = (
+        Tracer(
+            export_path=cnf.get("TRACE_EXPORT_FILE"),
+            slow_threshold=cnf.get("TRACE_SLOW_THRESHOLD", 30),
+            service_name=cnf.get("TRACE_SERVICE_NAME", SERVICE_NAME),
+        )
+        if cnf.get("TRACING", True)
+        else None
+    )
+
+
+def get_tracer():
+    """Get the tracer of reruns, None if disabled."""
+    return current_app.config.get("TRACER")
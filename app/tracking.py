@@ -0,0 +1,257 @@
+"""Tracking of analyses launched detached on the remote."""
+import logging
+import os
+import shlex
+import threading
+import time
+from collections import defaultdict
+
+import attr
+from flask import current_app
+
+from .exceptions import PipelineExecutionError
+from .jobs import DONE, FAILED, LAUNCHED
+from .metrics import STAGE_DURATION
+from .remote import get_connect_kwargs, get_pool
+
+LOG = logging.getLogger(__name__)
+
+# max number of bytes of stdout and stderr collected from the remote
+OUTPUT_LIMIT = 65536
+
+
+@attr.s()
+class RemoteLaunch(object):
+    """An analysis started in the background on the remote."""
+
+    host = attr.ib(type=str)
+    user = attr.ib(type=str)
+    cmd = attr.ib(type=str)
+    pid = attr.ib(type=int)
+    stdout_path = attr.ib(type=str)
+    stderr_path = attr.ib(type=str)
+    exit_path = attr.ib(type=str)
+    started = attr.ib(type=float, factory=time.time)
+    state = attr.ib(type=str, default="running")  # running, done, failed or lost
+    exit_status = attr.ib(type=int, default=None)
+    stdout = attr.ib(type=str, default=None, repr=False)
+    stderr = attr.ib(type=str, default=None, repr=False)
+
+    @property
+    def is_finished(self):
+        """Check if the launched process has exited."""
+        return self.state != "running"
+
+    def to_json(self):
+        """Summarize launch as json."""
+        return {
+            "host": self.host,
+            "pid": self.pid,
+            "state": self.state,
+            "exit_status": self.exit_status,
+            "stdout_path": self.stdout_path,
+            "stderr_path": self.stderr_path,
+            "stdout": self.stdout,
+            "stderr": self.stderr,
+        }
+
+
+def detached_cmd(cmd, log_prefix):
+    """Wrap a command to run detached with nohup and setsid.
+
+    Stdout, stderr and exit status are written to files with log_prefix and
+    the command prints the pid of the detached process.
+    """
+    stdout, stderr, exit_path = (
+        shlex.quote(f"{log_prefix}.{ext}") for ext in ("out", "err", "exit")
+    )
+    inner = (
+        f"( {cmd} ) > {stdout} 2> {stderr}; "
+        f"echo $? > {exit_path}.tmp && mv {exit_path}.tmp {exit_path}"
+    )
+    return (
+        f"rm -f {exit_path}; "
+        f"setsid nohup sh -c {shlex.quote(inner)} > /dev/null 2>&1 < /dev/null & echo $!"
+    )
+
+
+def status_cmd(launches):
+    """Build one command reporting the state of many launches.
+
+    Prints one line per launch; <index> exit <status>, <index> running or
+    <index> lost if the process is gone without an exit status.
+    """
+    lines = []
+    for idx, launch in enumerate(launches):
+        exit_path = shlex.quote(launch.exit_path)
+        lines.append(
+            f'if [ -f {exit_path} ]; then echo "{idx} exit $(cat {exit_path})"; '
+            f'elif kill -0 {launch.pid} 2> /dev/null; then echo "{idx} running"; '
+            f'elif [ -f {exit_path} ]; then echo "{idx} exit $(cat {exit_path})"; '
+            f'else echo "{idx} lost"; fi'
+        )
+    return "\n".join(lines)
+
+
+class LaunchTracker(object):
+    """Poll the remote for launches to finish and update their jobs."""
+
+    def __init__(self, app, interval=30, error_handler=None):
+        self.app = app
+        self.interval = interval
+        self.error_handler = error_handler
+        self._tracked = {}  # job id -> (job, [(launch, result)])
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def track(self, job, launch, result):
+        """Track a launch of a job, the result is updated when it finishes."""
+        with self._lock:
+            self._start()
+            job.launches.append(launch)
+            self._tracked.setdefault(job.id, (job, []))[1].append((launch, result))
+        result["remote"] = launch.to_json()
+
+    def resume(self, job, launches):
+        """Track launches of a job recovered after a restart, launches are dicts."""
+        results = job.result if isinstance(job.result, list) else [job.result]
+        for launch in launches:
+            launch = RemoteLaunch(**launch)
+            result = next(
+                (
+                    res
+                    for res in results
+                    if isinstance(res, dict) and (res.get("remote") or {}).get("pid") == launch.pid
+                ),
+                {},
+            )
+            self.track(job, launch, result)
+
+    def _start(self):
+        """Start polling in the current process, the lock must be held."""
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        threading.Thread(target=self._poll_forever, name="launch-tracker", daemon=True).start()
+
+    def _poll_forever(self):
+        """Poll the remote until the process exits."""
+        while True:
+            time.sleep(self.interval)
+            try:
+                with self.app.app_context():
+                    self.poll()
+            except Exception as err:
+                LOG.error(f"Polling of remote launches failed: {type(err).__name__} - {err}")
+
+    def poll(self):
+        """Check state of all unfinished launches, one command per host."""
+        with self._lock:
+            tracked = list(self._tracked.values())
+        by_host = defaultdict(list)
+        for job, launches in tracked:
+            for launch, result in launches:
+                if not launch.is_finished:
+                    by_host[(launch.host, launch.user)].append((launch, result))
+
+        connect_kwargs = get_connect_kwargs() if by_host else None
+        for (host, user), launches in by_host.items():
+            with get_pool().connection(host, user, connect_kwargs) as conn:
+                self._poll_host(conn, launches)
+
+        for job, launches in tracked:
+            self._finish_job(job, launches)
+
+    def _poll_host(self, conn, launches):
+        """Update launches on one host, a launch shared by coalesced reruns is checked once."""
+        results = defaultdict(list)
+        for launch, result in launches:
+            results[id(launch)].append(result)
+        unique = list({id(launch): launch for launch, _ in launches}.values())
+        resp = conn.run(status_cmd(unique), hide=True, warn=True)
+        for line in resp.stdout.splitlines():
+            idx, state, *status = line.split()
+            launch = unique[int(idx)]
+            if state == "running":
+                continue
+            if state == "exit":
+                launch.exit_status = int(status[0]) if status else None
+                launch.state = "done" if launch.exit_status == 0 else "failed"
+                launch.stdout = self._read_output(conn, launch.stdout_path)
+                launch.stderr = self._read_output(conn, launch.stderr_path)
+            else:
+                launch.state = "lost"
+            LOG.info(f"Remote launch {launch.pid} on {launch.host} finished: {launch.state}")
+            for result in results[id(launch)]:
+                result["remote"] = launch.to_json()
+
+    @staticmethod
+    def _read_output(conn, path):
+        """Read the end of an output file on the remote."""
+        resp = conn.run(f"tail -c {OUTPUT_LIMIT} {shlex.quote(path)}", hide=True, warn=True)
+        return resp.stdout.strip()
+
+    def _finish_job(self, job, launches):
+        """Finish job when all of its launches are done, a failed launch fails the job.
+
+        A batch with failed launches is done if any of its launches succeeded,
+        the failed cases are marked in the results.
+        """
+        if job.state != LAUNCHED or not all(launch.is_finished for launch, _ in launches):
+            return
+        with self._lock:
+            self._tracked.pop(job.id, None)
+        elapsed = max(time.time() - launch.started for launch, _ in launches)
+        job.stages["remote_exec"] = round(elapsed, 6)
+        STAGE_DURATION.observe(elapsed, "remote_exec")
+        failed = [(launch, result) for launch, result in launches if launch.state != "done"]
+        if not failed:
+            job.finish(DONE)
+            return
+        errors = [self._describe_error(launch) for launch, _ in failed]
+        if not isinstance(job.result, list):
+            job.finish(FAILED, *errors[0])
+            return
+        # the failed cases of a batch are marked in their results
+        for (_, result), (error, status_code) in zip(failed, errors):
+            result["state"] = FAILED
+            result["error"], result["status_code"] = error, status_code
+        if len(failed) < len(launches):
+            job.finish(DONE)
+        else:
+            job.finish(FAILED, *errors[0])
+
+    def _describe_error(self, launch):
+        """Translate a failed launch into a message and status code."""
+        err = PipelineExecutionError(
+            {
+                "cmd": launch.cmd,
+                "exit_status": launch.exit_status,
+                "stdout": launch.stdout,
+                "stderr": launch.stderr,
+            }
+        )
+        if self.error_handler is None:
+            return f"{type(err).__name__} - {str(err)}", 500
+        return self.error_handler(err)
+
+
+def init_tracker(error_handler=None):
+    """Initialize tracking of remote launches from flask.
+
+    Launches of jobs recovered by the job manager are tracked.
+    """
+    tracker = LaunchTracker(
+        current_app._get_current_object(),
+        interval=current_app.config.get("REMOTE_POLL_INTERVAL", 30),
+        error_handler=error_handler,
+    )
+    manager = current_app.config.get("JOB_MANAGER")
+    if manager is not None:
+        manager.resume_launches = tracker.resume
+    current_app.config["LAUNCH_TRACKER"] = tracker
+
+
+def get_tracker():
+    """Get the launch tracker of the app."""
+    return current_app.config["LAUNCH_TRACKER"]
@@ -0,0 +1,242 @@
+"""Content addressed cache of the files uploaded to the remote.
+
+Uploaded files are hard linked, or copied, into a blob directory on the
+remote named by the sha256 of their content. Files with the same content as
+a blob are linked from the blob instead of being transfered again.
+"""
+import hashlib
+import io
+import logging
+import shlex
+import threading
+import time
+from pathlib import Path
+
+from flask import current_app
+
+from .exceptions import UploadError
+from .hosts import get_workflow_host
+from .jobs import stage
+from .remote import heredoc_cmd, write_files_cmd
+from .tracing import span
+
+LOG = logging.getLogger(__name__)
+
+# printed to stderr by upload commands when a blob thought to be cached is missing
+CACHE_MISS_MARKER = "RERUNNER_UPLOAD_CACHE_MISS"
+
+
+def digest(content):
+    """Hash the content of a file."""
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+def _link_cmd(source, target):
+    """Hard link source to target, copy if they are on different file systems."""
+    source, target = shlex.quote(str(source)), shlex.quote(str(target))
+    return f"{{ ln -f {source} {target} 2> /dev/null || cp {source} {target}; }}"
+
+
+class UploadIndex(object):
+    """Digests of the blobs on each remote host.
+
+    The index of a host is listed from the remote when it is older than ttl
+    seconds, in between blobs are assumed to exist until linking one fails.
+    Blobs are stored in blob_dir, by default .blobs in the data directory of
+    each workflow host.
+    """
+
+    def __init__(self, blob_dir=None, ttl=3600):
+        self.blob_dir = None if blob_dir is None else Path(blob_dir)
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._digests = {}  # host -> set of digests
+        self._refreshed = {}  # host -> time of last listing
+        self._lock = threading.Lock()
+
+    def blob_dir_of(self, host):
+        """Remote directory of the blobs of a host."""
+        if self.blob_dir is not None:
+            return self.blob_dir
+        return Path(get_workflow_host(host).data_dir) / ".blobs"
+
+    def blob_path(self, host, file_digest):
+        """Remote path of the blob of a digest."""
+        return self.blob_dir_of(host) / file_digest
+
+    def needs_refresh(self, host):
+        """Check if the index of host is missing or expired."""
+        refreshed = self._refreshed.get(host)
+        return refreshed is None or time.monotonic() - refreshed >= self.ttl
+
+    def refresh_cmd(self, host):
+        """Build shell command listing the blobs on the remote."""
+        blob_dir = shlex.quote(str(self.blob_dir_of(host)))
+        return f"mkdir -p {blob_dir} && ls -1 {blob_dir}"
+
+    def refresh(self, host, listing):
+        """Replace the digests of host with the output of refresh_cmd."""
+        digests = {name for name in listing.split() if len(name) == 64}
+        with self._lock:
+            self._digests[host] = digests
+            self._refreshed[host] = time.monotonic()
+        LOG.debug(f"Listed {len(digests)} uploaded files on {host}")
+
+    def cached(self, host, files):
+        """Get the digests of files that are stored on host."""
+        digests = {digest(content) for content in files.values()}
+        with self._lock:
+            cached = digests & self._digests.get(host, set())
+            self.hits += len(cached)
+            self.misses += len(digests) - len(cached)
+        return cached
+
+    def add(self, host, digests):
+        """Mark digests as stored on host."""
+        with self._lock:
+            self._digests.setdefault(host, set()).update(digests)
+
+    def discard(self, host, digests):
+        """Mark digests as missing on host."""
+        with self._lock:
+            self._digests.get(host, set()).difference_update(digests)
+
+    def write_files_cmd(self, host, files, cached=()):
+        """Build shell command writing files on the remote.
+
+        Files with a digest in cached are linked from their blobs and the
+        command fails with CACHE_MISS_MARKER if a blob is missing. Other
+        files are written with here documents and stored as blobs.
+        """
+        lines = ["set -e", f"mkdir -p {shlex.quote(str(self.blob_dir_of(host)))}"]
+        for path, content in files.items():
+            blob = self.blob_path(host, digest(content))
+            if blob.name in cached:
+                lines.append(
+                    f"{_link_cmd(blob, path)} 2> /dev/null || "
+                    f"{{ echo {CACHE_MISS_MARKER} >&2; exit 1; }}"
+                )
+            else:
+                lines.append(heredoc_cmd(path, content))
+                lines.append(_link_cmd(path, blob))
+        return "\n".join(lines)
+
+    def stats(self):
+        """Summarize usage of the index."""
+        with self._lock:
+            return {
+                "blobs": {host: len(digests) for host, digests in self._digests.items()},
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+def upload_cmd(host, files, cached):
+    """Build shell command writing files, cached is None if the upload cache is disabled."""
+    if cached is None:
+        return write_files_cmd(files)
+    return get_upload_index().write_files_cmd(host, files, cached)
+
+
+def prepare_upload(conn, files):
+    """Get the digests of files cached on the remote, None if the cache is disabled.
+
+    The index of the host is listed with one command when it has expired.
+    """
+    index = get_upload_index()
+    if index is None:
+        return None
+    if index.needs_refresh(conn.host):
+        with stage("upload_index"):
+            resp = conn.run(index.refresh_cmd(conn.host), hide=True, warn=True)
+        if not resp.failed:
+            index.refresh(conn.host, resp.stdout)
+    return index.cached(conn.host, files)
+
+
+async def prepare_upload_async(conn, files):
+    """Get the digests of files cached on the remote without blocking, see prepare_upload."""
+    index = get_upload_index()
+    if index is None:
+        return None
+    if index.needs_refresh(conn.host):
+        with stage("upload_index"):
+            resp = await conn.run(index.refresh_cmd(conn.host))
+        if not resp.failed:
+            index.refresh(conn.host, resp.stdout)
+    return index.cached(conn.host, files)
+
+
+def finish_upload(conn, files, cached, resp):
+    """Update the index with the outcome of an upload command.
+
+    Returns False if a cached blob was missing and the files must be
+    uploaded again without the cache.
+    """
+    index = get_upload_index()
+    if cached is None or index is None:
+        return True
+    if resp.failed and CACHE_MISS_MARKER in resp.stderr:
+        LOG.warning(f"Uploaded files missing on {conn.host}, uploading them again")
+        index.discard(conn.host, cached)
+        return False
+    if not resp.failed:
+        index.add(conn.host, [digest(content) for content in files.values()])
+    return True
+
+
+def _upload_attributes(conn, files):
+    """Span attributes of an upload of files with one command."""
+    return {"net.peer.name": conn.host, "files": len(files)}
+
+
+def upload_files(conn, files):
+    """Upload files with sftp, files already on the remote are linked from their blobs."""
+    cached = prepare_upload(conn, files)
+    if cached:
+        with span("upload_command", {**_upload_attributes(conn, files), "cached": len(cached)}):
+            resp = conn.run(upload_cmd(conn.host, files, cached), hide=True, warn=True)
+        if finish_upload(conn, files, cached, resp):
+            if resp.failed:  # not a missing blob, the files were not written
+                raise UploadError({"cmd": "upload", "stderr": resp.stderr.strip()})
+            return
+    for path, content in files.items():
+        data = content.encode()
+        attributes = {"net.peer.name": conn.host, "path": str(path), "bytes": len(data)}
+        with span("upload_file", attributes):
+            conn.put(io.BytesIO(data), remote=str(path))
+    index = get_upload_index()
+    if index is not None:  # store files as blobs
+        blobs = {path: index.blob_path(conn.host, digest(c)) for path, c in files.items()}
+        store_cmd = [f"mkdir -p {shlex.quote(str(index.blob_dir_of(conn.host)))}"]
+        store_cmd.extend(_link_cmd(path, blob) for path, blob in blobs.items())
+        resp = conn.run(" && ".join(store_cmd), hide=True, warn=True)
+        finish_upload(conn, files, set(), resp)
+
+
+async def upload_files_async(conn, files):
+    """Write files on the remote with one command, see upload_files."""
+    cached = await prepare_upload_async(conn, files)
+    with span("upload_command", _upload_attributes(conn, files)):
+        resp = await conn.run(upload_cmd(conn.host, files, cached))
+    if not finish_upload(conn, files, cached, resp):
+        with span("upload_command", _upload_attributes(conn, files)):
+            resp = await conn.run(upload_cmd(conn.host, files, set()))
+        finish_upload(conn, files, set(), resp)
+    if resp.failed:
+        raise UploadError({"cmd": "upload", "stderr": resp.stderr.strip()})
+
+
+def init_upload_index():
+    """Initialize the index of uploaded files from flask, disabled unless UPLOAD_CACHE is set."""
+    cnf = current_app.config
+    index = None
+    if cnf.get("UPLOAD_CACHE", False):
+        index = UploadIndex(cnf.get("UPLOAD_CACHE_DIR"), ttl=cnf.get("UPLOAD_INDEX_TTL", 3600))
+    cnf["UPLOAD_INDEX"] = index
+
+
+def get_upload_index():
+    """Get the index of uploaded files, None if disabled."""
+    return current_app.config.get("UPLOAD_INDEX")
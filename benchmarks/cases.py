@@ -0,0 +1,57 @@
+"""Synthetic Scout case documents for the benchmarks."""
+import random
+
+# number of individuals of the benchmarked cases, from a trio to large pedigrees
+CASE_SIZES = [3, 30, 300, 3000]
+
+
+def scout_case(size, seed=0):
+    """Build a case document of size individuals over generations.
+
+    The first three individuals are a trio, the parents of later individuals
+    are picked among the earlier ones.
+    """
+    rand = random.Random(seed)
+    individuals = []
+    males, females = [], []
+    for idx in range(size):
+        ind_id = f"ind-{idx}"
+        sex = "male" if idx == 1 else "female" if idx == 2 else rand.choice(["male", "female"])
+        if idx == 0:
+            mother, father = "ind-2", "ind-1"
+        elif idx < 3 or not (males and females):
+            mother, father = "0", "0"
+        else:
+            mother, father = rand.choice(females), rand.choice(males)
+        individuals.append(
+            {
+                "individual_id": ind_id,
+                "mother": mother,
+                "father": father,
+                "sex": sex,
+                "phenotype": rand.choice(["affected", "unaffected", "unknown"]),
+            }
+        )
+        (males if sex == "male" else females).append(ind_id)
+    return {
+        "_id": f"case-{size}",
+        "individuals": individuals,
+        "vcf_files": {
+            "vcf_snv": f"/data/case-{size}.snv.vcf.gz",
+            "vcf_sv": f"/data/case-{size}.sv.vcf.gz",
+            "vcf_str": f"/data/case-{size}.str.vcf.gz",
+        },
+    }
+
+
+def edited_metadata(case, seed=0):
+    """Modify the phenotype and sex of every individual of a case."""
+    rand = random.Random(seed)
+    return [
+        {
+            "sample_id": ind["individual_id"],
+            "sex": rand.randint(0, 2),
+            "phenotype": rand.randint(0, 2),
+        }
+        for ind in case["individuals"]
+    ]
@@ -0,0 +1,20 @@
+"""Fixtures of the benchmarks."""
+import pytest
+from flask import Flask
+
+from cases import CASE_SIZES, scout_case
+
+
+@pytest.fixture(params=CASE_SIZES, ids=lambda size: f"{size}_individuals")
+def case(request):
+    """A synthetic case of each size."""
+    return scout_case(request.param)
+
+
+@pytest.fixture(scope="session")
+def app():
+    """Bare flask app, the builders only read its configuration."""
+    app = Flask(__name__)
+    app.config["TESTING"] = False
+    with app.app_context():
+        yield app
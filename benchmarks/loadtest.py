@@ -0,0 +1,283 @@
+"""Load test reruns end to end against local stand-ins of the database and remote.
+
+The app is started in process with mongomock, or a local mongod with
+--mongo-uri, and an SSH/SFTP server on localhost standing in for the
+workflow host, see benchmarks/standin.py. A corpus of rerun requests is
+replayed through the REST api at a set concurrency and each rerun is
+followed until it has finished. Latency, throughput and errors are reported
+in total and per stage of the reruns.
+
+    python benchmarks/loadtest.py [--requests 200] [--concurrency 16] [--ssh-latency 0.02]
+    python benchmarks/loadtest.py --set WORKFLOW_PIPELINED_SUBMIT=true --json
+
+The corpus is generated from synthetic cases unless given with --corpus, a
+file with one request per line, {"case_id": .., "sample_ids": [..], "body": [..]}.
+Cases are then read from the database given by --mongo-uri.
+"""
+import argparse
+import base64
+import json
+import logging
+import random
+import statistics
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import yaml
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from app.app import create_app  # noqa: E402
+from standin import SSHStandIn, client_key  # noqa: E402
+
+FINISHED = ("done", "failed", "launched")
+USER, API_KEY = "loadtest@mail.com", "loadtest"
+VCF_KEYS = ("vcf_snv", "vcf_sv", "vcf_str")
+
+
+def _individual(ind_id, mother="0", father="0", sex="male", phenotype="unaffected"):
+    """Individual of a case document."""
+    return {
+        "individual_id": ind_id,
+        "mother": mother,
+        "father": father,
+        "sex": sex,
+        "phenotype": phenotype,
+    }
+
+
+def synthetic_case(case_id, family_size, data_dir):
+    """Build a case document of a trio and siblings, its vcf files are created."""
+    mother, father = f"{case_id}-3", f"{case_id}-2"
+    individuals = [
+        _individual(f"{case_id}-1", mother, father, phenotype="affected"),
+        _individual(father),
+        _individual(mother, sex="female"),
+    ][:family_size]
+    for idx in range(4, family_size + 1):
+        sex = random.choice(["male", "female"])
+        phenotype = random.choice(["affected", "unaffected"])
+        individuals.append(_individual(f"{case_id}-{idx}", mother, father, sex, phenotype))
+    vcf_files = {}
+    for key in VCF_KEYS:
+        path = data_dir / "vcf" / f"{case_id}.{key}.vcf.gz"
+        path.touch()
+        vcf_files[key] = str(path)
+    return {
+        "_id": case_id,
+        "case_id": case_id,
+        "owner": "loadtest",
+        "individuals": individuals,
+        "vcf_files": vcf_files,
+    }
+
+
+def synthetic_corpus(cases, num_requests):
+    """Build rerun requests that flip the phenotype of a random individual."""
+    sexes = {"unknown": 0, "male": 1, "female": 2}
+    requests = []
+    for _ in range(num_requests):
+        case = random.choice(cases)
+        edited = random.choice(case["individuals"])
+        requests.append(
+            {
+                "case_id": case["_id"],
+                "sample_ids": [ind["individual_id"] for ind in case["individuals"]],
+                "body": [
+                    {
+                        "sample_id": edited["individual_id"],
+                        "sex": sexes[edited["sex"]],
+                        "phenotype": 1 if edited["phenotype"] == "affected" else 2,
+                    }
+                ],
+            }
+        )
+    return requests
+
+
+def build_app(args, workdir, standin):
+    """Create the app configured for the stand-ins."""
+    data_dir = workdir / "data"
+    exec_script = workdir / "rescore.sh"
+    exec_script.write_text(f"#!/bin/sh\nsleep {args.exec_time}\n")
+    exec_script.chmod(0o755)
+    settings = {
+        "TESTING": True,
+        "SWAGGER_UI": False,
+        "API_SECRET_KEY": API_KEY,
+        "AUTHORIZED_USERS": [USER],
+        "WORKFLOW_HOST": standin.address,
+        "WORKFLOW_USER": "loadtest",
+        "WORKFLOW_DATA_DIR": str(data_dir),
+        "WORKFLOW_EXEC_SCRIPT": str(exec_script),
+        "SSH_KEY_FILENAME": client_key(workdir / "id_rsa"),
+        "RERUN_WORKERS": args.concurrency,
+        "RERUN_QUEUE_SIZE": max(args.requests, 100),
+        "RERUN_DEDUP_WINDOW": 0,  # replayed requests may repeat
+        "MONGO_DBNAME": "loadtest",
+    }
+    if args.mongo_uri:
+        settings["MONGO_HOST"] = args.mongo_uri
+    for setting in args.set:
+        key, _, value = setting.partition("=")
+        settings[key] = yaml.safe_load(value)
+    app = create_app(type("LoadTestConfig", (), settings))
+    # keep stages in the order they were run, failures are counted in the last stage
+    if hasattr(app, "json"):
+        app.json.sort_keys = False
+    else:
+        app.config["JSON_SORT_KEYS"] = False
+    logging.getLogger().setLevel(args.log_level)
+    if not args.mongo_uri:
+        import mongomock
+
+        app.config["MONGO_DATABASE"] = mongomock.MongoClient()["loadtest"]
+    return app
+
+
+def run_rerun(client, request, poll_interval):
+    """Submit a rerun and wait for it to finish, returns its outcome."""
+    credentials = base64.b64encode(f"{USER}:{API_KEY}".encode()).decode()
+    headers = {"Authorization": f"Basic {credentials}"}
+    query = [("case_id", request["case_id"])]
+    query += [("sample_ids", sample_id) for sample_id in request.get("sample_ids", [])]
+    start = time.perf_counter()
+    resp = client.post(
+        "/v1.0/rerun", query_string=query, json=request.get("body", []), headers=headers
+    )
+    if resp.status_code not in (200, 202):
+        job = {"state": "rejected", "status_code": resp.status_code, "stages": {}}
+    else:
+        job = resp.get_json()
+    while job["state"] not in (*FINISHED, "rejected"):
+        time.sleep(poll_interval)
+        job = client.get(f"/v1.0/rerun/{job['job_id']}", headers=headers).get_json()
+    return {
+        "latency": time.perf_counter() - start,
+        "state": job["state"],
+        "status_code": job["status_code"],
+        "stages": job["stages"],
+    }
+
+
+def percentiles(values):
+    """Get the 50th, 95th and 99th percentiles of values."""
+    if len(values) == 1:
+        return {f"p{pct}": values[0] for pct in (50, 95, 99)}
+    cuts = statistics.quantiles(values, n=100, method="inclusive")
+    return {"p50": cuts[49], "p95": cuts[94], "p99": cuts[98]}
+
+
+def summarize(outcomes, elapsed):
+    """Summarize latencies, throughput and errors in total and per stage."""
+    failed = [out for out in outcomes if out["state"] not in ("done", "launched")]
+    by_stage = defaultdict(list)
+    stage_errors = Counter()
+    for out in outcomes:
+        for name, duration in out["stages"].items():
+            by_stage[name].append(duration)
+        if out["state"] == "failed" and out["stages"]:
+            stage_errors[list(out["stages"])[-1]] += 1  # the stage the rerun failed in
+    return {
+        "requests": len(outcomes),
+        "elapsed": elapsed,
+        "throughput": len(outcomes) / elapsed,
+        "error_rate": len(failed) / len(outcomes),
+        "errors": dict(Counter(f"{out['state']} {out['status_code']}" for out in failed)),
+        "latency": percentiles([out["latency"] for out in outcomes]),
+        "stages": {
+            name: {
+                "count": len(durations),
+                "error_rate": stage_errors[name] / len(durations),
+                **percentiles(durations),
+            }
+            for name, durations in by_stage.items()
+        },
+    }
+
+
+def print_summary(summary):
+    """Print a summary as a table."""
+    latency = summary["latency"]
+    print(
+        f"{summary['requests']} reruns in {summary['elapsed']:.2f}s, "
+        f"{summary['throughput']:.1f} reruns/s, error rate {summary['error_rate']:.1%}"
+    )
+    for error, count in summary["errors"].items():
+        print(f"  {error}: {count}")
+    print(f"{'stage':<16}{'count':>7}{'p50':>10}{'p95':>10}{'p99':>10}{'errors':>9}")
+    print(
+        f"{'total':<16}{summary['requests']:>7}{latency['p50']:>10.4f}"
+        f"{latency['p95']:>10.4f}{latency['p99']:>10.4f}{summary['error_rate']:>9.1%}"
+    )
+    for name, stats in summary["stages"].items():
+        print(
+            f"{name:<16}{stats['count']:>7}{stats['p50']:>10.4f}{stats['p95']:>10.4f}"
+            f"{stats['p99']:>10.4f}{stats['error_rate']:>9.1%}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=200, help="number of reruns to replay")
+    parser.add_argument("--concurrency", type=int, default=16, help="reruns in flight")
+    parser.add_argument("--cases", type=int, default=50, help="number of synthetic cases")
+    parser.add_argument("--family-size", type=int, default=3, help="individuals per case")
+    parser.add_argument("--corpus", help="file with one rerun request per line")
+    parser.add_argument("--mongo-uri", help="local mongod, mongomock is used if not given")
+    parser.add_argument("--ssh-latency", type=float, default=0.02, help="seconds per command")
+    parser.add_argument("--exec-time", type=float, default=0.0, help="seconds to start a rerun")
+    parser.add_argument("--poll-interval", type=float, default=0.01)
+    parser.add_argument("--set", action="append", default=[], help="config KEY=VALUE")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--log-level", default="WARNING")
+    parser.add_argument("--json", action="store_true", help="print the summary as json")
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    standin = SSHStandIn(latency=args.ssh_latency).start()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        workdir = Path(tmpdir)
+        (workdir / "data" / "vcf").mkdir(parents=True)
+        app = build_app(args, workdir, standin)
+        with app.app_context():
+            cases_collection = app.config.get("MONGO_DATABASE")
+            if args.corpus:
+                with open(args.corpus) as inpt:
+                    corpus = [json.loads(line) for line in inpt if line.strip()]
+            else:
+                cases = [
+                    synthetic_case(f"load-{idx}", args.family_size, workdir / "data")
+                    for idx in range(args.cases)
+                ]
+                if cases_collection is None:  # local mongod
+                    from app.db import get_database
+
+                    cases_collection = get_database()
+                cases_collection.case.delete_many({"owner": "loadtest"})
+                cases_collection.case.insert_many(cases)
+                corpus = synthetic_corpus(cases, args.requests)
+        requests = [corpus[idx % len(corpus)] for idx in range(args.requests)]
+
+        client = app.test_client()
+        start = time.perf_counter()
+        with ThreadPoolExecutor(args.concurrency) as pool:
+            outcomes = list(
+                pool.map(lambda request: run_rerun(client, request, args.poll_interval), requests)
+            )
+        summary = summarize(outcomes, time.perf_counter() - start)
+    standin.stop()
+
+    if args.json:
+        print(json.dumps(summary, indent=2))
+    else:
+        print_summary(summary)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+"""In-process SSH and SFTP server standing in for a workflow host.
+
+Commands are run with bash on the local machine after a configurable
+delay, so the rerunner talks to it over real SSH connections with fabric.
+Any user and public key are accepted. Used by the load test, see
+benchmarks/loadtest.py.
+"""
+import logging
+import os
+import socket
+import subprocess
+import threading
+import time
+
+import paramiko
+
+LOG = logging.getLogger(__name__)
+
+
+class StandInServer(paramiko.ServerInterface):
+    """Accept any public key and run exec requests and the sftp subsystem."""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+
+    def get_allowed_auths(self, username):
+        return "publickey"
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        if kind == "session":
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED_OPEN_REQUEST
+
+    def check_channel_exec_request(self, channel, command):
+        threading.Thread(target=self._exec, args=(channel, command.decode()), daemon=True).start()
+        return True
+
+    def check_channel_pty_request(self, *args):
+        return True
+
+    def check_channel_env_request(self, channel, name, value):
+        return True
+
+    def _exec(self, channel, command):
+        """Run a command with bash after the simulated latency."""
+        time.sleep(self.latency)
+        try:
+            resp = subprocess.run(["bash", "-c", command], capture_output=True)
+            channel.sendall(resp.stdout)
+            channel.sendall_stderr(resp.stderr)
+            channel.send_exit_status(resp.returncode)
+        except Exception as err:  # the client went away
+            LOG.debug(f"Command failed: {err}")
+        finally:
+            channel.close()
+
+
+class LocalSFTPHandle(paramiko.SFTPHandle):
+    """Handle of an open local file."""
+
+    def stat(self):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+        except OSError as err:
+            return paramiko.SFTPServer.convert_errno(err.errno)
+
+
+class LocalSFTPServer(paramiko.SFTPServerInterface):
+    """Serve the local file system, paths are used as given."""
+
+    latency = 0.0
+
+    def session_started(self):
+        time.sleep(self.latency)
+
+    def _attrs(self, func, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(func(path))
+        except OSError as err:
+            return paramiko.SFTPServer.convert_errno(err.errno)
+
+    def stat(self, path):
+        return self._attrs(os.stat, path)
+
+    def lstat(self, path):
+        return self._attrs(os.lstat, path)
+
+    def list_folder(self, path):
+        try:
+            return [
+                paramiko.SFTPAttributes.from_stat(os.stat(os.path.join(path, name)), name)
+                for name in os.listdir(path)
+            ]
+        except OSError as err:
+            return paramiko.SFTPServer.convert_errno(err.errno)
+
+    def open(self, path, flags, attr):
+        try:
+            fd = os.open(path, flags, 0o644)
+            if flags & os.O_WRONLY:
+                mode = "ab" if flags & os.O_APPEND else "wb"
+            elif flags & os.O_RDWR:
+                mode = "a+b" if flags & os.O_APPEND else "r+b"
+            else:
+                mode = "rb"
+            fobj = os.fdopen(fd, mode)
+        except OSError as err:
+            return paramiko.SFTPServer.convert_errno(err.errno)
+        handle = LocalSFTPHandle(flags)
+        handle.filename = path
+        handle.readfile = handle.writefile = fobj
+        return handle
+
+    def remove(self, path):
+        return self._call(os.remove, path)
+
+    def rename(self, oldpath, newpath):
+        return self._call(os.rename, oldpath, newpath)
+
+    def posix_rename(self, oldpath, newpath):
+        return self._call(os.replace, oldpath, newpath)
+
+    def mkdir(self, path, attr):
+        return self._call(os.mkdir, path)
+
+    def rmdir(self, path):
+        return self._call(os.rmdir, path)
+
+    def chattr(self, path, attr):
+        return paramiko.SFTP_OK
+
+    @staticmethod
+    def _call(func, *args):
+        try:
+            func(*args)
+        except OSError as err:
+            return paramiko.SFTPServer.convert_errno(err.errno)
+        return paramiko.SFTP_OK
+
+
+class SSHStandIn(object):
+    """SSH server on a free local port, each connection is served by a thread.
+
+    latency is added before each command and sftp session, as the round trip
+    to a remote host.
+    """
+
+    def __init__(self, latency=0.0, host="127.0.0.1"):
+        self.latency = latency
+        self.host_key = paramiko.RSAKey.generate(2048)
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.bind((host, 0))
+        self._sock.listen(128)
+        self.address = f"{host}:{self._sock.getsockname()[1]}"
+        self._transports = []
+
+    def start(self):
+        """Accept connections in a background thread."""
+        threading.Thread(target=self._accept, name="ssh-standin", daemon=True).start()
+        return self
+
+    def _accept(self):
+        """Serve each new connection in a thread."""
+        while True:
+            try:
+                client, _ = self._sock.accept()
+            except OSError:  # closed
+                return
+            threading.Thread(target=self._serve, args=(client,), daemon=True).start()
+
+    def _serve(self, client):
+        """Negotiate a connection, its channels are served by the transport thread."""
+        sftp_server = type("SFTPServer", (LocalSFTPServer,), {"latency": self.latency})
+        transport = paramiko.Transport(client)
+        transport.add_server_key(self.host_key)
+        transport.set_subsystem_handler("sftp", paramiko.SFTPServer, sftp_server)
+        self._transports.append(transport)
+        try:
+            transport.start_server(server=StandInServer(self.latency))
+        except (paramiko.SSHException, EOFError) as err:
+            LOG.debug(f"Negotiation failed: {err}")
+
+    def stop(self):
+        """Stop accepting connections and close open ones."""
+        self._sock.close()
+        for transport in self._transports:
+            transport.close()
+
+
+def client_key(path):
+    """Write a private key for connecting to the stand-in, returns the path."""
+    paramiko.RSAKey.generate(2048).write_private_key_file(str(path))
+    return str(path)
@@ -0,0 +1,60 @@
+"""Benchmark cold starts of the app.
+
+Each start is measured in a new interpreter, as when a gunicorn worker is
+restarted without --preload. No database or remote is needed since they are
+connected on first use.
+
+    python benchmarks/startup.py [--runs 10] [--config config.yml]
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+START_APP = """
+import json, time
+start = time.perf_counter()
+from app.app import create_app
+imported = time.perf_counter()
+create_app(config_path={config!r})
+created = time.perf_counter()
+print(json.dumps({{"import": imported - start, "create_app": created - imported}}))
+"""
+
+
+def measure(config, runs):
+    """Start the app in new interpreters, returns the timings of each start."""
+    timings = []
+    for _ in range(runs):
+        resp = subprocess.run(
+            [sys.executable, "-c", START_APP.format(config=config)],
+            cwd=ROOT,
+            check=True,
+            capture_output=True,
+            text=True,
+        )
+        timings.append(json.loads(resp.stdout.strip().splitlines()[-1]))
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--config", default=str(ROOT / "config.yml"))
+    args = parser.parse_args()
+
+    timings = measure(args.config, args.runs)
+    for step in ("import", "create_app"):
+        values = [timing[step] for timing in timings]
+        print(
+            f"{step:<10} median {statistics.median(values):.3f}s "
+            f"min {min(values):.3f}s max {max(values):.3f}s"
+        )
+
+
+if __name__ == "__main__":
+    main()
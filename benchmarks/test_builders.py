@@ -0,0 +1,70 @@
+"""Benchmark building and serializing pedigrees and run data.
+
+Run with pytest-benchmark, results are saved to .benchmarks and compared
+with earlier runs:
+
+    pytest benchmarks --benchmark-autosave
+    pytest benchmarks --benchmark-compare --benchmark-compare-fail=median:15%
+"""
+import io
+
+import pytest
+from app.io import create_new_pedigree, create_rundata, diff_pedigree, rescored_vcf_types
+
+from cases import edited_metadata
+
+
+def _pedigree(case, edited=False):
+    """Build the pedigree of a case including all individuals."""
+    sample_ids = [ind["individual_id"] for ind in case["individuals"]]
+    body = edited_metadata(case) if edited else []
+    return create_new_pedigree(case["_id"], "group", sample_ids, body, case=case)
+
+
+@pytest.mark.benchmark(group="create_new_pedigree")
+@pytest.mark.parametrize("edited", [False, True], ids=["unedited", "edited"])
+def test_create_new_pedigree(benchmark, case, edited):
+    """Build pedigrees with and without modified metadata."""
+    sample_ids = [ind["individual_id"] for ind in case["individuals"]]
+    body = edited_metadata(case) if edited else []
+    family = benchmark(create_new_pedigree, case["_id"], "group", sample_ids, body, case=case)
+    assert len(family) == len(case["individuals"])
+
+
+@pytest.mark.benchmark(group="diff_pedigree")
+def test_diff_pedigree(benchmark, case):
+    """Compare an edited pedigree with the case."""
+    family = _pedigree(case, edited=True)
+    changes = benchmark(diff_pedigree, case, family)
+    assert changes
+
+
+@pytest.mark.benchmark(group="to_ped")
+def test_to_ped(benchmark, case):
+    """Serialize pedigrees to ped files."""
+    family = _pedigree(case)
+
+    def to_ped():
+        output = io.StringIO()
+        family.to_ped(output, write_header=False)
+        return output.getvalue()
+
+    assert benchmark(to_ped).count("\n") == len(case["individuals"])
+
+
+@pytest.mark.benchmark(group="to_json")
+def test_to_json(benchmark, case):
+    """Serialize pedigrees to json."""
+    family = _pedigree(case)
+    assert len(benchmark(family.to_json)) == len(case["individuals"])
+
+
+@pytest.mark.benchmark(group="create_rundata")
+@pytest.mark.parametrize("edited", [False, True], ids=["all_vcfs", "affected_vcfs"])
+def test_create_rundata(benchmark, app, case, edited):
+    """Build run data with all vcf files or those affected by the changes."""
+    vcf_types = None
+    if edited:
+        vcf_types = rescored_vcf_types(diff_pedigree(case, _pedigree(case, edited=True)))
+    rows = benchmark(create_rundata, case["_id"], "group", case=case, vcf_types=vcf_types)
+    assert len(rows) == 1
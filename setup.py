@@ -27,7 +27,7 @@ setup(
     include_package_data=True,
     zip_safe=False,
     install_requires=[
-        "flask>=1.1.2",
+        "flask>=2.2",
         "connexion>=2.7.0",
         "swagger-ui-bundle>=0.0.8",
         "ped-parser==1.6.6",
@@ -37,6 +37,7 @@ setup(
         "attr",
         "cattrs",
     ],
+    extras_require={"async": ["flask>=2.2", "motor", "asyncssh"]},
     setup_requires=["pytest-runner"],
     tests_require=["pytest", "mongomock"],
 )
@@ -6,6 +6,7 @@ import tempfile
 import connexion
 import pytest
 from app.app import create_app
+from app.remote import close_pool
 
 from .config import TestConfig
 
@@ -27,9 +28,47 @@ def app(mongodb):
         app.config[var] = val
 
     yield app
+    close_pool()  # drop pooled mock connections
 
 
 @pytest.fixture
 def client(app):
     """Setup client."""
     return app.test_client()
+
+
+class AsyncCursor(object):
+    """Iterate over the documents of a mongomock cursor asynchronously."""
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self.cursor)
+        except StopIteration:
+            raise StopAsyncIteration
+
+
+class AsyncCollection(object):
+    """Minimal stand-in of a motor collection."""
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    async def find_one(self, *args, **kwargs):
+        return self.collection.find_one(*args, **kwargs)
+
+    def find(self, *args, **kwargs):
+        return AsyncCursor(self.collection.find(*args, **kwargs))
+
+
+@pytest.fixture
+def async_database(app, mongodb):
+    """Use the test database through a non-blocking interface."""
+    database = type("AsyncDatabase", (), {"case": AsyncCollection(mongodb.case)})()
+    app.config["MONGO_ASYNC_DATABASE"] = database
+    return database
@@ -1,12 +1,31 @@
 """Test API functionality."""
+import asyncio
+import json
 from pathlib import Path
-from tempfile import TemporaryDirectory
-from unittest.mock import Mock
+from threading import get_ident
+from unittest.mock import AsyncMock, Mock
 
 import pytest
-from app.api import authenticate_user, conduct_reanalysis, run_rescore, build_new_case_id
-from app.exceptions import PipelineExecutionError, SSHKeyException
-from app.io import Family
+from app.api import (
+    authenticate_user,
+    batch_rerun_wrapper,
+    build_new_case_id,
+    conduct_batch_reanalysis,
+    conduct_batch_reanalysis_async,
+    conduct_reanalysis,
+    conduct_reanalysis_async,
+    pedigree_export,
+    queue_status,
+    rerun_preview,
+    request_hash,
+    rerun_status,
+    rerun_wrapper,
+    run_rescore,
+)
+from app.db import CaseNotFoundError, query_case, query_cases
+from app.exceptions import PipelineExecutionError, QueueFullError, SSHKeyException
+from app.io import Family, create_new_pedigree, create_rundata, diff_pedigree
+from app.store import JobStore
 from connexion.exceptions import OAuthProblem
 from fabric import Connection
 from invoke.runners import Result
@@ -28,19 +47,16 @@ def init_rerun_func(monkeypatch):
     )
     mock_pedigree = Mock(return_value=Mock(spec=Family))
     mock_runrescore = Mock()
-    # mock tempdir context manager
-    mock_tempdir = Mock(spec=TemporaryDirectory, return_value="directory")
-    mock_tempdir.return_value = Mock(__enter__=mock_tempdir, __exit__=Mock())
-    # mock connection context manager
+    # mock pooled connection
     mock_connection = Mock(spec=Connection)
-    mock_context = Mock(spec=Connection)
-    mock_connection.return_value = Mock(
-        __enter__=mock_context,
-        __exit__=Mock(),
-    )
+    mock_context = Mock(return_value=mock_connection.return_value)
     monkeypatch.setattr("app.api.create_rundata", mock_rundata)
     monkeypatch.setattr("app.api.create_new_pedigree", mock_pedigree)
-    monkeypatch.setattr("app.api.Connection", mock_connection)
+    monkeypatch.setattr(
+        "app.api.diff_pedigree",
+        Mock(return_value=[{"sample_id": "9075-18", "field": "sex", "old": 1, "new": 2}]),
+    )
+    monkeypatch.setattr("app.remote.Connection", mock_connection)
     monkeypatch.setattr("app.api.run_rescore", mock_runrescore)
 
     return mock_connection, mock_context, mock_rundata, mock_pedigree, mock_runrescore
@@ -100,6 +116,16 @@ def test_runrescore(app, monkeypatch):
         run_rescore(mock_connection, Path(path))
 
 
+def test_toggle_rerun_fetch_case_once(app, monkeypatch, init_rerun_func):
+    """Test that the case is fetched once and shared by the builders."""
+    mock_query_case = Mock(wraps=query_case)
+    monkeypatch.setattr("app.api.query_case", mock_query_case)
+    monkeypatch.setitem(app.config, "SSH_KEY_FILENAME", "/path/to/ssh-keys")
+
+    conduct_reanalysis("9075-18", sample_ids=["9075-18"])
+    mock_query_case.assert_called_once_with("9075-18")
+
+
 def test_toggle_rerun_success(app, monkeypatch, init_rerun_func):
     """
     Test the API entry point toggle_rerun.
@@ -133,9 +159,12 @@ def test_toggle_rerun_success(app, monkeypatch, init_rerun_func):
     conduct_reanalysis(case_id, new_case_id=new_case_id, sample_ids=sample_ids)
 
     # test that rundata was written
-    mock_rundata.assert_called_with(case_id, new_case_id)
+    case = query_case(case_id)
+    mock_rundata.assert_called_with(
+        case_id, new_case_id, case=case, vcf_types={"sv_vcf", "snv_vcf", "str_vcf"}
+    )
     # test that mock_pedigree
-    mock_pedigree.assert_called_with(case_id, new_case_id, sample_ids, [])
+    mock_pedigree.assert_called_with(case_id, new_case_id, sample_ids, [], case=case)
     # test setting up connection
     mock_connection.assert_called_with(
         host="http://worker.remote",
@@ -145,12 +174,30 @@ def test_toggle_rerun_success(app, monkeypatch, init_rerun_func):
             "passphrase": conect_conf["SSH_PASSPHRASE"],
         },
     )
-    # test transfering of files
-    assert mock_context.return_value.put.call_count == 2
+    # test transfering of files from memory
+    put = mock_context.return_value.put
+    assert put.call_count == 2
+    remote_paths = [call.kwargs["remote"] for call in put.call_args_list]
+    assert remote_paths[0].startswith("/data/dir/9075-18_") and remote_paths[0].endswith(".csv")
+    assert remote_paths[1] == remote_paths[0].replace(".csv", ".ped")
+    assert put.call_args_list[0].args[0].read().startswith(b"group,assay")
     # launching rerun on remote
     mock_runrescore.assert_called_once()
 
 
+def test_toggle_rerun_pipelined(app, monkeypatch, init_rerun_func):
+    """Test uploading files and starting the rerun in one remote command."""
+    mock_connection, _, _, _, mock_runrescore = init_rerun_func
+    monkeypatch.setitem(app.config, "SSH_KEY_FILENAME", "/path/to/ssh-keys")
+    monkeypatch.setitem(app.config, "WORKFLOW_PIPELINED_SUBMIT", True)
+
+    conduct_reanalysis("9075-18", sample_ids=["9075-18"])
+    mock_connection.return_value.put.assert_not_called()
+    (_, run_data_path), kwargs = mock_runrescore.call_args
+    assert sorted(path.suffix for path in kwargs["files"]) == [".csv", ".ped"]
+    assert kwargs["files"][run_data_path].startswith("group,assay")
+
+
 def test_toggle_rerun_ssh_key(app, monkeypatch, init_rerun_func):
     """Test the API entry point toggle_rerun ssh key failure."""
     (
@@ -170,3 +217,359 @@ def test_toggle_rerun_ssh_key(app, monkeypatch, init_rerun_func):
 
     with pytest.raises(SSHKeyException):
         conduct_reanalysis(case_id, sample_ids=sample_ids)
+
+
+def test_rerun_wrapper(app, client, monkeypatch):
+    """Test that reruns are queued and their status reported."""
+    mock_reanalysis = Mock(return_value={"rerun_group_id": "group"})
+    monkeypatch.setattr("app.api.conduct_reanalysis", mock_reanalysis)
+
+    with app.test_request_context("/v1.0/rerun"):
+        body, code, headers = rerun_wrapper("9075-18", sample_ids=["9075-18"])
+    assert code == 202
+    assert body["state"] == "queued"
+    assert headers["Location"].endswith(f"/rerun/{body['job_id']}")
+
+    app.config["JOB_MANAGER"].get(body["job_id"]).wait(5)
+    mock_reanalysis.assert_called_with("9075-18", sample_ids=["9075-18"])
+    with app.app_context():
+        status, code = rerun_status(body["job_id"])
+        assert code == 200
+        assert status["state"] == "done"
+        assert status["result"] == {"rerun_group_id": "group"}
+
+        # unknown job
+        assert rerun_status("not_a_job")[1] == 404
+
+
+def test_rerun_wrapper_traced(app, monkeypatch, init_rerun_func, tmp_path):
+    """Test that a rerun is traced from its submission to the remote command."""
+    mock_connection, *_ = init_rerun_func
+    mock_connection.return_value.run.return_value = Mock(failed=False, stdout="")
+    monkeypatch.setattr("app.api.run_rescore", run_rescore)
+    monkeypatch.setitem(app.config, "SSH_KEY_FILENAME", "/path/to/ssh-keys")
+    monkeypatch.setitem(app.config, "WORKFLOW_EXEC_SCRIPT", "rescore.sh")
+    export_path = tmp_path / "traces.jsonl"
+    monkeypatch.setattr(app.config["TRACER"], "export_path", str(export_path))
+
+    trace_id, parent_id = "4bf92f3577b34da6a3ce929d0e0e4736", "00f067aa0ba902b7"
+    headers = {"traceparent": f"00-{trace_id}-{parent_id}-01"}
+    with app.test_request_context("/v1.0/rerun", headers=headers):
+        body, *_ = rerun_wrapper("9075-18", sample_ids=["9075-18"])
+    assert body["trace_id"] == trace_id
+    app.config["JOB_MANAGER"].get(body["job_id"]).wait(5)
+
+    (line,) = export_path.read_text().splitlines()
+    spans = json.loads(line)["resourceSpans"][0]["scopeSpans"][0]["spans"]
+    names = [item["name"] for item in spans]
+    for name in ["rerun", "queue", "fetch_case", "mongo_query", "build_pedigree", "serialize"]:
+        assert name in names
+    for name in ["ssh_connect", "upload", "run_rescore", "remote_exec"]:
+        assert name in names
+    assert names.count("upload_file") == 2
+    assert spans[0]["name"] == "rerun" and spans[0]["parentSpanId"] == parent_id
+    assert {item["traceId"] for item in spans} == {trace_id}
+
+
+def test_rerun_wrapper_error(app, monkeypatch):
+    """Test that errors of a rerun are translated to status codes."""
+    monkeypatch.setattr(
+        "app.api.conduct_reanalysis", Mock(side_effect=CaseNotFoundError("Not found"))
+    )
+    with app.test_request_context("/v1.0/rerun"):
+        body, *_ = rerun_wrapper("Not a case_id")
+    job = app.config["JOB_MANAGER"].get(body["job_id"])
+    job.wait(5)
+    assert job.state == "failed"
+    assert (job.error, job.status_code) == ("Not found", 404)
+
+
+def test_batch_reanalysis(app, monkeypatch):
+    """Test that a batch is transfered over one connection with results per case."""
+    mock_connection = Mock(spec=Connection)
+    mock_runrescore = Mock()
+    monkeypatch.setattr("app.remote.Connection", mock_connection)
+    monkeypatch.setattr("app.api.run_rescore", mock_runrescore)
+    mock_query_cases = Mock(wraps=query_cases)
+    monkeypatch.setattr("app.api.query_cases", mock_query_cases)
+    monkeypatch.setitem(app.config, "SSH_KEY_FILENAME", "/path/to/ssh-keys")
+
+    reruns = [
+        {"case_id": "9075-18", "sample_ids": ["9075-18"]},
+        {"case_id": "missing_case", "sample_ids": ["9075-18"]},
+        {"case_id": "9075-18", "sample_ids": ["missing_sample"]},
+        {"case_id": "9075-18", "sample_ids": ["9075-18", "2112-19"], "body": []},
+    ]
+    with app.app_context():
+        results = conduct_batch_reanalysis(["9075-18", "missing_case"], reruns)
+
+    # one query and one connection
+    mock_query_cases.assert_called_once_with(["9075-18", "missing_case"])
+    mock_connection.assert_called_once()
+    # two pairs of files were transfered and started
+    assert mock_connection.return_value.put.call_count == 4
+    assert mock_runrescore.call_count == 2
+
+    assert [res["state"] for res in results] == ["done", "failed", "failed", "done"]
+    assert [res.get("status_code") for res in results] == [None, 404, 404, None]
+    assert results[0]["rerun_group_id"] == build_new_case_id("9075-18")
+
+
+def test_batch_reanalysis_pipeline_error(app, monkeypatch):
+    """Test that a failing rerun does not fail the rest of the batch."""
+    mock_runrescore = Mock(side_effect=[PipelineExecutionError("crash"), None])
+    monkeypatch.setattr("app.remote.Connection", Mock(spec=Connection))
+    monkeypatch.setattr("app.api.run_rescore", mock_runrescore)
+    monkeypatch.setitem(app.config, "SSH_KEY_FILENAME", "/path/to/ssh-keys")
+
+    reruns = [{"case_id": "9075-18", "sample_ids": ["9075-18"]}] * 2
+    with app.app_context():
+        results = conduct_batch_reanalysis(["9075-18"], reruns)
+    assert [res["state"] for res in results] == ["failed", "done"]
+    assert results[0]["status_code"] == 500
+
+
+def test_request_hash():
+    """Test that equivalent requests have the same hash."""
+    body = [{"sample_id": "a", "sex": 1, "phenotype": 2}, {"sample_id": "b", "sex": 0}]
+    reordered = [{"sex": "0", "sample_id": "b"}, {"phenotype": 2, "sample_id": "a", "sex": 1}]
+    assert request_hash("case", ["a", "b"], body) == request_hash("case", ["b", "a"], reordered)
+    assert request_hash("case", ["a"]) == request_hash("case", ["a"], [])
+    assert request_hash("case", ["a"]) != request_hash("case", ["a", "b"])
+    assert request_hash("case", ["a"]) != request_hash("other_case", ["a"])
+
+
+def test_rerun_wrapper_dedup(app, monkeypatch):
+    """Test that duplicated requests reuse the submitted rerun."""
+    monkeypatch.setattr("app.api.conduct_reanalysis", Mock())
+
+    def submit(sample_ids, headers={}):
+        with app.test_request_context("/v1.0/rerun", headers=headers):
+            body, code, *_ = rerun_wrapper("9075-18", sample_ids=sample_ids)
+        return body["job_id"] if code in (200, 202) else body, code
+
+    job_id, code = submit(["9075-18", "2112-19"])
+    assert code == 202
+    assert submit(["2112-19", "9075-18"]) == (job_id, 200)
+    # other request
+    other_job_id, code = submit(["9075-18"])
+    assert code == 202 and other_job_id != job_id
+
+    # idempotency key
+    keyed_job_id, _ = submit(["2112-19"], headers={"Idempotency-Key": "abc"})
+    assert submit(["2112-19"], headers={"Idempotency-Key": "abc"}) == (keyed_job_id, 200)
+    # the key of another request
+    assert submit(["2113-19"], headers={"Idempotency-Key": "abc"})[1] == 422
+    assert submit(["9075-18"], headers={"Idempotency-Key": "abc"})[1] == 422
+
+    # disable deduplication
+    app.config["JOB_MANAGER"].dedup_window = 0
+    assert submit(["2113-19", "9075-18"])[1] == 202
+    assert submit(["2113-19", "9075-18"])[1] == 202
+
+
+def test_toggle_rerun_noop(app, monkeypatch, init_rerun_func):
+    """Test that reruns not changing the pedigree are skipped."""
+    mock_connection, _, _, _, mock_runrescore = init_rerun_func
+    monkeypatch.setattr("app.api.create_new_pedigree", create_new_pedigree)
+    monkeypatch.setattr("app.api.create_rundata", create_rundata)
+    monkeypatch.setattr("app.api.diff_pedigree", diff_pedigree)
+    monkeypatch.setitem(app.config, "SSH_KEY_FILENAME", "/path/to/ssh-keys")
+
+    # all samples with original metadata
+    sample_ids = ["9075-18", "2112-19", "2113-19"]
+    result = conduct_reanalysis("9075-18", sample_ids=sample_ids, body=[])
+    assert result["noop"] is True
+    mock_connection.assert_not_called()
+    mock_runrescore.assert_not_called()
+
+    # modified phenotype only rescores snv and sv
+    body = [{"sample_id": "2112-19", "sex": 2, "phenotype": 2}]
+    result = conduct_reanalysis("9075-18", sample_ids=sample_ids, body=body)
+    assert result["changes"] == [
+        {"sample_id": "2112-19", "field": "phenotype", "old": 1, "new": 2}
+    ]
+    mock_runrescore.assert_called_once()
+    run_data = mock_connection.return_value.put.call_args_list[0].args[0].read().decode()
+    assert run_data.splitlines()[1].endswith(",")  # no str vcf
+
+    # rerun unchanged pedigree when configured
+    monkeypatch.setitem(app.config, "RERUN_SKIP_NOOP", False)
+    result = conduct_reanalysis("9075-18", sample_ids=sample_ids, body=[])
+    assert "noop" not in result
+
+
+@pytest.fixture()
+def mock_asyncssh(monkeypatch):
+    """Patch asyncssh with connections that complete every command."""
+    connection = Mock(is_closed=Mock(return_value=False))
+    connection.run = AsyncMock(return_value=Mock(exit_status=0, stdout="4242\n", stderr=""))
+    mock_asyncssh = Mock(
+        connect=AsyncMock(return_value=connection), Error=type("Error", (Exception,), {})
+    )
+    monkeypatch.setattr("app.remote.asyncssh", mock_asyncssh)
+    return mock_asyncssh
+
+
+def test_toggle_rerun_async(app, monkeypatch, async_database, mock_asyncssh):
+    """Test running many reruns concurrently over one ssh connection."""
+    monkeypatch.setitem(app.config, "SSH_KEY_FILENAME", "/path/to/ssh-keys")
+    monkeypatch.setitem(app.config, "WORKFLOW_EXEC_SCRIPT", "rescore.sh")
+    body = [{"sample_id": "2112-19", "phenotype": 2}]
+
+    async def rerun_many():
+        reruns = [
+            conduct_reanalysis_async("9075-18", sample_ids=["9075-18", "2112-19"], body=body)
+            for _ in range(20)
+        ]
+        return await asyncio.gather(*reruns)
+
+    with app.app_context():
+        results = asyncio.run(rerun_many())
+    assert all(res["host"] == "http://worker.remote" for res in results)
+    mock_asyncssh.connect.assert_called_once_with(
+        "http://worker.remote",
+        username="user",
+        keepalive_interval=30,
+        client_keys=["/path/to/ssh-keys"],
+        passphrase=None,
+    )
+    connection = mock_asyncssh.connect.return_value
+    # files are uploaded and the rerun is started by separate commands
+    assert connection.run.call_count == 40
+    upload_cmd = connection.run.call_args_list[0].args[0]
+    assert "group,assay" in upload_cmd and "9075-18-ped-update" in upload_cmd
+
+    # failing command
+    connection.run.return_value = Mock(exit_status=1, stdout="", stderr="crash")
+    with app.app_context(), pytest.raises(PipelineExecutionError):
+        asyncio.run(conduct_reanalysis_async("9075-18", sample_ids=["9075-18"]))
+
+
+def test_toggle_rerun_async_blocking_calls(app, monkeypatch, async_database, mock_asyncssh):
+    """Test that the job store and the case cache watcher are not used on the event loop."""
+    monkeypatch.setitem(app.config, "SSH_KEY_FILENAME", "/path/to/ssh-keys")
+    monkeypatch.setitem(app.config, "WORKFLOW_EXEC_SCRIPT", "rescore.sh")
+    threads = {}
+    store = Mock(record_rerun=Mock(side_effect=lambda *a: threads.setdefault("store", get_ident())))
+    monkeypatch.setitem(app.config, "JOB_STORE", store)
+    monkeypatch.setattr(
+        app.config["CASE_CACHE"], "watch", lambda _: threads.setdefault("watch", get_ident())
+    )
+
+    async def rerun():
+        threads["loop"] = get_ident()
+        return await conduct_reanalysis_async("9075-18", sample_ids=["9075-18"])
+
+    with app.app_context():
+        asyncio.run(rerun())
+    store.record_rerun.assert_called_once()
+    assert threads["loop"] not in (threads["store"], threads["watch"])
+
+
+def test_batch_reanalysis_async(app, monkeypatch, async_database, mock_asyncssh):
+    """Test that a batch is submitted concurrently with results per case."""
+    monkeypatch.setitem(app.config, "SSH_KEY_FILENAME", "/path/to/ssh-keys")
+    monkeypatch.setitem(app.config, "WORKFLOW_EXEC_SCRIPT", "rescore.sh")
+    monkeypatch.setitem(app.config, "WORKFLOW_PIPELINED_SUBMIT", True)
+    reruns = [
+        {"case_id": "9075-18", "sample_ids": ["9075-18"]},
+        {"case_id": "missing_case", "sample_ids": ["9075-18"]},
+    ]
+    with app.app_context():
+        results = asyncio.run(conduct_batch_reanalysis_async(["9075-18", "missing_case"], reruns))
+    assert [res["state"] for res in results] == ["done", "failed"]
+    mock_asyncssh.connect.return_value.run.assert_called_once()
+
+
+def test_rerun_wrapper_backpressure(app, monkeypatch):
+    """Test that clients are asked to retry later when the queue is full."""
+    monkeypatch.setitem(app.config, "RERUN_RETRY_AFTER", 60)
+    manager = app.config["JOB_MANAGER"]
+    monkeypatch.setattr(manager, "submit_once", Mock(side_effect=QueueFullError("full")))
+    with app.test_request_context("/v1.0/rerun"):
+        msg, code, headers = rerun_wrapper("9075-18", sample_ids=["9075-18"])
+        assert (code, headers) == (429, {"Retry-After": "60"})
+        assert batch_rerun_wrapper([{"case_id": "9075-18"}], priority="research")[1] == 429
+    assert manager.submit_once.call_args.kwargs["priority"] == 10
+
+
+def test_queue_status(app, monkeypatch):
+    """Test reporting the depth of the queue."""
+    monkeypatch.setattr("app.api.conduct_reanalysis", Mock())
+    with app.test_request_context("/v1.0/rerun"):
+        body, *_ = rerun_wrapper("9075-18", priority="research", sample_ids=["9075-18"])
+        assert body["priority"] == 10
+        app.config["JOB_MANAGER"].get(body["job_id"]).wait(5)
+        status, code = queue_status()
+    assert code == 200
+    assert status["depth"] == 0 and status["by_priority"] == {}
+    assert status["hosts"] == {}
+
+
+def test_toggle_rerun_recorded(app, monkeypatch, init_rerun_func, tmp_path):
+    """Test that submitted reruns are recorded in the job store."""
+    init_rerun_func[0].return_value.host = "worker.remote"
+    store = JobStore(tmp_path / "jobs.sqlite")
+    monkeypatch.setitem(app.config, "JOB_STORE", store)
+    monkeypatch.setitem(app.config, "SSH_KEY_FILENAME", "/path/to/ssh-keys")
+    monkeypatch.setitem(app.config, "WORKFLOW_EXEC_SCRIPT", "rescore.sh")
+
+    result = conduct_reanalysis("9075-18", sample_ids=["9075-18"])
+    (rerun,) = store.list_reruns(case_id="9075-18")
+    assert rerun["rerun_group_id"] == result["rerun_group_id"]
+    assert rerun["command"] == f"rescore.sh {result['run_data']}"
+    assert rerun["changes"] == result["changes"] and rerun["host"] == "worker.remote"
+
+
+def test_pedigree_export(app, mongodb):
+    """Test that pedigrees of cases selected by id or owner are streamed."""
+    with app.test_request_context("/v1.0/pedigree"):
+        response = pedigree_export(case_id=["9075-18", "missing"])
+        assert response.mimetype == "text/tab-separated-values"
+        lines = response.get_data(as_text=True).splitlines()
+        assert [line.split("\t")[:2] for line in lines[1:]] == [
+            ["9075-18", "9075-18"],
+            ["9075-18", "2113-19"],
+            ["9075-18", "2112-19"],
+        ]
+        response = pedigree_export(owner="klingen_38", format="ndjson")
+        assert len(response.get_data().splitlines()) == 1
+        assert pedigree_export(owner="other", format="ndjson").get_data() == b""
+        assert pedigree_export()[1] == 400
+
+
+def test_rerun_preview(app, monkeypatch):
+    """Test that previewed files are reused by the matching rerun."""
+    monkeypatch.setitem(app.config, "SSH_KEY_FILENAME", "/path/to/ssh-keys")
+    monkeypatch.setattr("app.remote.Connection", Mock(spec=Connection))
+    monkeypatch.setattr("app.api.run_rescore", Mock())
+    body = [{"sample_id": "9075-18", "sex": 2}]
+    samples = ["9075-18", "2112-19", "2113-19"]
+    with app.test_request_context("/v1.0/rerun/preview"):
+        preview, code = rerun_preview("9075-18", sample_ids=samples, body=body)
+        assert code == 200
+        assert preview["changes"] == [{"sample_id": "9075-18", "field": "sex", "old": 1, "new": 2}]
+        assert preview["pedigree"].split("\t")[4] == "2"
+        assert preview["run_data"].startswith("group,assay,sv_vcf")
+        assert rerun_preview("missing", sample_ids=["9075-18"])[1] == 404
+        assert rerun_preview("9075-18", sample_ids=[])[1] == 400
+
+        build_pedigree = Mock(wraps=create_new_pedigree)
+        monkeypatch.setattr("app.api.create_new_pedigree", build_pedigree)
+        result = conduct_reanalysis("9075-18", sample_ids=samples, body=body)
+        assert result["rerun_group_id"] == preview["rerun_group_id"]
+        build_pedigree.assert_not_called()
+
+        # previews are used once
+        conduct_reanalysis("9075-18", sample_ids=samples, body=body)
+        build_pedigree.assert_called_once()
+
+        # and not after the case was changed
+        rerun_preview("9075-18", sample_ids=samples, body=body)
+        app.config["MONGO_DATABASE"].case.update_one(
+            {"_id": "9075-18"}, {"$set": {"vcf_files.vcf_snv": "/new/snv.vcf.gz"}}
+        )
+        app.config["CASE_CACHE"].clear()
+        conduct_reanalysis("9075-18", sample_ids=samples, body=body)
+        assert build_pedigree.call_count == 3  # by the preview and the rerun
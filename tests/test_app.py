@@ -0,0 +1,54 @@
+"""Test setup of the app."""
+from unittest.mock import MagicMock, Mock
+
+from app.app import SPEC_PATH, create_app, load_spec
+from app.db import get_database
+
+from .config import TestConfig
+
+
+def test_load_config(tmp_path, monkeypatch):
+    """Test that the config is read from the given path."""
+    config = tmp_path / "rerunner.yml"
+    config.write_text("TESTING: true\nWORKFLOW_HOST: remote.host\n")
+    app = create_app(config_path=str(config))
+    assert app.config["WORKFLOW_HOST"] == "remote.host"
+
+    # path from the environment
+    config.write_text("TESTING: true\nWORKFLOW_HOST: other.host\n")
+    monkeypatch.setenv("RERUNNER_CONFIG", str(config))
+    assert create_app().config["WORKFLOW_HOST"] == "other.host"
+
+
+def test_lazy_database(monkeypatch):
+    """Test that the database is connected on first use in each process."""
+    mock_client = MagicMock()
+    monkeypatch.setattr("app.db.MongoClient", mock_client)
+    app = create_app(TestConfig)
+    mock_client.assert_not_called()
+
+    with app.app_context():
+        database = get_database()
+        assert get_database() is database
+        mock_client.assert_called_once()
+
+        # new client in forked process
+        monkeypatch.setattr("app.db.os.getpid", Mock(return_value=-1))
+        get_database()
+        assert mock_client.call_count == 2
+
+
+def test_swagger_ui():
+    """Test that the swagger ui is only served if enabled."""
+    assert create_app(TestConfig).test_client().get("/v1.0/ui/").status_code == 404
+
+    class SwaggerConfig(TestConfig):
+        SWAGGER_UI = True
+
+    assert create_app(SwaggerConfig).test_client().get("/v1.0/ui/").status_code == 200
+
+
+def test_load_spec():
+    """Test loading the specification."""
+    spec = load_spec(SPEC_PATH)
+    assert spec["paths"]["/rerun"]["post"]["operationId"] == "app.api.rerun_wrapper"
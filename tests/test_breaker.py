@@ -0,0 +1,109 @@
+"""Test retries and circuit breakers."""
+import time
+from unittest.mock import Mock
+
+import pytest
+from app.api import health, rerun_wrapper
+from app.breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, retry
+from app.db import database_breaker, query_case
+from app.exceptions import CircuitOpenError
+from pymongo.errors import AutoReconnect
+
+
+def test_retry(monkeypatch):
+    """Test that transient errors are retried with growing delays."""
+    sleep = Mock()
+    monkeypatch.setattr("app.breaker.time.sleep", sleep)
+    func = Mock(side_effect=[OSError("refused"), OSError("refused"), "ok"])
+    assert retry(func, OSError, retries=2, backoff=1) == "ok"
+    assert [call.args[0] <= 2 ** idx for idx, call in enumerate(sleep.call_args_list)] == [True] * 2
+
+    func = Mock(side_effect=OSError("refused"))
+    with pytest.raises(OSError):
+        retry(func, OSError, retries=1, backoff=0)
+    assert func.call_count == 2
+
+    func = Mock(side_effect=KeyError("other"))
+    with pytest.raises(KeyError):
+        retry(func, OSError, retries=2)
+    func.assert_called_once()
+
+
+def test_circuit_breaker():
+    """Test that the breaker opens after repeated failures and fails fast."""
+    breaker = CircuitBreaker("remote", failure_threshold=2, reset_timeout=0.05)
+    for _ in range(2):
+        with pytest.raises(OSError):
+            with breaker.guard(OSError):
+                raise OSError("unreachable")
+    assert breaker.state == OPEN
+    with pytest.raises(CircuitOpenError):
+        with breaker.guard(OSError):
+            pass
+
+    # a trial call is let through after the timeout
+    time.sleep(0.05)
+    breaker.before_call()
+    assert breaker.state == HALF_OPEN
+    breaker.record_success()
+    assert (breaker.state, breaker.failures) == (CLOSED, 0)
+
+    # errors that are not failures of the dependency
+    with pytest.raises(KeyError):
+        with breaker.guard(OSError):
+            raise KeyError("case")
+    assert breaker.state == CLOSED
+
+
+def test_circuit_breaker_probe():
+    """Test that an open breaker is closed when the probe succeeds."""
+    probe = Mock(side_effect=[OSError("still down"), None])
+    breaker = CircuitBreaker("remote", failure_threshold=1, reset_timeout=0.01, probe=probe)
+    breaker.record_failure(OSError("down"))
+    assert breaker.state == OPEN
+    deadline = time.monotonic() + 5
+    while breaker.state == OPEN and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert breaker.state == CLOSED
+    assert probe.call_count == 2
+
+
+def test_database_retry(app, monkeypatch):
+    """Test that database queries are retried and guarded by the breaker."""
+    monkeypatch.setitem(app.config, "MONGO_RETRY_BACKOFF", 0)
+    monkeypatch.setitem(app.config, "CASE_CACHE", None)
+    collection = app.config["MONGO_DATABASE"].case
+    find_one = Mock(side_effect=[AutoReconnect("primary stepped down"), {"_id": "9075-18"}])
+    monkeypatch.setattr(type(collection), "find_one", lambda self, *args: find_one(*args))
+    with app.app_context():
+        assert query_case("9075-18") == {"_id": "9075-18"}
+        assert database_breaker().state == CLOSED
+
+        monkeypatch.setitem(app.config, "MONGO_RETRIES", 0)
+        database_breaker().failure_threshold = 1
+        database_breaker().probe = None  # reopened until a call is let through
+        find_one.side_effect = AutoReconnect("down")
+        with pytest.raises(AutoReconnect):
+            query_case("9075-18")
+        with pytest.raises(CircuitOpenError):
+            query_case("9075-18")
+
+
+def test_health(app, monkeypatch):
+    """Test that reruns are rejected while a dependency is down."""
+    with app.test_request_context("/v1.0/rerun"):
+        body, code = health()
+        assert (body["status"], code) == ("ok", 200)
+        assert set(body["breakers"]) == {"mongo", "ssh:http://worker.remote"}
+
+        breaker = database_breaker()
+        breaker.probe = None
+        breaker.failure_threshold = 1
+        breaker.record_failure(AutoReconnect("down"))
+        body, code = health()
+        assert (body["status"], code) == ("down", 503)
+        assert body["breakers"]["mongo"]["state"] == OPEN
+
+        msg, code, headers = rerun_wrapper("9075-18", sample_ids=["9075-18"])
+        assert (code, headers) == (503, {"Retry-After": "30"})
+        assert "mongo" in msg
@@ -0,0 +1,89 @@
+"""Test caching of case documents."""
+import time
+from unittest.mock import MagicMock, Mock
+
+from app.cache import CHANGE_STREAM_NOT_SUPPORTED, CaseCache, ChangeWatcher
+from app.db import query_case, query_cases
+from pymongo.errors import OperationFailure
+
+
+def test_lru_eviction():
+    """Test that the least recently used entry is evicted."""
+    cache = CaseCache(max_size=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1  # b is now least recently used
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("c") == 3
+    assert cache.stats()["evictions"] == 1
+    assert (cache.hits, cache.misses) == (2, 1)
+
+
+def test_ttl_expiry():
+    """Test that entries expire."""
+    cache = CaseCache(ttl=0)
+    cache.set("a", 1)
+    time.sleep(0.001)
+    assert cache.get("a") is None
+
+
+def _mock_collection(changes=None, error=None):
+    """Mock collection with a change stream."""
+    collection = Mock()
+    stream = MagicMock()
+    stream.__enter__.return_value = iter(changes or [])
+    collection.watch.return_value = stream
+    collection.watch.side_effect = error
+    return collection
+
+
+def test_change_stream_invalidation():
+    """Test that changed documents are invalidated."""
+    cache = CaseCache()
+
+    def changes():
+        cache.set("a", 1)
+        cache.set("b", 2)
+        yield {"documentKey": {"_id": "a"}}
+
+    collection = _mock_collection(changes())
+    # stop watching when the stream is reopened
+    collection.watch.side_effect = [collection.watch.return_value, RuntimeError("stop")]
+    ChangeWatcher(cache, collection, retry_delay=0).run()
+
+    assert cache.get("a") is None
+    assert cache.get("b") == 2
+    assert cache.invalidations == 1
+
+
+def test_change_stream_not_supported():
+    """Test that cache falls back on ttl when change streams are unavailable."""
+    cache = CaseCache()
+    error = OperationFailure("not a replica set", code=CHANGE_STREAM_NOT_SUPPORTED)
+    cache.watch(_mock_collection(error=error))
+    cache._watcher.join(5)
+    assert not cache._watcher.is_alive()
+    assert not cache.watching
+    # only one watcher is started
+    cache.watch(_mock_collection())
+    assert cache._watcher.collection.watch.call_count == 1
+
+
+def test_query_case_cached(app):
+    """Test that queried cases are cached."""
+    with app.app_context():
+        cache = app.config["CASE_CACHE"]
+        case = query_case("9075-18")
+        assert query_case("9075-18") is case
+        assert (cache.hits, cache.misses) == (1, 1)
+
+        # uncached projection
+        query_case("9075-18", projection=None)
+        assert (cache.hits, cache.misses) == (1, 1)
+
+        # batch queries only fetch missing cases
+        app.config["MONGO_DATABASE"] = Mock(wraps=app.config["MONGO_DATABASE"])
+        cases = query_cases(["9075-18"])
+        assert cases["9075-18"] is case
+        assert cache.hits == 2
@@ -0,0 +1,142 @@
+"""Test coalescing of reruns into shared launches."""
+import asyncio
+import copy
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import Mock
+
+import pytest
+from app.api import conduct_reanalysis
+from app.coalesce import Coalescer
+from app.exceptions import PipelineExecutionError
+from app.jobs import DONE, FAILED, JobManager
+from fabric import Connection
+
+
+def test_coalescer():
+    """Test that reruns submitted within the window are launched together."""
+    coalescer = Coalescer(window=5, max_size=3)
+    launch = Mock(side_effect=lambda reruns: [f"{rerun}-done" for rerun in reruns])
+    with ThreadPoolExecutor(3) as pool:
+        # the group is launched as soon as it is full
+        outcomes = list(pool.map(lambda key: coalescer.submit_wait(key, key, launch), "abc"))
+    assert outcomes == ["a-done", "b-done", "c-done"]
+    assert sorted(launch.call_args.args[0]) == ["a", "b", "c"]
+
+    # reruns with the same key are launched separately
+    coalescer.window = 0.05
+    with ThreadPoolExecutor(2) as pool:
+        list(pool.map(lambda key: coalescer.submit_wait(key, key, launch), "aa"))
+    assert [call.args[0] for call in launch.call_args_list[1:]] == [["a"], ["a"]]
+    assert coalescer.stats()["launches"] == 3
+
+    # errors of the launch are raised for all reruns
+    launch.side_effect = PipelineExecutionError("crash")
+    with pytest.raises(PipelineExecutionError):
+        coalescer.submit_wait("a", "a", launch)
+
+
+def test_coalescer_handoff():
+    """Test that reruns are handed to the coalescer without waiting for the launch."""
+    coalescer = Coalescer(window=0.2, max_size=3)
+    launch = Mock(side_effect=lambda reruns: [f"{rerun}-done" for rerun in reruns])
+    outcomes, delivered = {}, threading.Event()
+
+    def callback(key):
+        def deliver(outcome):
+            outcomes[key] = outcome
+            if len(outcomes) == 2:
+                delivered.set()
+
+        return deliver
+
+    for key in "ab":
+        coalescer.submit(key, key, launch, callback(key))
+    assert outcomes == {}  # returned before the launch
+    assert delivered.wait(5)
+    assert outcomes == {"a": "a-done", "b": "b-done"}
+    launch.assert_called_once()
+
+
+def test_coalescer_async():
+    """Test that reruns are coalesced on an event loop."""
+    coalescer = Coalescer(window=0.1, max_size=2)
+
+    async def launch(reruns):
+        return [ValueError(rerun) if rerun == "bad" else len(reruns) for rerun in reruns]
+
+    async def submit_all():
+        return await asyncio.gather(
+            *(coalescer.submit_async(key, key, launch) for key in ["a", "bad", "c"]),
+            return_exceptions=True,
+        )
+
+    first, second, third = asyncio.run(submit_all())
+    assert first == 2 and isinstance(second, ValueError) and third == 1
+    assert coalescer.stats()["launches"] == 2
+
+
+def test_coalesced_reanalysis(app, monkeypatch, mongodb):
+    """Test that concurrent reruns share one run data file and launch."""
+    other = copy.deepcopy(mongodb.case.find_one({"_id": "9075-18"}))
+    other["_id"] = other["case_id"] = "9075-19"
+    mongodb.case.insert_one(other)
+    monkeypatch.setitem(app.config, "SSH_KEY_FILENAME", "/path/to/ssh-keys")
+    monkeypatch.setitem(app.config, "COALESCER", Coalescer(window=0.2))
+    monkeypatch.setattr("app.remote.Connection", Mock(spec=Connection))
+    upload_files, run_rescore = Mock(), Mock()
+    monkeypatch.setattr("app.api.upload_files", upload_files)
+    monkeypatch.setattr("app.api.run_rescore", run_rescore)
+
+    def rerun(case_id):
+        with app.app_context():
+            return conduct_reanalysis(case_id, sample_ids=["9075-18"])
+
+    with ThreadPoolExecutor(2) as pool:
+        results = list(pool.map(rerun, ["9075-18", "9075-19"]))
+    run_rescore.assert_called_once()
+    assert results[0]["run_data"] == results[1]["run_data"]
+    assert [res["rerun_group_id"].split("-ped")[0] for res in results] == ["9075-18", "9075-19"]
+
+    files = upload_files.call_args.args[1]
+    run_data, pedigree = files.values()
+    assert run_data.count("\n") == 3  # header and one row per rerun
+    group_ids = {res["rerun_group_id"] for res in results}
+    assert {line.split(",")[0] for line in run_data.splitlines()[1:]} == group_ids
+    assert {line.split("\t")[0] for line in pedigree.splitlines()} == group_ids
+
+
+def test_coalesced_jobs(app, monkeypatch, mongodb):
+    """Test that a group of queued reruns is not limited by the number of workers."""
+    for idx in range(2):
+        other = copy.deepcopy(mongodb.case.find_one({"_id": "9075-18"}))
+        other["_id"] = other["case_id"] = f"9075-{20 + idx}"
+        mongodb.case.insert_one(other)
+    manager = JobManager(app, workers=1)
+    monkeypatch.setitem(app.config, "JOB_MANAGER", manager)
+    monkeypatch.setitem(app.config, "SSH_KEY_FILENAME", "/path/to/ssh-keys")
+    monkeypatch.setitem(app.config, "COALESCER", Coalescer(window=0.5))
+    monkeypatch.setattr("app.remote.Connection", Mock(spec=Connection))
+    monkeypatch.setattr("app.api.upload_files", Mock())
+    run_rescore = Mock()
+    monkeypatch.setattr("app.api.run_rescore", run_rescore)
+
+    case_ids = ["9075-18", "9075-20", "9075-21"]
+    jobs = [
+        manager.submit(conduct_reanalysis, case_id, sample_ids=["9075-18"]) for case_id in case_ids
+    ]
+    for job in jobs:
+        assert job.wait(5)
+    run_rescore.assert_called_once()  # one worker, one launch
+    assert [job.state for job in jobs] == [DONE] * 3
+    assert len({job.result["run_data"] for job in jobs}) == 1
+    assert all("coalesce" in job.stages for job in jobs)
+
+    # the failed launch fails the jobs handed to the leader
+    run_rescore.side_effect = PipelineExecutionError("crash")
+    jobs = [
+        manager.submit(conduct_reanalysis, case_id, sample_ids=["9075-18"]) for case_id in case_ids
+    ]
+    for job in jobs:
+        assert job.wait(5)
+    assert [job.state for job in jobs] == [FAILED] * 3
@@ -1,7 +1,14 @@
 """Test database interactions."""
+import asyncio
 
 import pytest
-from app.db import CaseNotFoundError, query_case
+from app.db import (
+    CaseNotFoundError,
+    query_case,
+    query_case_async,
+    query_cases,
+    query_cases_async,
+)
 
 
 def test_query_cases(app):
@@ -9,6 +16,28 @@ def test_query_cases(app):
     # success
     assert query_case("9075-18")
 
+    # only fields needed for the rerun are fetched
+    assert set(query_case("9075-18")) == {"_id", "individuals", "vcf_files"}
+    assert "owner" in query_case("9075-18", projection=None)
+
     # test case not exist
     with pytest.raises(CaseNotFoundError):
         query_case("Not a case_id")
+
+
+def test_query_multiple_cases(app):
+    """Test querying of several cases at once."""
+    cases = query_cases(["9075-18", "Not a case_id"])
+    assert list(cases) == ["9075-18"]
+    assert cases["9075-18"]["_id"] == "9075-18"
+
+
+def test_query_cases_async(app, async_database):
+    """Test querying of data without blocking."""
+    with app.app_context():
+        case = asyncio.run(query_case_async("9075-18"))
+        assert set(case) == {"_id", "individuals", "vcf_files"}
+        with pytest.raises(CaseNotFoundError):
+            asyncio.run(query_case_async("Not a case_id"))
+        cases = asyncio.run(query_cases_async(["9075-18", "Not a case_id"]))
+    assert list(cases) == ["9075-18"]
@@ -0,0 +1,148 @@
+"""Test routing of reruns to the workflow hosts."""
+from unittest.mock import Mock
+
+import pytest
+from app.api import conduct_batch_reanalysis, conduct_reanalysis
+from app.coalesce import Coalescer
+from app.exceptions import LaunchUnknownError, PipelineExecutionError
+from paramiko.ssh_exception import SSHException
+from app.hosts import get_router, get_workflow_host, workflow_hosts
+from app.remote import close_pool
+from fabric import Connection
+
+HOSTS = [
+    {"host": "head-1", "data_dir": "/data/one"},
+    {"host": "head-2", "user": "other", "data_dir": "/data/two", "exec_script": "run.sh"},
+]
+
+
+@pytest.fixture
+def mock_connection(app, monkeypatch):
+    """Configure two workflow hosts with mock connections."""
+    monkeypatch.setitem(app.config, "WORKFLOW_HOSTS", HOSTS)
+    monkeypatch.setitem(app.config, "SSH_KEY_FILENAME", "/path/to/ssh-keys")
+    monkeypatch.setitem(app.config, "WORKFLOW_EXEC_SCRIPT", "rescore.sh")
+    monkeypatch.setitem(app.config, "SSH_CONNECT_RETRIES", 0)
+    mock_connection = Mock(spec=Connection, side_effect=lambda **kw: Mock(**kw))
+    monkeypatch.setattr("app.remote.Connection", mock_connection)
+    return mock_connection
+
+
+def set_loads(router, loads):
+    """Set the probed load of hosts."""
+    for host, load in loads.items():
+        router._state(host).load = load
+        router._state(host).probed = float("inf")  # never stale
+
+
+def test_workflow_hosts(app, mock_connection):
+    """Test that settings missing for a host are taken from the app config."""
+    with app.app_context():
+        first, second = workflow_hosts()
+        assert (first.user, first.data_dir) == ("user", "/data/one")
+        assert first.exec_script == "rescore.sh"
+        assert (second.user, second.exec_script) == ("other", "run.sh")
+        assert get_workflow_host("unknown").data_dir == "/data/dir"
+
+
+def test_probe(app, mock_connection):
+    """Test that the load per cpu of hosts is probed."""
+    with app.app_context():
+        router = get_router()
+        mock_connection.side_effect = lambda **kw: Mock(
+            run=Mock(return_value=Mock(stdout="6.0 4\n" if kw["host"] == "head-1" else "1.5 4")),
+            **kw,
+        )
+        router.probe(workflow_hosts())
+        assert [host.host for host in router.candidates()] == ["head-2", "head-1"]
+        assert router.stats()["head-1"]["load"] == 1.5
+
+
+def test_least_loaded_host(app, monkeypatch, mock_connection):
+    """Test that reruns are submitted to the least loaded host."""
+    monkeypatch.setattr("app.api.run_rescore", Mock())
+    with app.app_context():
+        set_loads(get_router(), {"head-1": 2.0, "head-2": 0.5})
+        result = conduct_reanalysis("9075-18", sample_ids=["9075-18"])
+    assert result["host"] == "head-2"
+    assert result["run_data"].startswith("/data/two/")
+    mock_connection.assert_called_once()
+    assert mock_connection.call_args.kwargs["user"] == "other"
+
+
+def test_failover(app, monkeypatch, mock_connection):
+    """Test that reruns are submitted to the next host when a host fails."""
+    upload_files = Mock(side_effect=[SSHException("connection lost"), None])
+    monkeypatch.setattr("app.api.upload_files", upload_files)
+    monkeypatch.setattr("app.api.run_rescore", Mock())
+    with app.app_context():
+        router = get_router()
+        set_loads(router, {"head-1": 0.1, "head-2": 0.5})
+        result = conduct_reanalysis("9075-18", sample_ids=["9075-18"])
+        assert result["host"] == "head-2"
+        assert not router.stats()["head-1"]["healthy"]
+        # failed hosts are tried last
+        assert [host.host for host in router.candidates()] == ["head-2", "head-1"]
+
+        # unreachable host
+        close_pool()
+        router.record_success("head-1")
+        upload_files.side_effect = None
+        mock_connection.side_effect = lambda **kw: Mock(
+            open=Mock(side_effect=OSError("unreachable")) if kw["host"] == "head-1" else Mock(),
+            **kw,
+        )
+        reruns = [{"case_id": "9075-18", "sample_ids": ["9075-18"]}] * 2
+        results = conduct_batch_reanalysis(["9075-18"], reruns)
+    assert [(res["state"], res["host"]) for res in results] == [("done", "head-2")] * 2
+
+
+def test_all_hosts_failed(app, monkeypatch, mock_connection):
+    """Test that the error of the last host is raised when all hosts fail."""
+    monkeypatch.setattr("app.api.upload_files", Mock(side_effect=SSHException("connection lost")))
+    monkeypatch.setattr("app.api.run_rescore", Mock())
+    with app.app_context():
+        with pytest.raises(SSHException):
+            conduct_reanalysis("9075-18", sample_ids=["9075-18"])
+        assert not any(host["healthy"] for host in get_router().stats().values())
+
+
+def test_script_failure(app, monkeypatch, mock_connection):
+    """Test that reruns failed by the rescoring script are not submitted to other hosts."""
+    run_rescore = Mock(side_effect=PipelineExecutionError("crash"))
+    monkeypatch.setattr("app.api.run_rescore", run_rescore)
+    with app.app_context():
+        router = get_router()
+        set_loads(router, {"head-1": 0.1, "head-2": 0.5})
+        with pytest.raises(PipelineExecutionError):
+            conduct_reanalysis("9075-18", sample_ids=["9075-18"])
+        run_rescore.assert_called_once()
+        assert all(host["healthy"] for host in router.stats().values())
+
+        reruns = [{"case_id": "9075-18", "sample_ids": ["9075-18"]}] * 2
+        results = conduct_batch_reanalysis(["9075-18"], reruns)
+    assert [(res["state"], res["status_code"]) for res in results] == [("failed", 500)] * 2
+    assert run_rescore.call_count == 3
+
+
+def test_launch_connection_lost(app, monkeypatch, mock_connection):
+    """Test that reruns are not submitted again when the connection is lost while starting them."""
+    monkeypatch.setattr("app.api.upload_files", Mock())
+    mock_connection.side_effect = lambda **kw: Mock(
+        run=Mock(side_effect=SSHException("connection lost")), **kw
+    )
+    with app.app_context():
+        router = get_router()
+        set_loads(router, {"head-1": 0.1, "head-2": 0.5})
+        with pytest.raises(LaunchUnknownError):
+            conduct_reanalysis("9075-18", sample_ids=["9075-18"])
+
+        reruns = [{"case_id": "9075-18", "sample_ids": ["9075-18"]}] * 2
+        results = conduct_batch_reanalysis(["9075-18"], reruns)
+
+        # coalesced launches
+        monkeypatch.setitem(app.config, "COALESCER", Coalescer(window=0))
+        with pytest.raises(LaunchUnknownError):
+            conduct_reanalysis("9075-18", sample_ids=["9075-18"])
+    assert [(res["state"], res["status_code"]) for res in results] == [("failed", 500)] * 2
+    assert {call.kwargs["host"] for call in mock_connection.call_args_list} == {"head-1"}
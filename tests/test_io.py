@@ -1,10 +1,19 @@
 """Test io operations."""
 
 from csv import DictWriter
+from io import StringIO
 from unittest.mock import Mock, mock_open, patch
 
 import pytest
-from app.io import create_new_pedigree, create_rundata
+from app.db import query_case
+from app.io import (
+    Family,
+    create_new_pedigree,
+    create_rundata,
+    diff_pedigree,
+    export_pedigrees,
+    rescored_vcf_types,
+)
 from app.api import build_new_case_id
 
 
@@ -208,3 +217,125 @@ def test_to_ped(app, monkeypatch):
     mock_dictwriter.return_value.writerow.assert_called()
     # wrote two rows
     assert mock_dictwriter.return_value.writerow.call_count == 2
+
+
+def test_create_rundata_vcf_types(app):
+    """Test that only the vcf files to rescore are included."""
+    dta = create_rundata("9075-18", "new_case_id", vcf_types={"snv_vcf"})[0]
+    assert list(dta) == ["group", "assay", "sv_vcf", "snv_vcf", "str_vcf"]
+    assert dta["snv_vcf"].endswith("vcf.gz")
+    assert dta["sv_vcf"] == dta["str_vcf"] == ""
+
+
+def test_diff_pedigree(app):
+    """Test comparing a new pedigree with the original case."""
+    case = query_case("9075-18")
+    all_ids = ["9075-18", "2112-19", "2113-19"]
+
+    # unchanged
+    ped = create_new_pedigree("9075-18", "new_case_id", all_ids, case=case)
+    assert diff_pedigree(case, ped) == []
+
+    # modified sex
+    ped = create_new_pedigree(
+        "9075-18", "new_case_id", all_ids, [{"sample_id": "2113-19", "sex": 2}], case=case
+    )
+    assert diff_pedigree(case, ped) == [
+        {"sample_id": "2113-19", "field": "sex", "old": 1, "new": 2}
+    ]
+
+    # excluded father
+    ped = create_new_pedigree("9075-18", "new_case_id", ["9075-18", "2112-19"], case=case)
+    assert diff_pedigree(case, ped) == [
+        {"sample_id": "9075-18", "field": "father", "old": "2113-19", "new": 0},
+        {"sample_id": "2113-19", "field": "excluded", "old": False, "new": True},
+    ]
+
+
+@pytest.mark.parametrize(
+    "fields,exp_vcf_types",
+    [
+        ([], set()),
+        (["phenotype"], {"sv_vcf", "snv_vcf"}),
+        (["phenotype", "sex"], {"sv_vcf", "snv_vcf", "str_vcf"}),
+        (["excluded"], {"sv_vcf", "snv_vcf", "str_vcf"}),
+    ],
+)
+def test_rescored_vcf_types(fields, exp_vcf_types):
+    """Test selecting vcf types to rescore."""
+    changes = [{"sample_id": "id", "field": field} for field in fields]
+    assert rescored_vcf_types(changes) == exp_vcf_types
+
+
+def test_family_index():
+    """Test looking up individuals and children in a family."""
+    family = Family(family_id="fam")
+    family.add("child", mother="mom", father="dad", sex=1, phenotype=2)
+    family.add("mom", sex=2)
+    assert len(family) == 2 and "mom" in family and "dad" not in family
+    assert family.get("child").mother == "mom"
+    assert family.get("dad") is None
+    assert family.children("mom") == family.children("dad") == ["child"]
+    with pytest.raises(ValueError):
+        family.add("mom")
+    with pytest.raises(ValueError):
+        family.add("other", sex=3)
+
+
+@pytest.mark.parametrize(
+    "individuals,exp_errors",
+    [
+        ([("child", "mom", "dad", 1), ("mom", 0, 0, 2), ("dad", 0, 0, 1)], []),
+        (
+            [("child", "mom", 0, 1)],
+            ["mother mom of child is not in the family"],
+        ),
+        (
+            [("child", "mom", "dad", 1), ("mom", 0, 0, 1), ("dad", 0, 0, 2)],
+            ["mother mom of child is male", "father dad of child is female"],
+        ),
+        (
+            [("a", "b", 0, 2), ("b", "a", 0, 2), ("c", "a", 0, 1)],
+            ["cycle in the ancestry of: a, b, c"],
+        ),
+    ],
+)
+def test_validate_family(individuals, exp_errors):
+    """Test validation of pedigrees."""
+    family = Family(family_id="fam")
+    for ind_id, mother, father, sex in individuals:
+        family.add(ind_id, mother=mother, father=father, sex=sex)
+    assert family.validate() == exp_errors
+
+
+def test_large_family():
+    """Test pedigrees with thousands of members."""
+    family = Family(family_id="fam")
+    for idx in range(5000):
+        family.add(f"s{idx}", mother=f"s{idx - 1}" if idx else 0, sex=2)
+    assert family.validate() == []
+    ped = family.to_json()
+    assert len(ped) == 5000 and ped[-1]["mother"] == "s4998"
+    output = StringIO()
+    family.to_ped(output, write_header=False)
+    assert output.getvalue().splitlines()[1] == "fam\ts1\ts0\t0\t2\t0"
+
+
+def test_export_pedigrees(app):
+    """Test that pedigrees are serialized in chunks of cases."""
+    individual = {"mother": "0", "father": "0", "sex": "female", "phenotype": "affected"}
+    cases = [
+        {"_id": f"case-{idx}", "individuals": [{"individual_id": f"s{idx}", **individual}]}
+        for idx in range(5)
+    ]
+    cases.insert(2, {"_id": "invalid", "individuals": [{"individual_id": "s"}]})
+    with app.app_context():
+        chunks = list(export_pedigrees(iter(cases), batch_size=2))
+        assert len(chunks) == 3
+        lines = "".join(chunks).splitlines()
+        assert lines[0] == "\t".join(Family.ped_header)
+        assert lines[1:3] == ["case-0\ts0\t0\t0\t2\t2", "case-1\ts1\t0\t0\t2\t2"]
+        assert len(lines) == 6  # the invalid case is skipped
+
+        ndjson = "".join(export_pedigrees(iter(cases[:1]), output_format="ndjson"))
+        assert ndjson.count("\n") == 1 and '"case_id": "case-0"' in ndjson
@@ -0,0 +1,132 @@
+"""Test background execution of jobs."""
+import asyncio
+import threading
+import time
+from unittest.mock import Mock
+
+import pytest
+from app.exceptions import QueueFullError
+from app.jobs import DONE, FAILED, AsyncJobManager, JobManager, stage
+
+
+def test_run_job(app):
+    """Test that jobs are run in the background."""
+    manager = JobManager(app, workers=1)
+
+    def func(case_id, sample_ids):
+        with stage("first"):
+            pass
+        return {"case_id": case_id, "sample_ids": sample_ids}
+
+    job = manager.submit(func, "case", sample_ids=["a"])
+    assert job.wait(5)
+    assert job.state == DONE
+    assert job.result == {"case_id": "case", "sample_ids": ["a"]}
+    assert list(job.stages) == ["first"]
+    assert manager.get(job.id) is job
+    assert manager.list(case_id="case") == [job]
+    assert manager.list(case_id="other") == []
+
+
+def test_failed_job(app):
+    """Test that errors are recorded."""
+    error_handler = Mock(return_value=("Not found", 404))
+    manager = JobManager(app, workers=1, error_handler=error_handler)
+
+    job = manager.submit(Mock(side_effect=KeyError("case")), "case")
+    assert job.wait(5)
+    assert job.state == FAILED
+    assert (job.error, job.status_code) == ("Not found", 404)
+    assert job.to_json()["status_code"] == 404
+
+
+def test_queue_full(app):
+    """Test that the queue is bounded."""
+    manager = JobManager(app, workers=1, max_queued=1)
+    blocker = threading.Event()
+    running = manager.submit(lambda case_id: blocker.wait(5), "running")
+    while manager.queue_depth():  # wait until worker picked up job
+        pass
+    manager.submit(Mock(), "queued")
+    with pytest.raises(QueueFullError):
+        manager.submit(Mock(), "rejected")
+    blocker.set()
+    assert running.wait(5)
+
+
+def test_history_size(app):
+    """Test that old finished jobs are forgotten."""
+    manager = JobManager(app, workers=1, history=2)
+    jobs = [manager.submit(Mock(), f"case_{i}") for i in range(3)]
+    for job in jobs:
+        job.wait(5)
+    manager.submit(Mock(), "case_3").wait(5)
+    assert manager.get(jobs[0].id) is None
+    assert len(manager.list()) == 2
+
+
+def test_submit_once(app):
+    """Test that jobs are deduplicated by key within the window."""
+    manager = JobManager(app, workers=1, dedup_window=60)
+    job, created = manager.submit_once(Mock(), "case", ["key"])
+    assert created
+    assert manager.submit_once(Mock(), "case", ["other", "key"]) == (job, False)
+
+    # failed jobs are not reused
+    job.wait(5)
+    job.state = FAILED
+    new_job, created = manager.submit_once(Mock(), "case", ["key"])
+    assert created and new_job is not job
+
+    # expired keys
+    manager.dedup_window = 0.01
+    job, _ = manager.submit_once(Mock(), "case", ["expiring"])
+    time.sleep(0.02)
+    assert manager.submit_once(Mock(), "case", ["expiring"])[1]
+
+
+def test_async_job_manager(app):
+    """Test that coroutines are run concurrently on the event loop."""
+    manager = AsyncJobManager(app, concurrency=100, max_queued=200)
+
+    async def func(case_id):
+        with stage("wait"):
+            await asyncio.sleep(0.2)
+        return case_id
+
+    start = time.monotonic()
+    jobs = [manager.submit(func, f"case_{i}") for i in range(100)]
+    assert all(job.wait(5) for job in jobs)
+    assert time.monotonic() - start < 2
+    assert [job.result for job in jobs] == [f"case_{i}" for i in range(100)]
+    assert all(job.state == DONE and list(job.stages) == ["wait"] for job in jobs)
+
+    async def fail(case_id):
+        raise KeyError(case_id)
+
+    job = manager.submit(fail, "case")
+    assert job.wait(5) and job.state == FAILED
+
+
+def test_priority(app):
+    """Test that jobs with lower priority values are run first."""
+    manager = JobManager(app, workers=1)
+    blocker = threading.Event()
+    order = []
+    manager.submit(lambda case_id: blocker.wait(5), "running")
+    while manager.queue_depth():  # wait until worker picked up job
+        pass
+    jobs = [
+        manager.submit(lambda case_id: order.append(case_id), case_id, priority=priority)
+        for case_id, priority in [("research_1", 10), ("clinical", 0), ("research_2", 10)]
+    ]
+    assert manager.queue_stats() == {
+        "depth": 3,
+        "max_size": 100,
+        "running": 1,
+        "by_priority": {0: 1, 10: 2},
+    }
+    blocker.set()
+    for job in jobs:
+        job.wait(5)
+    assert order == ["clinical", "research_1", "research_2"]
@@ -0,0 +1,63 @@
+"""Test metrics."""
+from unittest.mock import Mock
+
+from app.api import rerun_wrapper
+from app.jobs import stage
+from app.metrics import ERRORS, STAGE_DURATION, Counter, Histogram, Registry
+
+
+def test_render_counter():
+    """Test rendering counters in the Prometheus text format."""
+    registry = Registry()
+    counter = registry.register(Counter("errors_total", "Errors.", labels=["type"]))
+    counter.inc("KeyError")
+    counter.inc("KeyError")
+    counter.inc('Odd"Name')
+    assert registry.render().splitlines() == [
+        "# HELP errors_total Errors.",
+        "# TYPE errors_total counter",
+        'errors_total{type="KeyError"} 2',
+        'errors_total{type="Odd\\"Name"} 1',
+    ]
+
+
+def test_render_histogram():
+    """Test that histogram buckets are cumulative."""
+    registry = Registry()
+    hist = registry.register(Histogram("duration_seconds", "Duration.", buckets=(0.1, 1)))
+    for value in (0.05, 0.1, 0.5, 5):
+        hist.observe(value)
+    lines = registry.render().splitlines()
+    assert lines[2:] == [
+        'duration_seconds_bucket{le="0.1"} 2',
+        'duration_seconds_bucket{le="1"} 3',
+        'duration_seconds_bucket{le="+Inf"} 4',
+        "duration_seconds_sum 5.65",
+        "duration_seconds_count 4",
+    ]
+
+
+def test_stage_duration():
+    """Test that stages are observed."""
+    before = STAGE_DURATION.count("test_stage")
+    with stage("test_stage"):
+        pass
+    assert STAGE_DURATION.count("test_stage") == before + 1
+
+
+def test_metrics_endpoint(app, client, monkeypatch):
+    """Test exposing metrics."""
+    before = ERRORS.get("KeyError")
+    monkeypatch.setattr("app.api.conduct_reanalysis", Mock(side_effect=KeyError("key")))
+    with app.test_request_context("/v1.0/rerun"):
+        body, *_ = rerun_wrapper("9075-18")
+    app.config["JOB_MANAGER"].get(body["job_id"]).wait(5)
+    assert ERRORS.get("KeyError") == before + 1
+
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.content_type.startswith("text/plain")
+    text = response.get_data(as_text=True)
+    assert 'rerunner_errors_total{type="KeyError"}' in text
+    assert "rerunner_queue_depth 0" in text
+    assert "# TYPE rerunner_case_cache_hits_total counter" in text
@@ -0,0 +1,84 @@
+"""Test checking of input files before reruns are started."""
+import subprocess
+from unittest.mock import Mock
+
+import pytest
+from app.api import conduct_batch_reanalysis, error_response
+from app.exceptions import MissingInputFilesError
+from app.preflight import PreflightCache, check_inputs, preflight, stat_cmd
+from fabric import Connection
+
+SNV_VCF = "9075-18.snv.rescored.sorted.vcf.gz"
+
+
+def test_stat_cmd(tmp_path):
+    """Test that one command reports every missing file."""
+    (tmp_path / "exists.vcf.gz").touch()
+    paths = [str(tmp_path / "exists.vcf.gz"), str(tmp_path / "missing's.vcf.gz")]
+    output = subprocess.run(
+        ["bash", "-c", stat_cmd(paths)], capture_output=True, text=True, check=True
+    ).stdout
+    assert output.splitlines() == ["0 ok", "1 missing"]
+    assert PreflightCache().update("host", paths, output) == {paths[1]}
+
+
+
+def test_preflight_unclear(app, monkeypatch):
+    """Test that only definite results of the check are reported and cached."""
+    cache = PreflightCache(ttl=60)
+    monkeypatch.setitem(app.config, "PREFLIGHT_CACHE", cache)
+    conn = Mock(host="host")
+    conn.run.return_value = Mock(failed=True, stdout="", stderr="bash: not found")
+    prepared = Mock(case_id="case", input_files=("a.vcf", "b.vcf"))
+    with app.app_context():
+        assert preflight(conn, [prepared]) == {}  # not reported missing
+        assert cache.get("host", ["a.vcf", "b.vcf"]) == (set(), ["a.vcf", "b.vcf"])
+
+        conn.run.return_value = Mock(failed=False, stdout="Welcome to head-1\n1 missing\n")
+        assert preflight(conn, [prepared]) == {"case": ["b.vcf"]}
+        assert cache.get("host", ["a.vcf", "b.vcf"]) == ({"b.vcf"}, ["a.vcf"])
+
+def test_preflight_cached(app, monkeypatch):
+    """Test that checked files are cached."""
+    monkeypatch.setitem(app.config, "PREFLIGHT_CACHE", PreflightCache(ttl=60))
+    conn = Mock(host="host")
+    conn.run.return_value = Mock(failed=False, stdout="0 ok\n1 missing\n")
+    prepared = Mock(case_id="case", input_files=("a.vcf", "b.vcf"))
+    with app.app_context():
+        assert preflight(conn, [prepared]) == {"case": ["b.vcf"]}
+        assert preflight(conn, [prepared, prepared]) == {"case": ["b.vcf"]}
+        conn.run.assert_called_once()
+        with pytest.raises(MissingInputFilesError):
+            check_inputs(preflight(conn, [prepared]), "case")
+        assert error_response(MissingInputFilesError("missing"))[1] == 422
+
+
+def test_batch_preflight(app, monkeypatch):
+    """Test that reruns of a batch are checked with one command and rejected before launch."""
+    monkeypatch.setitem(app.config, "PREFLIGHT_CACHE", PreflightCache(ttl=60))
+    monkeypatch.setitem(app.config, "SSH_KEY_FILENAME", "/path/to/ssh-keys")
+    monkeypatch.setitem(app.config, "WORKFLOW_PIPELINED_SUBMIT", True)
+    mock_runrescore = Mock()
+    monkeypatch.setattr("app.api.run_rescore", mock_runrescore)
+    conn = Mock(spec=Connection, host="http://worker.remote")
+
+    def run(cmd, **kwargs):
+        lines = cmd.splitlines()
+        return Mock(
+            failed=False,
+            stdout="".join(
+                f"{idx} {'missing' if SNV_VCF in line else 'ok'}\n"
+                for idx, line in enumerate(lines)
+            )
+        )
+
+    conn.run.side_effect = run
+    monkeypatch.setattr("app.remote.Connection", Mock(return_value=conn))
+
+    reruns = [{"case_id": "9075-18", "sample_ids": ["9075-18"]}] * 2
+    with app.app_context():
+        results = conduct_batch_reanalysis(["9075-18"], reruns)
+    assert [(res["state"], res["status_code"]) for res in results] == [("failed", 422)] * 2
+    assert SNV_VCF in results[0]["error"]
+    conn.run.assert_called_once()
+    mock_runrescore.assert_not_called()
@@ -0,0 +1,128 @@
+"""Test remote connections and commands."""
+import subprocess
+import threading
+from unittest.mock import Mock
+
+import pytest
+from app.exceptions import ConnectionPoolTimeout
+from app.remote import ConnectionPool, get_pool, write_files_cmd
+from fabric import Connection
+
+CONNECT_KWARGS = {"key_filename": ["/path/to/key"], "passphrase": "phrase"}
+
+
+@pytest.fixture()
+def mock_connection(monkeypatch):
+    """Patch fabric connections with healthy mocks."""
+    mock_connection = Mock(spec=Connection, side_effect=lambda **kw: Mock(host=kw["host"]))
+    monkeypatch.setattr("app.remote.Connection", mock_connection)
+    return mock_connection
+
+
+def test_reuse_connection(mock_connection):
+    """Test that released connections are reused."""
+    pool = ConnectionPool(max_size=2, keepalive=15)
+    with pool.connection("host", "user", CONNECT_KWARGS) as conn:
+        conn.open.assert_called_once()
+        conn.transport.set_keepalive.assert_called_with(15)
+    with pool.connection("host", "user", CONNECT_KWARGS) as other_conn:
+        assert other_conn is conn
+    assert mock_connection.call_count == 1
+
+    # new connection for another user
+    with pool.connection("host", "other_user", CONNECT_KWARGS) as other_conn:
+        assert other_conn is not conn
+    assert mock_connection.call_count == 2
+
+
+def test_discard_unhealthy_connection(mock_connection):
+    """Test that stale connections are closed instead of reused."""
+    pool = ConnectionPool()
+    with pool.connection("host", "user", CONNECT_KWARGS) as conn:
+        pass
+    conn.transport.is_active.return_value = False
+
+    with pool.connection("host", "user", CONNECT_KWARGS) as new_conn:
+        assert new_conn is not conn
+    conn.close.assert_called_once()
+
+
+def test_health_checked_once_after_error(mock_connection):
+    """Test that a connection used by a failed command is checked once."""
+    pool = ConnectionPool()
+    with pytest.raises(KeyError):
+        with pool.connection("host", "user", CONNECT_KWARGS) as conn:
+            raise KeyError("failed")
+    conn.transport.send_ignore.assert_called_once()
+
+    with pool.connection("host", "user", CONNECT_KWARGS) as reused:
+        assert reused is conn  # healthy connections are kept
+
+
+def test_health_check_outside_lock(mock_connection):
+    """Test that other connections can be borrowed while the health of one is checked."""
+    pool = ConnectionPool()
+    with pool.connection("host", "user", CONNECT_KWARGS) as conn:
+        pass
+
+    def send_ignore():
+        def borrow():
+            with pool.connection("other", "user", CONNECT_KWARGS):
+                borrowed.set()
+
+        borrowed = threading.Event()
+        threading.Thread(target=borrow, daemon=True).start()
+        assert borrowed.wait(5)  # not blocked by the check
+
+    conn.transport.send_ignore.side_effect = send_ignore
+    with pool.connection("host", "user", CONNECT_KWARGS) as reused:
+        assert reused is conn
+
+
+def test_max_size(mock_connection):
+    """Test that the pool blocks when all connections are borrowed."""
+    pool = ConnectionPool(max_size=1, acquire_timeout=0.01)
+    conn = pool.acquire("host", "user", CONNECT_KWARGS)
+    with pytest.raises(ConnectionPoolTimeout):
+        pool.acquire("host", "user", CONNECT_KWARGS)
+
+    # waiting borrower gets the released connection
+    pool.acquire_timeout = 5
+    borrowed = []
+    thread = threading.Thread(
+        target=lambda: borrowed.append(pool.acquire("host", "user", CONNECT_KWARGS))
+    )
+    thread.start()
+    pool.release(conn)
+    thread.join()
+    assert borrowed == [conn]
+
+
+def test_evict_idle(mock_connection):
+    """Test that idle connections are closed."""
+    pool = ConnectionPool(idle_timeout=0)
+    with pool.connection("host", "user", CONNECT_KWARGS) as conn:
+        pass
+    pool.evict_idle()
+    conn.close.assert_called_once()
+    assert pool.stats() == {"user@host": {"open": 0, "idle": 0}}
+
+
+def test_get_pool(app, monkeypatch):
+    """Test that the pool is configured from the app."""
+    monkeypatch.setitem(app.config, "SSH_POOL_MAX_SIZE", 8)
+    with app.app_context():
+        pool = get_pool()
+        assert pool.max_size == 8
+        assert get_pool() is pool
+
+
+def test_write_files_cmd(tmp_path):
+    """Test that files are written by the remote command."""
+    files = {
+        tmp_path / "file.csv": "group,assay\ncase,rescore\n",
+        tmp_path / "file.ped": "case\tid\t0\t0\t1\t2",
+    }
+    subprocess.run(["bash", "-c", write_files_cmd(files)], check=True)
+    assert (tmp_path / "file.csv").read_text() == files[tmp_path / "file.csv"]
+    assert (tmp_path / "file.ped").read_text() == files[tmp_path / "file.ped"] + "\n"
@@ -0,0 +1,59 @@
+"""Test limits on concurrent submissions."""
+import asyncio
+import threading
+import time
+
+from app.scheduler import HostLimiter
+
+
+def test_slot():
+    """Test that concurrent submissions are capped per host."""
+    limiter = HostLimiter(max_per_host=2)
+    active, max_active = [0], [0]
+    lock = threading.Lock()
+
+    def submit():
+        with limiter.slot("host"):
+            with lock:
+                active[0] += 1
+                max_active[0] = max(max_active[0], active[0])
+            time.sleep(0.05)
+            with lock:
+                active[0] -= 1
+
+    threads = [threading.Thread(target=submit) for _ in range(6)]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.01)
+    assert limiter.stats() == {"host": {"limit": 2, "active": 2, "waiting": 4}}
+    for thread in threads:
+        thread.join()
+    assert max_active[0] == 2
+
+    # other hosts have their own slots
+    with limiter.slot("host"), limiter.slot("host"), limiter.slot("other_host"):
+        assert limiter.stats()["other_host"]["active"] == 1
+
+
+def test_slot_async():
+    """Test that concurrent submissions of coroutines are capped per host."""
+    limiter = HostLimiter(max_per_host=3)
+    active = []
+
+    async def submit():
+        async with limiter.slot_async("host"):
+            active.append(limiter.stats()["host"]["active"])
+            await asyncio.sleep(0.01)
+
+    async def submit_many():
+        await asyncio.gather(*(submit() for _ in range(10)))
+
+    asyncio.run(submit_many())
+    assert max(active) == 3
+
+
+def test_unlimited():
+    """Test that submissions are not limited when the limit is 0."""
+    limiter = HostLimiter(max_per_host=0)
+    with limiter.slot("host"), limiter.slot("host"):
+        assert limiter.stats() == {}
@@ -0,0 +1,174 @@
+"""Test the persistent job store."""
+import time
+from unittest.mock import Mock
+
+import pytest
+from app.api import PreparedRerun, rerun_history, rerun_status
+from app.app import create_app
+from app.exceptions import IdempotencyKeyConflict
+from app.jobs import DONE, FAILED, LAUNCHED, QUEUED, RUNNING, Job, JobManager
+from app.store import JobStore
+from app.tracking import RemoteLaunch
+
+from .config import TestConfig
+
+PREPARED = PreparedRerun(
+    "case", "case-ped-update", "case_rescore", "group,assay\n", "case\tid\t0\t0\t1\t2\n"
+)
+
+
+def rerun(case_id, **params):
+    """Job function that can be imported when the job is recovered."""
+    return {"case_id": case_id, **params}
+
+
+@pytest.fixture()
+def store(tmp_path):
+    """Job store in a temporary directory."""
+    return JobStore(tmp_path / "jobs.sqlite")
+
+
+def test_save_job(store):
+    """Test storing and listing jobs by case."""
+    job = Job(func=rerun, case_id="case", params={"sample_ids": ["a"]}, priority=10)
+    batch = Job(func=rerun, case_id=["case", "other_case"])
+    store.save_job(job)
+    store.save_job(batch)
+    job.stages["fetch_case"] = 0.1
+    job.finish(DONE)
+    store.save_job(job)
+
+    stored = store.get_job(job.id)
+    assert stored["func"] == "tests.test_store.rerun"
+    assert stored["state"] == DONE and stored["stages"] == {"fetch_case": 0.1}
+    assert stored["params"] == {"sample_ids": ["a"]} and stored["priority"] == 10
+    assert store.get_job("not_a_job") is None
+
+    assert [row["id"] for row in store.list_jobs(case_id="case")] == [batch.id, job.id]
+    assert [row["id"] for row in store.list_jobs(case_id="other_case")] == [batch.id]
+    assert [row["id"] for row in store.list_jobs(state=DONE)] == [job.id]
+    assert store.list_jobs(since=time.time() + 1) == []
+
+
+def test_record_rerun(store):
+    """Test recording submitted reruns."""
+    store.record_rerun("job_id", PREPARED, "host", "/data/case.csv", "rescore.sh /data/case.csv")
+    (rerun,) = store.list_reruns(case_id="case")
+    assert rerun["job_id"] == "job_id"
+    assert rerun["pedigree"] == PREPARED.pedigree and rerun["run_data"] == PREPARED.run_data
+    assert rerun["command"] == "rescore.sh /data/case.csv"
+    assert store.list_reruns(case_id="other_case") == []
+    assert store.list_reruns(until=rerun["created"]) == []
+
+
+def test_shared_dedup(app, store, tmp_path):
+    """Test that duplicated requests are found by all processes sharing the store."""
+    manager = JobManager(app, workers=1, store=store)
+    other_store = JobStore(tmp_path / "jobs.sqlite")
+    other_store.token = "other_process"
+    other_manager = JobManager(app, workers=1, store=other_store)
+
+    job, created = manager.submit_once(rerun, "case", ["hash", "key"], fingerprint="hash")
+    assert created and job.wait(5)
+    duplicate, created = other_manager.submit_once(rerun, "case", ["key"], fingerprint="hash")
+    assert not created and duplicate.id == job.id and duplicate.state == DONE
+    with pytest.raises(IdempotencyKeyConflict):
+        other_manager.submit_once(rerun, "case", ["other", "key"], fingerprint="other")
+
+    # failed jobs are not reused
+    job.finish(FAILED)
+    retried, created = other_manager.submit_once(rerun, "case", ["key"], fingerprint="hash")
+    assert created and retried.id != job.id
+    assert manager.submit_once(rerun, "case", ["key"], fingerprint="hash")[0].id == retried.id
+
+
+def test_claim_orphans(store, tmp_path):
+    """Test that only unfinished jobs of stopped processes are claimed."""
+    store.heartbeat()
+    jobs = [Job(func=rerun, case_id="case", state=state) for state in (QUEUED, DONE)]
+    for job in jobs:
+        store.save_job(job)
+
+    other_store = JobStore(tmp_path / "jobs.sqlite")
+    other_store.token = "other_process"
+    assert other_store.claim_orphans([QUEUED, RUNNING], lease=60) == []
+    time.sleep(0.02)
+    (claimed,) = other_store.claim_orphans([QUEUED, RUNNING], lease=0.01)
+    assert claimed["id"] == jobs[0].id
+    assert other_store.claim_orphans([QUEUED, RUNNING], lease=0.01) == []
+
+
+def _orphan(store, state, **kwargs):
+    """Save a job of a stopped process."""
+    job = Job(func=rerun, case_id="case", params={"sample_ids": ["a"]}, state=state, **kwargs)
+    store.save_job(job)
+    return job
+
+
+def test_recover(app, store, tmp_path):
+    """Test that unfinished jobs of stopped processes are recovered."""
+    queued = _orphan(store, QUEUED)
+    running = _orphan(store, RUNNING)
+    submitted = _orphan(store, RUNNING)
+    store.record_rerun(submitted.id, PREPARED, "host", "/data/case.csv", "rescore.sh")
+    launched = _orphan(store, LAUNCHED, result={"remote": {"pid": 1}})
+    launched.launches.append(RemoteLaunch("host", "user", "cmd", 1, "out", "err", "exit"))
+    store.save_job(launched)
+    store.save_job(_orphan(store, DONE))
+
+    new_store = JobStore(tmp_path / "jobs.sqlite")
+    manager = JobManager(app, workers=1, store=new_store, lease=0)
+    manager.resume_launches = Mock()
+    manager.recover()
+
+    for job in (queued, running):
+        recovered = manager.get(job.id)
+        assert recovered.wait(5) and recovered.state == DONE
+        assert recovered.result == {"case_id": "case", "sample_ids": ["a"]}
+        assert new_store.get_job(job.id)["state"] == DONE
+    assert manager.get(submitted.id).state == FAILED
+    recovered_launch = manager.get(launched.id)
+    assert recovered_launch.state == LAUNCHED
+    (job, launches), _ = manager.resume_launches.call_args
+    assert job is recovered_launch and launches[0]["pid"] == 1
+    assert len(manager.list()) == 4
+
+
+def test_recover_on_first_request(store, tmp_path):
+    """Test that jobs of a stopped process are recovered from the first request."""
+    queued = _orphan(store, QUEUED)  # the process never updated its heartbeat
+
+    class Config(TestConfig):
+        JOB_STORE_PATH = str(tmp_path / "jobs.sqlite")
+        RERUN_RECOVERY_LEASE = 0.3
+
+    app = create_app(Config)
+    manager = app.config["JOB_MANAGER"]
+    time.sleep(0.5)
+    assert manager.get(queued.id) is None  # not recovered before the first request
+
+    app.test_client().get("/")
+    deadline = time.monotonic() + 5
+    while manager.get(queued.id) is None and time.monotonic() < deadline:
+        time.sleep(0.05)
+    recovered = manager.get(queued.id)
+    assert recovered is not None and recovered.wait(5) and recovered.state == DONE
+
+
+def test_history(app, store, monkeypatch):
+    """Test looking up forgotten jobs and submitted reruns."""
+    monkeypatch.setitem(app.config, "JOB_STORE", store)
+    job = Job(func=rerun, case_id="case")
+    job.finish(DONE)
+    store.save_job(job)
+    store.record_rerun(job.id, PREPARED, "host", "/data/case.csv", "rescore.sh")
+    with app.app_context():
+        status, code = rerun_status(job.id)
+        assert code == 200 and status["state"] == DONE and status["job_id"] == job.id
+
+        reruns, code = rerun_history(case_id="case", since="2020-01-01")
+        assert code == 200 and [rerun["job_id"] for rerun in reruns] == [job.id]
+        assert rerun_history(case_id="case", until="2020-01-01")[0] == []
+
+        monkeypatch.setitem(app.config, "JOB_STORE", None)
+        assert rerun_history()[1] == 404
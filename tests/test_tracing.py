@@ -0,0 +1,52 @@
+"""Test tracing of reruns."""
+import json
+import logging
+
+import pytest
+from app.tracing import Tracer, current_span, parse_traceparent, span
+
+
+def test_parse_traceparent():
+    """Test reading the trace context of a caller."""
+    trace_id, span_id = "4bf92f3577b34da6a3ce929d0e0e4736", "00f067aa0ba902b7"
+    assert parse_traceparent(f"00-{trace_id}-{span_id}-01") == (trace_id, span_id)
+    assert parse_traceparent(f"00-{'0' * 32}-{span_id}-01") is None
+    assert parse_traceparent("not a traceparent") is None
+    assert parse_traceparent(None) is None
+
+
+def test_trace(tmp_path, caplog):
+    """Test that spans are exported as OTLP json and slow traces are logged."""
+    export_path = tmp_path / "traces.jsonl"
+    tracer = Tracer(export_path=str(export_path), slow_threshold=0)
+
+    with span("outside") as outside:
+        assert outside is None  # not traced
+    with caplog.at_level(logging.WARNING), pytest.raises(KeyError):
+        with tracer.trace("rerun", attributes={"case_id": "case"}) as root:
+            with span("fetch_case", {"db.system": "mongodb"}):
+                assert current_span().parent_id == root.id
+            with span("upload"):
+                with span("upload_file", {"bytes": 10}):
+                    raise KeyError("path")
+    assert current_span() is None
+
+    (line,) = export_path.read_text().splitlines()
+    (resource_spans,) = json.loads(line)["resourceSpans"]
+    assert resource_spans["resource"]["attributes"][0] == {
+        "key": "service.name",
+        "value": {"stringValue": "scout-rerunner"},
+    }
+    spans = {item["name"]: item for item in resource_spans["scopeSpans"][0]["spans"]}
+    assert list(spans) == ["rerun", "fetch_case", "upload", "upload_file"]
+    assert {item["traceId"] for item in spans.values()} == {root.trace_id}
+    assert "parentSpanId" not in spans["rerun"]
+    assert spans["upload_file"]["parentSpanId"] == spans["upload"]["spanId"]
+    assert spans["upload_file"]["attributes"] == [{"key": "bytes", "value": {"intValue": "10"}}]
+    assert spans["upload_file"]["status"] == {"code": 2, "message": "KeyError - 'path'"}
+    assert spans["fetch_case"]["status"] == {"code": 1}
+
+    # the slow trace is logged with the breakdown of its spans
+    assert f"Slow rerun took {root.duration:.3f}s, trace {root.trace_id}" in caplog.text
+    assert "\n  upload " in caplog.text and "\n    upload_file " in caplog.text
+    assert tracer.stats() == {"exported": 1, "slow": 1, "slow_threshold": 0}
@@ -0,0 +1,145 @@
+"""Test tracking of detached remote launches."""
+import subprocess
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from unittest.mock import Mock
+
+import pytest
+from app.api import run_rescore
+from app.jobs import DONE, FAILED, LAUNCHED, Job
+from app.tracking import LaunchTracker, RemoteLaunch, detached_cmd
+
+
+class LocalConnection(object):
+    """Stand-in for a connection running commands on the local host."""
+
+    host = "localhost"
+    user = "user"
+
+    def run(self, cmd, **kwargs):
+        proc = subprocess.run(["bash", "-c", cmd], capture_output=True, text=True)
+        return Mock(stdout=proc.stdout, stderr=proc.stderr, failed=proc.returncode != 0)
+
+
+@pytest.fixture()
+def local_pool(app, monkeypatch):
+    """Run remote commands on the local host."""
+
+    @contextmanager
+    def connection(host, user, connect_kwargs):
+        yield LocalConnection()
+
+    monkeypatch.setattr("app.tracking.get_pool", Mock(return_value=Mock(connection=connection)))
+    monkeypatch.setitem(app.config, "SSH_KEY_FILENAME", "/path/to/ssh-keys")
+
+
+def _launch(tmp_path, cmd):
+    """Launch a command detached on the local host."""
+    conn = LocalConnection()
+    resp = conn.run(detached_cmd(cmd, tmp_path / "rerun"))
+    return RemoteLaunch(
+        host=conn.host,
+        user=conn.user,
+        cmd=cmd,
+        pid=int(resp.stdout),
+        stdout_path=str(tmp_path / "rerun.out"),
+        stderr_path=str(tmp_path / "rerun.err"),
+        exit_path=str(tmp_path / "rerun.exit"),
+    )
+
+
+def _wait_for_exit(launch):
+    """Wait until the detached process has written its exit status."""
+    for _ in range(500):
+        if Path(launch.exit_path).exists():
+            return
+        time.sleep(0.01)
+
+
+def test_detached_cmd(tmp_path):
+    """Test that detached commands record output and exit status."""
+    launch = _launch(tmp_path, "echo out; echo err >&2; exit 3")
+    assert launch.pid > 0
+    _wait_for_exit(launch)
+    assert (tmp_path / "rerun.out").read_text() == "out\n"
+    assert (tmp_path / "rerun.err").read_text() == "err\n"
+    assert (tmp_path / "rerun.exit").read_text() == "3\n"
+
+
+@pytest.mark.parametrize("cmd,state", [("echo done", DONE), ("echo crash >&2; exit 1", FAILED)])
+def test_poll_finished_launch(app, local_pool, tmp_path, cmd, state):
+    """Test that jobs are finished when their launch exits."""
+    job = Job(func=Mock(), case_id="case", state=LAUNCHED)
+    launch = _launch(tmp_path, cmd)
+    result = {}
+    tracker = LaunchTracker(app, interval=3600)
+    tracker.track(job, launch, result)
+    assert result["remote"]["state"] == "running"
+
+    _wait_for_exit(launch)
+    with app.app_context():
+        tracker.poll()
+    assert job.state == state
+    assert job.wait(0)
+    assert "remote_exec" in job.stages
+    assert result["remote"]["exit_status"] == (0 if state == DONE else 1)
+    if state == FAILED:
+        assert result["remote"]["stderr"] == "crash"
+        assert job.status_code == 500
+
+
+def test_poll_lost_launch(app, local_pool, tmp_path):
+    """Test that launches without exit status are reported as lost."""
+    job = Job(func=Mock(), case_id="case", state=LAUNCHED)
+    proc = subprocess.Popen(["true"])
+    proc.wait()  # pid of an exited process
+    launch = RemoteLaunch(
+        host="localhost",
+        user="user",
+        cmd="true",
+        pid=proc.pid,
+        stdout_path=str(tmp_path / "rerun.out"),
+        stderr_path=str(tmp_path / "rerun.err"),
+        exit_path=str(tmp_path / "rerun.exit"),
+    )
+    tracker = LaunchTracker(app, interval=3600)
+    tracker.track(job, launch, {})
+    with app.app_context():
+        tracker.poll()
+    assert launch.state == "lost"
+    assert job.state == FAILED
+
+
+def test_run_rescore_detached(app, monkeypatch):
+    """Test that a detached launch returns without waiting for the script."""
+    monkeypatch.setitem(app.config, "WORKFLOW_EXEC_SCRIPT", "script_name.sh")
+    conn = Mock(host="host", user="user")
+    conn.run.return_value = Mock(stdout="1234\n", failed=False)
+    with app.app_context():
+        launch = run_rescore(conn, Path("/data/dir/case.csv"), detached=True)
+    cmd = conn.run.call_args.args[0]
+    assert "setsid nohup" in cmd
+    assert "script_name.sh /data/dir/case.csv" in cmd
+    assert launch.pid == 1234
+    assert launch.exit_path == "/data/dir/case.exit"
+
+
+def test_poll_partly_failed_batch(app, local_pool, tmp_path):
+    """Test that cases of a batch whose launch failed are marked failed."""
+    results = [{"case_id": "ok", "state": DONE}, {"case_id": "crash", "state": DONE}]
+    job = Job(func=Mock(), case_id=["ok", "crash"], state=LAUNCHED, result=results)
+    for case_id in ("ok", "crash"):
+        (tmp_path / case_id).mkdir()
+    launches = [_launch(tmp_path / "ok", "echo done"), _launch(tmp_path / "crash", "exit 1")]
+    tracker = LaunchTracker(app, interval=3600)
+    for launch, result in zip(launches, results):
+        tracker.track(job, launch, result)
+
+    for launch in launches:
+        _wait_for_exit(launch)
+    with app.app_context():
+        tracker.poll()
+    assert job.state == DONE
+    assert results[0]["state"] == DONE
+    assert results[1]["state"] == FAILED and results[1]["status_code"] == 500
@@ -0,0 +1,112 @@
+"""Test the content addressed cache of uploaded files."""
+import subprocess
+from unittest.mock import Mock
+
+import pytest
+from app.exceptions import UploadError
+from app.uploads import (
+    UploadIndex,
+    digest,
+    finish_upload,
+    prepare_upload,
+    upload_cmd,
+    upload_files,
+)
+
+
+class LocalConnection(object):
+    """Connection running commands with the local shell."""
+
+    host = "localhost"
+
+    def __init__(self):
+        self.commands = []
+        self.put = Mock(side_effect=self._put)
+
+    def run(self, cmd, hide=False, warn=False):
+        self.commands.append(cmd)
+        proc = subprocess.run(["bash", "-c", cmd], capture_output=True, text=True)
+        return Mock(failed=proc.returncode != 0, stdout=proc.stdout, stderr=proc.stderr)
+
+    @staticmethod
+    def _put(local, remote):
+        with open(remote, "wb") as out:
+            out.write(local.read())
+
+
+@pytest.fixture
+def upload_index(app, tmp_path, monkeypatch):
+    """Enable the upload cache with blobs in a temporary directory."""
+    index = UploadIndex(tmp_path / "blobs")
+    monkeypatch.setitem(app.config, "UPLOAD_INDEX", index)
+    return index
+
+
+def test_upload_files_linked(app, tmp_path, upload_index):
+    """Test that files with the same content are linked instead of uploaded."""
+    conn = LocalConnection()
+    content = "case\tid\t0\t0\t1\t2\n"
+    with app.app_context():
+        upload_files(conn, {tmp_path / "first.ped": content})
+        assert conn.put.call_count == 1
+        assert (upload_index.blob_path("localhost", digest(content))).read_text() == content
+
+        upload_files(conn, {tmp_path / "second.ped": content})
+    assert conn.put.call_count == 1
+    assert (tmp_path / "second.ped").read_text() == content
+    assert upload_index.stats() == {"blobs": {"localhost": 1}, "hits": 1, "misses": 1}
+    # the remote was listed once
+    assert sum(cmd.startswith("mkdir -p") and "ls -1" in cmd for cmd in conn.commands) == 1
+
+
+def test_upload_files_missing_blob(app, tmp_path, upload_index):
+    """Test that files are uploaded again when their blob was removed."""
+    conn = LocalConnection()
+    content = "group,assay\ncase,rescore\n"
+    with app.app_context():
+        upload_files(conn, {tmp_path / "first.csv": content})
+        upload_index.blob_path("localhost", digest(content)).unlink()
+
+        upload_files(conn, {tmp_path / "second.csv": content})
+    assert conn.put.call_count == 2
+    assert (tmp_path / "second.csv").read_text() == content
+    assert upload_index.blob_path("localhost", digest(content)).exists()
+
+
+def test_upload_cmd_cache_miss(app, tmp_path, upload_index):
+    """Test that commands linking missing blobs report a cache miss."""
+    conn = LocalConnection()
+    files = {tmp_path / "file.csv": "group,assay\n", tmp_path / "file.ped": "case\tid\n"}
+    with app.app_context():
+        cached = prepare_upload(conn, files)
+        assert cached == set()
+        resp = conn.run(upload_cmd(conn.host, files, cached))
+        assert finish_upload(conn, files, cached, resp)
+        assert upload_index.cached(conn.host, files) == {digest(c) for c in files.values()}
+
+        for path in files:
+            path.unlink()
+        for blob in upload_index.blob_dir.iterdir():
+            blob.unlink()
+        cached = prepare_upload(conn, files)
+        resp = conn.run(upload_cmd(conn.host, files, cached))
+        assert not finish_upload(conn, files, cached, resp)
+        assert upload_index.cached(conn.host, files) == set()
+        assert not any(path.exists() for path in files)
+
+
+def test_upload_files_command_failed(app, tmp_path, upload_index):
+    """Test that an upload command failing without a missing blob is an error."""
+    conn = LocalConnection()
+    content = "group,assay\ncase,rescore\n"
+    with app.app_context():
+        upload_files(conn, {tmp_path / "first.csv": content})
+        run = conn.run
+        conn.run = lambda cmd, **kwargs: (
+            Mock(failed=True, stdout="", stderr="Disk quota exceeded")
+            if cmd.startswith("set -e")
+            else run(cmd, **kwargs)
+        )
+        with pytest.raises(UploadError):
+            upload_files(conn, {tmp_path / "second.csv": content})
+    assert conn.put.call_count == 1  # not uploaded again as if the blob was missing